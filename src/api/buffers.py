@@ -0,0 +1,616 @@
+import atexit
+import json
+import logging
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from device.device_cache import device_cache
+from device.models import Device, RawData
+from device.raw_data_store import (RAW_DATA_LAYOUT_BUCKETS, compact_raw_data_window, get_bucket_start,
+                                   get_raw_data_layout)
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.utils import timezone
+
+logger = logging.getLogger('device')
+
+
+class RawDataWriter:
+    """
+        Micro-batching writer for incoming RawData rows.
+
+        Rows and the matching `last_data_sync_time` device updates are kept in
+        memory and flushed together, either when `max_rows` rows are pending or
+        when the oldest pending row is `max_delay_seconds` old. One flush is a
+        `bulk_create` per `max_rows` rows plus one `other_data` update per
+        device, instead of an insert and a device read/save per message.
+        Flushed rows are noted for bucket compaction, see RawDataBucketCompactor.
+
+        A failed batch is retried row by row, so a row which cannot be written
+        does not hold back the others; it is kept for `max_attempts` flushes and
+        then dropped. When a whole batch fails the remaining batches are kept
+        untried and flushes pause for `retry_delay_seconds`. At most
+        `max_pending_rows` rows are kept, the oldest are dropped beyond that.
+    """
+
+    def __init__(self, max_rows=200, max_delay_seconds=2.0, max_pending_rows=20000, max_attempts=5,
+                 retry_delay_seconds=1.0):
+        self.max_rows = int(max_rows)
+        self.max_delay_seconds = float(max_delay_seconds)
+        self.max_pending_rows = max(self.max_rows, int(max_pending_rows))
+        self.max_attempts = max(1, int(max_attempts))
+        self.retry_delay_seconds = float(retry_delay_seconds)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._rows = []
+        # Failed write attempts of the pending rows, by id() of the row.
+        self._attempts = {}
+        self._device_updates = {}
+        self._oldest_row_time = None
+        self._retry_after = None
+        self._flusher = None
+        self._stopped = threading.Event()
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+
+    @property
+    def enabled(self):
+        return self.max_rows > 1
+
+    def add(self, raw_data, device_updates=None):
+        """
+            Queue a RawData instance and the `other_data` keys to merge into its
+            device. Writes through immediately when buffering is disabled.
+        """
+        device_updates = device_updates or {}
+        if device_updates:
+            other_data = dict(raw_data.device.other_data or {})
+            other_data.update(device_updates)
+            raw_data.device.other_data = other_data
+
+        if not self.enabled:
+            raw_data.save()
+            if device_updates:
+                self._update_devices({raw_data.device_id: device_updates})
+            return
+
+        with self._lock:
+            self._rows.append(raw_data)
+            self._drop_overflow()
+            if device_updates:
+                self._device_updates.setdefault(raw_data.device_id, {}).update(device_updates)
+            if self._oldest_row_time is None:
+                self._oldest_row_time = time.monotonic()
+            should_flush = len(self._rows) >= self.max_rows and not self._retry_pending()
+        self._ensure_flusher()
+
+        if should_flush:
+            self.flush()
+
+    def _drop_overflow(self):
+        overflow = len(self._rows) - self.max_pending_rows
+        if overflow > 0:
+            for raw_data in self._rows[:overflow]:
+                self._attempts.pop(id(raw_data), None)
+            del self._rows[:overflow]
+            self.rows_dropped += overflow
+            logger.warning("RawData buffer is full, dropped %s oldest rows", overflow)
+
+    def _retry_pending(self):
+        return self._retry_after is not None and time.monotonic() < self._retry_after
+
+    def get_pending(self, device):
+        """Return the newest buffered row for the device, if any."""
+        with self._lock:
+            for raw_data in reversed(self._rows):
+                if raw_data.device_id == device.pk:
+                    return raw_data
+        return None
+
+    def get_pending_rows(self, device, data_type=None):
+        """Return the buffered rows of the device, oldest first."""
+        with self._lock:
+            return [
+                raw_data
+                for raw_data in self._rows
+                if raw_data.device_id == device.pk and (data_type is None or raw_data.data_type == data_type)
+            ]
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._rows)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                rows = self._rows
+                attempts = self._attempts
+                device_updates = self._device_updates
+                self._rows = []
+                self._attempts = {}
+                self._device_updates = {}
+                self._oldest_row_time = None
+
+            if not rows and not device_updates:
+                return 0
+
+            written, failed, untried = self._write_rows(rows)
+            if failed or untried:
+                self.failed_flushes += 1
+                retry_rows = []
+                retry_attempts = {}
+                for raw_data in failed:
+                    attempt = attempts.get(id(raw_data), 0) + 1
+                    if attempt >= self.max_attempts:
+                        self.rows_dropped += 1
+                        logger.error(
+                            "Dropped RawData row of device %s after %s failed attempts",
+                            raw_data.device_id, attempt,
+                        )
+                        continue
+                    retry_rows.append(raw_data)
+                    retry_attempts[id(raw_data)] = attempt
+                for raw_data in untried:
+                    retry_rows.append(raw_data)
+                    if id(raw_data) in attempts:
+                        retry_attempts[id(raw_data)] = attempts[id(raw_data)]
+                self._requeue(retry_rows, retry_attempts, {})
+                if not written:
+                    self._retry_after = time.monotonic() + self.retry_delay_seconds
+            else:
+                self._retry_after = None
+
+            if written:
+                self.flushes += 1
+                self.rows_written += len(written)
+                raw_data_bucket_compactor.note(written)
+            try:
+                if device_updates:
+                    self._update_devices(device_updates)
+            except Exception as ex:
+                logger.exception("Device sync time update failed: %s", ex)
+                self._requeue([], {}, device_updates)
+            return len(written)
+
+    def _write_rows(self, rows):
+        """
+            Insert the rows `max_rows` at a time, a failed batch is inserted
+            again row by row. Returns the written rows, the rows which failed
+            and the rows left untried because a whole batch failed.
+        """
+        written = []
+        failed = []
+        for start in range(0, len(rows), self.max_rows):
+            batch = rows[start:start + self.max_rows]
+            try:
+                RawData.objects.bulk_create(batch, batch_size=len(batch))
+            except Exception as ex:
+                logger.warning("RawData insert of %s rows failed, retrying them one by one: %s", len(batch), ex)
+            else:
+                written.extend(batch)
+                continue
+
+            batch_failed = []
+            for raw_data in batch:
+                try:
+                    RawData.objects.bulk_create([raw_data])
+                except Exception as ex:
+                    logger.exception("RawData insert for device %s failed: %s", raw_data.device_id, ex)
+                    batch_failed.append(raw_data)
+                else:
+                    written.append(raw_data)
+            failed.extend(batch_failed)
+            if len(batch_failed) == len(batch):
+                # Nothing could be written, likely an outage: keep the rest for a later flush.
+                return written, failed, rows[start + self.max_rows:]
+        return written, failed, []
+
+    def _requeue(self, rows, attempts, device_updates):
+        with self._lock:
+            # Keep the failed rows for the next attempt, ahead of newer data.
+            self._rows = rows + self._rows
+            self._attempts.update(attempts)
+            self._drop_overflow()
+            for device_id, updates in device_updates.items():
+                merged = dict(updates)
+                merged.update(self._device_updates.get(device_id, {}))
+                self._device_updates[device_id] = merged
+            if self._oldest_row_time is None and self._rows:
+                self._oldest_row_time = time.monotonic()
+
+    def _update_devices(self, device_updates):
+        device_state_writer.record_many(device_updates)
+
+    def _ensure_flusher(self):
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        self._stopped.clear()
+        self._flusher = threading.Thread(
+            target=self._run_flusher,
+            name="raw-data-flusher",
+            daemon=True,
+        )
+        self._flusher.start()
+
+    def _run_flusher(self):
+        interval = max(0.05, self.max_delay_seconds / 4)
+        while not self._stopped.wait(interval):
+            with self._lock:
+                oldest = self._oldest_row_time
+            if oldest is None or self._retry_pending():
+                continue
+            if time.monotonic() - oldest >= self.max_delay_seconds:
+                self.flush()
+                close_old_connections()
+
+    def close(self):
+        self._stopped.set()
+        self.flush()
+
+    def stats(self):
+        return {
+            "pending_rows": self.pending_count(),
+            "rows_written": self.rows_written,
+            "rows_dropped": self.rows_dropped,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+        }
+
+
+def _update_device_other_data(device_updates, attempts=3):
+    """
+        Merge the updates into `other_data` with one partial update per device.
+
+        An update only applies while the device's `updated_at` is still the
+        one read, a device saved meanwhile is read and merged again, up to
+        `attempts` times. Returns {device_pk: updates} of the devices that kept
+        changing, which are left for the caller to retry.
+    """
+    remaining = dict(device_updates)
+    for _ in range(attempts):
+        conflicts = {}
+        for device in Device.objects.filter(pk__in=list(remaining.keys())):
+            other_data = dict(device.other_data or {})
+            other_data.update(remaining[device.pk])
+            updated_at = timezone.now()
+            if not Device.objects.filter(pk=device.pk, updated_at=device.updated_at).update(
+                other_data=other_data,
+                updated_at=updated_at,
+            ):
+                conflicts[device.pk] = remaining[device.pk]
+                continue
+            device.other_data = other_data
+            device.updated_at = updated_at
+            device_cache.refresh(device)
+        remaining = conflicts
+        if not remaining:
+            break
+    if remaining:
+        logger.warning("Devices changed while merging other_data, not updated: %s", list(remaining))
+    return remaining
+
+
+class DeviceStateWriter:
+    """
+        Write-behind store for the volatile `other_data` fields of devices
+        (sync/heartbeat times, latest device status values).
+
+        Updates are written to one Redis hash per device and the device is
+        marked dirty; every `flush_interval_seconds` the dirty devices are
+        merged into their `other_data` with a partial update. Hashes outlive
+        the flush by `ttl_seconds`, so readers merging them with `merge_into`
+        always see the latest values. Without a Redis cache the updates are
+        written through immediately.
+    """
+
+    KEY_PREFIX = 'device_state:v1:'
+    DIRTY_KEY = 'device_state:v1:dirty'
+
+    def __init__(self, flush_interval_seconds=30.0, ttl_seconds=24 * 60 * 60, flush_batch_size=500):
+        self.flush_interval_seconds = float(flush_interval_seconds)
+        self.ttl_seconds = int(ttl_seconds)
+        self.flush_batch_size = max(1, int(flush_batch_size))
+        self._redis = None
+        self._redis_checked = False
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        self._stopped = threading.Event()
+        self.updates_recorded = 0
+        self.devices_flushed = 0
+        self.failed_flushes = 0
+
+    def _get_redis(self):
+        if not self._redis_checked:
+            with self._lock:
+                if not self._redis_checked:
+                    try:
+                        from django_redis import get_redis_connection
+                        self._redis = get_redis_connection('default')
+                    except (ImportError, NotImplementedError):
+                        self._redis = None
+                    self._redis_checked = True
+        return self._redis
+
+    def _key(self, device_pk):
+        return f"{self.KEY_PREFIX}{device_pk}"
+
+    def record(self, device_pk, updates):
+        self.record_many({device_pk: updates})
+
+    def record_many(self, device_updates):
+        device_updates = {device_pk: updates for device_pk, updates in device_updates.items() if updates}
+        if not device_updates:
+            return
+        self.updates_recorded += len(device_updates)
+
+        redis_client = self._get_redis()
+        if redis_client is None:
+            _update_device_other_data(device_updates)
+            return
+
+        pipeline = redis_client.pipeline(transaction=False)
+        for device_pk, updates in device_updates.items():
+            key = self._key(device_pk)
+            pipeline.hset(key, mapping={
+                field_name: json.dumps(value, default=str)
+                for field_name, value in updates.items()
+            })
+            pipeline.expire(key, self.ttl_seconds)
+            pipeline.sadd(self.DIRTY_KEY, str(device_pk))
+        pipeline.execute()
+        self._ensure_flusher()
+
+    def get_many(self, device_pks):
+        """Return {device_pk: {field: value}} of the recorded values."""
+        device_pks = list(device_pks)
+        redis_client = self._get_redis()
+        if redis_client is None or not device_pks:
+            return {}
+        pipeline = redis_client.pipeline(transaction=False)
+        for device_pk in device_pks:
+            pipeline.hgetall(self._key(device_pk))
+        states = {}
+        for device_pk, values in zip(device_pks, pipeline.execute()):
+            if values:
+                states[device_pk] = {
+                    self._decode(field_name): json.loads(value)
+                    for field_name, value in values.items()
+                }
+        return states
+
+    def merge_into(self, devices):
+        """Overlay the recorded values on the `other_data` of the devices."""
+        devices = [device for device in devices if device is not None]
+        try:
+            states = self.get_many(device.pk for device in devices)
+        except Exception as ex:
+            logger.warning("Failed to read device states: %s", ex)
+            return devices
+        for device in devices:
+            state = states.get(device.pk)
+            if state:
+                device.other_data = {**(device.other_data or {}), **state}
+        return devices
+
+    def _decode(self, value):
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def flush(self):
+        redis_client = self._get_redis()
+        if redis_client is None:
+            return 0
+        flushed = 0
+        retries = []
+        with self._flush_lock:
+            while True:
+                # Popped before reading, an update racing with the flush marks the device dirty again.
+                device_pks = [self._decode(pk) for pk in redis_client.spop(self.DIRTY_KEY, self.flush_batch_size) or []]
+                if not device_pks:
+                    break
+                device_pks = [self._parse_pk(device_pk) for device_pk in device_pks]
+                try:
+                    conflicts = _update_device_other_data(self.get_many(device_pks))
+                except Exception as ex:
+                    self.failed_flushes += 1
+                    logger.exception("Device state flush failed: %s", ex)
+                    redis_client.sadd(self.DIRTY_KEY, *[str(device_pk) for device_pk in device_pks])
+                    break
+                retries.extend(conflicts)
+                flushed += len(device_pks) - len(conflicts)
+            if retries:
+                # Marked dirty after the loop so the next flush, not this one, retries them.
+                redis_client.sadd(self.DIRTY_KEY, *[str(device_pk) for device_pk in retries])
+        self.devices_flushed += flushed
+        return flushed
+
+    def _parse_pk(self, device_pk):
+        try:
+            return uuid.UUID(device_pk)
+        except ValueError:
+            return device_pk
+
+    def _ensure_flusher(self):
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        self._stopped.clear()
+        self._flusher = threading.Thread(
+            target=self._run_flusher,
+            name="device-state-flusher",
+            daemon=True,
+        )
+        self._flusher.start()
+
+    def _run_flusher(self):
+        while not self._stopped.wait(self.flush_interval_seconds):
+            try:
+                self.flush()
+            except Exception as ex:
+                logger.exception("Device state flush failed: %s", ex)
+            close_old_connections()
+
+    def close(self):
+        self._stopped.set()
+        try:
+            self.flush()
+        except Exception as ex:
+            logger.exception("Device state flush failed: %s", ex)
+
+    def stats(self):
+        return {
+            "updates_recorded": self.updates_recorded,
+            "devices_flushed": self.devices_flushed,
+            "failed_flushes": self.failed_flushes,
+        }
+
+
+class RawDataBucketCompactor:
+    """
+        Compacts the RawData documents of every closed window into one
+        RawDataBucket per device and data type, when RAW_DATA_STORAGE_LAYOUT is
+        "buckets".
+
+        The windows of flushed rows are noted, and a background thread compacts
+        them `grace_seconds` after they closed, so rows still buffered by other
+        processes are included. A cache lock, held while compacting, makes one
+        process compact a window at a time; a window locked by another process
+        is kept and tried again on the next check, so rows this process noted
+        for it are compacted too. Windows never compacted are read from the
+        documents.
+    """
+
+    LOCK_KEY_PREFIX = 'raw_data_bucket:compact:v1:'
+
+    def __init__(self, bucket_seconds=60 * 60, grace_seconds=5 * 60, check_interval_seconds=60.0):
+        self.bucket_seconds = max(1, int(bucket_seconds))
+        self.grace_seconds = max(0, int(grace_seconds))
+        self.check_interval_seconds = float(check_interval_seconds)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._instance_id = uuid.uuid4().hex
+        self._worker = None
+        self._stopped = threading.Event()
+        self.windows_compacted = 0
+        self.failed_compactions = 0
+
+    @property
+    def enabled(self):
+        return get_raw_data_layout() == RAW_DATA_LAYOUT_BUCKETS
+
+    def note(self, rows):
+        if not rows or not self.enabled:
+            return
+        with self._lock:
+            for raw_data in rows:
+                self._pending.add((
+                    raw_data.device_id,
+                    raw_data.data_type,
+                    get_bucket_start(raw_data.data_arrival_time, self.bucket_seconds),
+                ))
+        self._ensure_worker()
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def compact_due(self, now=None):
+        """Compact the noted windows which closed `grace_seconds` ago, returns the count."""
+        if now is None:
+            now = timezone.now()
+        closed_before = now - timedelta(seconds=self.bucket_seconds + self.grace_seconds)
+        with self._lock:
+            due = sorted((key for key in self._pending if key[2] <= closed_before), key=lambda key: key[2])
+            self._pending.difference_update(due)
+
+        compacted = 0
+        for device_id, data_type, bucket_start in due:
+            lock_key = f"{self.LOCK_KEY_PREFIX}{device_id}:{data_type}:{bucket_start.isoformat()}"
+            if not self._acquire(lock_key):
+                with self._lock:
+                    self._pending.add((device_id, data_type, bucket_start))
+                continue
+            try:
+                compact_raw_data_window(device_id, data_type, bucket_start, bucket_seconds=self.bucket_seconds)
+            except Exception as ex:
+                self.failed_compactions += 1
+                logger.exception("Compacting RawData of %s/%s at %s failed: %s", device_id, data_type, bucket_start, ex)
+                with self._lock:
+                    self._pending.add((device_id, data_type, bucket_start))
+                continue
+            finally:
+                self._release(lock_key)
+            compacted += 1
+        self.windows_compacted += compacted
+        return compacted
+
+    def _acquire(self, lock_key):
+        # The timeout only frees the windows of a process that died while compacting.
+        try:
+            return cache.add(lock_key, self._instance_id, self.bucket_seconds + self.grace_seconds)
+        except Exception as ex:
+            logger.warning("RawData compaction lock failed for %s: %s", lock_key, ex)
+            return True
+
+    def _release(self, lock_key):
+        try:
+            if cache.get(lock_key) == self._instance_id:
+                cache.delete(lock_key)
+        except Exception as ex:
+            logger.warning("RawData compaction lock release failed for %s: %s", lock_key, ex)
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        self._stopped.clear()
+        self._worker = threading.Thread(
+            target=self._run_worker,
+            name="raw-data-bucket-compactor",
+            daemon=True,
+        )
+        self._worker.start()
+
+    def _run_worker(self):
+        while not self._stopped.wait(self.check_interval_seconds):
+            try:
+                self.compact_due()
+            except Exception as ex:
+                logger.exception("RawData bucket compaction failed: %s", ex)
+            close_old_connections()
+
+    def close(self):
+        self._stopped.set()
+
+    def stats(self):
+        return {
+            "pending_windows": self.pending_count(),
+            "windows_compacted": self.windows_compacted,
+            "failed_compactions": self.failed_compactions,
+        }
+
+
+raw_data_bucket_compactor = RawDataBucketCompactor(
+    bucket_seconds=getattr(settings, 'RAW_DATA_BUCKET_SECONDS', 60 * 60),
+    grace_seconds=getattr(settings, 'RAW_DATA_BUCKET_GRACE_SECONDS', 5 * 60),
+)
+atexit.register(raw_data_bucket_compactor.close)
+
+
+device_state_writer = DeviceStateWriter(
+    flush_interval_seconds=getattr(settings, 'DEVICE_STATE_FLUSH_SECONDS', 30),
+    ttl_seconds=getattr(settings, 'DEVICE_STATE_TTL_SECONDS', 24 * 60 * 60),
+)
+atexit.register(device_state_writer.close)
+
+
+raw_data_writer = RawDataWriter(
+    max_rows=getattr(settings, 'RAW_DATA_BUFFER_SIZE', 200),
+    max_delay_seconds=getattr(settings, 'RAW_DATA_BUFFER_MAX_DELAY_SECONDS', 2),
+    max_pending_rows=getattr(settings, 'RAW_DATA_BUFFER_MAX_PENDING_ROWS', 20000),
+    max_attempts=getattr(settings, 'RAW_DATA_BUFFER_MAX_ATTEMPTS', 5),
+)
+atexit.register(raw_data_writer.close)
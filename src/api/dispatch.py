@@ -0,0 +1,267 @@
+import json
+import logging
+import threading
+import time
+
+from api.ingestion import LatencyHistogram
+from device.models import Command as CommandsModal
+from device.models import Device
+from device.models.device import COMMAND_NOTIFY_CHANNEL, pending_command_event
+from device.models.ota import DeviceConfig
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+logger = logging.getLogger('django')
+
+MQTT_ENABLED_DEVICE_COMMANDS = {
+    'cmd-req': "/{dev_mqtt_user}/devices/{device_alias}/cmd-req",
+    'update-trigger-device': "/{dev_mqtt_user}/devices/{device_alias}/update-trigger",
+    'update-trigger-group': "/{dev_mqtt_user}/groups/{device_group}/update-trigger",
+}
+
+COMMAND_RESPONSE_CACHE_TTL = 60 * 60
+COMMAND_INDEX_CACHE_KEY_PREFIX = 'command_index:v1:'
+
+def get_latest_device_configs(device_ids):
+    """Return {device_id: data} of the latest config of each device, in one query."""
+    configs = {}
+    queryset = DeviceConfig.objects.filter(device__in=list(device_ids)).order_by('-created_at')
+    for cfg in queryset.only('id', 'device', 'data', 'created_at'):
+        configs.setdefault(cfg.device_id, cfg.data if cfg.data is not None else {})
+    return configs
+
+
+def get_command_short_id(command_id):
+    return command_id.hex[-10:]
+
+
+def _get_command_index_key(device_id, short_id):
+    return f"{COMMAND_INDEX_CACHE_KEY_PREFIX}{device_id}:{short_id}"
+
+
+def index_sent_commands(commands):
+    """Map the short id devices answer with to the command id, per device."""
+    cache.set_many(
+        {
+            _get_command_index_key(command.device_id, get_command_short_id(command.id)): command.id
+            for command in commands
+        },
+        COMMAND_RESPONSE_CACHE_TTL,
+    )
+
+
+def get_indexed_command_id(device_id, short_id):
+    return cache.get(_get_command_index_key(device_id, short_id))
+
+
+def build_command_message(command, device, cfg_data):
+    dev_mqtt_user = cfg_data.get('mqtt_user', 'Devtest')
+    dev_mqtt_user = dev_mqtt_user if dev_mqtt_user is not None else 'Devtest'
+    dev_mqtt_group = cfg_data.get('group_id', 'Devtest')
+    dev_mqtt_group = dev_mqtt_group if dev_mqtt_group is not None else 'Devtest'
+
+    default_command_topic = MQTT_ENABLED_DEVICE_COMMANDS.get(command.command, '')
+    if default_command_topic is None or default_command_topic == '':
+        default_command_topic = MQTT_ENABLED_DEVICE_COMMANDS.get('cmd-req', '')
+    command_topic = default_command_topic.format(
+        dev_mqtt_user=dev_mqtt_user,
+        device_alias=device.alias,
+        device_group=dev_mqtt_group
+    )
+    payload = json.dumps({
+        "command": f"{command.command} {command.param}".strip(),
+        "device": device.alias,
+        "command_id": get_command_short_id(command.id),
+    })
+    return command_topic, payload
+
+
+class CommandDispatcher:
+    """
+        Publishes pending commands to their devices over MQTT.
+
+        The dispatcher sleeps until a command is created (a post_save signal in
+        this process, or a Redis pub/sub notification from the web processes)
+        and polls every `poll_interval_seconds` as a fallback. At most
+        `batch_size` commands are published per round; devices and their
+        latest configs are loaded with one query each.
+
+        Commands are published with QoS 1. Each publish is tracked until the
+        broker acknowledges it, and the time from `command_in_time` to the
+        acknowledgement is recorded in a latency histogram. Publishes not
+        acknowledged within `ack_timeout_seconds` are counted and logged.
+    """
+
+    def __init__(self, client, poll_interval_seconds=None, batch_size=None, ack_timeout_seconds=None):
+        self.client = client
+        if poll_interval_seconds is None:
+            poll_interval_seconds = getattr(settings, 'COMMAND_DISPATCH_POLL_SECONDS', 10)
+        if batch_size is None:
+            batch_size = getattr(settings, 'COMMAND_DISPATCH_BATCH_SIZE', 100)
+        if ack_timeout_seconds is None:
+            ack_timeout_seconds = getattr(settings, 'COMMAND_ACK_TIMEOUT_SECONDS', 30)
+        self.poll_interval_seconds = float(poll_interval_seconds)
+        self.batch_size = max(1, int(batch_size))
+        self.ack_timeout_seconds = float(ack_timeout_seconds)
+        self.latency = LatencyHistogram()
+        self._inflight = {}
+        self._early_acks = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._listener = None
+        self.published = 0
+        self.acknowledged = 0
+        self.unacknowledged = 0
+        self.publish_failures = 0
+        self.notifications = 0
+
+    def start(self):
+        if self._listener is None:
+            self._listener = threading.Thread(
+                target=self._listen_for_notifications,
+                name="command-notifications",
+                daemon=True,
+            )
+            self._listener.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        pending_command_event.set()
+
+    def _listen_for_notifications(self):
+        try:
+            from django_redis import get_redis_connection
+        except ImportError:
+            return
+
+        while not self._stopped.is_set():
+            pubsub = None
+            try:
+                pubsub = get_redis_connection('default').pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(COMMAND_NOTIFY_CHANNEL)
+                while not self._stopped.is_set():
+                    if pubsub.get_message(timeout=1.0) is not None:
+                        self.notifications += 1
+                        pending_command_event.set()
+            except NotImplementedError:
+                logger.info("Cache is not Redis, pending commands are polled every %ss", self.poll_interval_seconds)
+                return
+            except Exception as ex:
+                logger.warning("Command notification listener failed, retrying: %s", ex)
+                self._stopped.wait(5)
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+
+    def wait_for_commands(self, timeout=None):
+        """Block until a command is announced or the poll interval passed."""
+        notified = pending_command_event.wait(self.poll_interval_seconds if timeout is None else timeout)
+        pending_command_event.clear()
+        return notified
+
+    def on_publish(self, client, userdata, mid):
+        # Called on the paho network thread once the broker acknowledged the publish.
+        with self._lock:
+            inflight = self._inflight.pop(mid, None)
+            if inflight is None:
+                # Either acknowledged before `_track` ran, or not a command publish.
+                self._early_acks[mid] = time.monotonic()
+                return
+        self._record_ack(*inflight)
+
+    def _record_ack(self, command_id, command_in_time, published_at):
+        self.acknowledged += 1
+        if command_in_time is not None:
+            self.latency.observe((timezone.now() - command_in_time).total_seconds())
+        logger.debug("Command %s acknowledged by the broker", command_id)
+
+    def _track(self, mid, command):
+        inflight = (command.id, command.command_in_time, time.monotonic())
+        with self._lock:
+            if self._early_acks.pop(mid, None) is None:
+                self._inflight[mid] = inflight
+                return
+        self._record_ack(*inflight)
+
+    def expire_unacknowledged(self):
+        deadline = time.monotonic() - self.ack_timeout_seconds
+        with self._lock:
+            expired = [mid for mid, (_, _, published_at) in self._inflight.items() if published_at < deadline]
+            expired_commands = [self._inflight.pop(mid)[0] for mid in expired]
+            for mid in [mid for mid, acked_at in self._early_acks.items() if acked_at < deadline]:
+                del self._early_acks[mid]
+        for command_id in expired_commands:
+            self.unacknowledged += 1
+            logger.warning("Command %s was not acknowledged by the broker in %ss", command_id, self.ack_timeout_seconds)
+
+    def dispatch_pending(self):
+        """Publish one batch of pending commands, returns the number published."""
+        # Oldest first, newer commands must not starve the ones waiting longest.
+        commands = list(
+            CommandsModal.objects.filter(status__iexact='P').order_by('command_in_time')[:self.batch_size]
+        )
+        if not commands:
+            return 0
+
+        device_ids = {command.device_id for command in commands}
+        devices = Device.objects.in_bulk(list(device_ids))
+        configs = get_latest_device_configs(device_ids)
+        # Indexed before publishing, responses can arrive before the batch is done.
+        index_sent_commands(commands)
+
+        sent_commands = []
+        orphaned_commands = []
+        for command in commands:
+            device = devices.get(command.device_id)
+            if device is None:
+                logger.warning("Device %s of command %s not found, marking it failed", command.device_id, command.id)
+                orphaned_commands.append(command)
+                continue
+            logger.info("Found command waiting to be processed: %s for device: %s", command.command, device.ip_address)
+            if command.device_id not in configs:
+                logger.warning("Config not found for device %s", device.ip_address)
+            command_topic, payload = build_command_message(command, device, configs.get(command.device_id, {}))
+
+            logger.info("Publishing MQTT %s: %s %s", command_topic, command.command, command.param)
+            message_info = self.client.publish(command_topic, payload, 1)
+            if message_info.rc != 0:
+                # paho keeps QoS 1 messages queued and sends them once reconnected.
+                self.publish_failures += 1
+                logger.warning("Publishing command %s returned rc %s", command.id, message_info.rc)
+            self.published += 1
+            self._track(message_info.mid, command)
+            sent_commands.append(command)
+
+        changed = 0
+        if sent_commands:
+            changed += CommandsModal.objects.filter(pk__in=[command.id for command in sent_commands]).update(
+                status='S',  # Sent
+                command_read_time=timezone.now(),
+            )
+        if orphaned_commands:
+            changed += CommandsModal.objects.filter(pk__in=[command.id for command in orphaned_commands]).update(
+                status='F',  # Failed, the device is gone
+            )
+        if changed and len(commands) == self.batch_size:
+            # There may be more pending commands, run the next round right away.
+            # Only when this round took commands out of 'P', it cannot spin on the same batch.
+            pending_command_event.set()
+        return len(sent_commands)
+
+    def stats(self):
+        with self._lock:
+            inflight = len(self._inflight)
+        return {
+            "published": self.published,
+            "acknowledged": self.acknowledged,
+            "unacknowledged": self.unacknowledged,
+            "inflight": inflight,
+            "publish_failures": self.publish_failures,
+            "notifications": self.notifications,
+            "command_to_ack_latency": self.latency.snapshot(),
+        }
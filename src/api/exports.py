@@ -0,0 +1,169 @@
+import csv
+import io
+import zlib
+from datetime import datetime, timezone as dt_timezone
+
+import simplejson as json
+from device.models import AssetStatus, RawData
+from django.conf import settings
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+EXPORT_FORMAT_CSV = "csv"
+EXPORT_FORMAT_NDJSON = "ndjson"
+
+EXPORT_FIELDS = ["data_arrival_time", "channel", "data_type", "device", "data", "id"]
+EXPORT_ITERATOR_CHUNK_SIZE = 2000
+# Rows are written to the response in blocks of this many bytes.
+EXPORT_BUFFER_BYTES = 64 * 1024
+
+RAW_DATA_TYPES = ("raw", "raw_data")
+
+
+def parse_export_time(value):
+    """
+        Parse a `resumeFrom` value, either TIME_FORMAT_STRING or ISO 8601.
+        Naive values are taken as UTC.
+    """
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        parsed_value = value
+    else:
+        value = str(value).strip()
+        try:
+            parsed_value = datetime.strptime(value, settings.TIME_FORMAT_STRING)
+        except ValueError:
+            parsed_value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if timezone.is_naive(parsed_value):
+        parsed_value = timezone.make_aware(parsed_value, dt_timezone.utc)
+    return parsed_value
+
+
+def get_export_time_field(data_type):
+    """Return the field the rows of `data_type` are exported and resumed in the order of."""
+    return "data_arrival_time" if data_type in RAW_DATA_TYPES else "created_at"
+
+
+def iter_export_records(devices, data_type, start_time, end_time, resume_from=None, resume_after_id=None):
+    """
+        Yield (data_arrival_time, channel, data_type, device, data, id) tuples
+        in ascending (time, id) order, reading the rows through a server side
+        cursor and only loading the exported columns.
+
+        An interrupted download is continued after the last row it received:
+        `resume_after_id` skips every row up to that row's (time, id), and
+        `resume_from`, used when the id is not given or no longer stored,
+        skips every row at or before that time.
+    """
+    ip_addresses = {device.pk: device.ip_address for device in devices}
+    device_ids = list(ip_addresses.keys())
+    time_field = get_export_time_field(data_type)
+
+    if data_type in RAW_DATA_TYPES:
+        model = RawData
+        queryset = RawData.objects.filter(device__in=device_ids)
+        queryset = queryset.only("id", "device", "data_arrival_time", "channel", "data_type", "data")
+    else:
+        model = AssetStatus
+        queryset = AssetStatus.objects.filter(device__in=device_ids, name=data_type)
+        queryset = queryset.only("id", "device", "created_at", "name", "status")
+
+    if start_time is not None:
+        queryset = queryset.filter(**{f"{time_field}__gte": start_time})
+    if end_time is not None:
+        queryset = queryset.filter(**{f"{time_field}__lt": end_time})
+
+    resume_time = None
+    if resume_after_id is not None:
+        # Exported times are rounded to the second, the exact time is read from the row.
+        resume_time = model.objects.filter(pk=resume_after_id).values_list(time_field, flat=True).first()
+    if resume_time is not None:
+        queryset = queryset.filter(
+            Q(**{f"{time_field}__gt": resume_time}) | Q(**{time_field: resume_time, "id__gt": resume_after_id})
+        )
+    elif resume_from is not None:
+        queryset = queryset.filter(**{f"{time_field}__gt": resume_from})
+    queryset = queryset.order_by(time_field, "id")
+
+    for row in queryset.iterator(chunk_size=EXPORT_ITERATOR_CHUNK_SIZE):
+        row_time = getattr(row, time_field)
+        if row_time is not None:
+            row_time = row_time.strftime(settings.TIME_FORMAT_STRING)
+        if data_type in RAW_DATA_TYPES:
+            yield row_time, row.channel, row.data_type, ip_addresses.get(row.device_id), row.data, str(row.id)
+        else:
+            yield row_time, "calculated", row.name, ip_addresses.get(row.device_id), row.status, str(row.id)
+
+
+def iter_csv_lines(records):
+    line_buffer = io.StringIO()
+    writer = csv.writer(line_buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for data_arrival_time, channel, data_type, ip_address, data, row_id in records:
+        writer.writerow([data_arrival_time, channel, data_type, ip_address, json.dumps(data), row_id])
+        if line_buffer.tell() >= EXPORT_BUFFER_BYTES:
+            yield line_buffer.getvalue()
+            line_buffer.seek(0)
+            line_buffer.truncate()
+    yield line_buffer.getvalue()
+
+
+def iter_ndjson_lines(records):
+    lines = []
+    size = 0
+    for record in records:
+        line = json.dumps(dict(zip(EXPORT_FIELDS, record))) + "\n"
+        lines.append(line)
+        size += len(line)
+        if size >= EXPORT_BUFFER_BYTES:
+            yield "".join(lines)
+            lines = []
+            size = 0
+    yield "".join(lines)
+
+
+def iter_gzip(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk.encode("utf-8"))
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def stream_data_export(devices, data_type, start_time, end_time, export_format=EXPORT_FORMAT_CSV,
+                       compress=False, resume_from=None, resume_after_id=None, filename="export"):
+    """
+        Build a StreamingHttpResponse exporting raw data or statuses of the
+        devices as CSV or newline delimited JSON, optionally gzip compressed.
+    """
+    records = iter_export_records(
+        devices,
+        data_type,
+        start_time,
+        end_time,
+        resume_from=resume_from,
+        resume_after_id=resume_after_id,
+    )
+    if export_format == EXPORT_FORMAT_NDJSON:
+        chunks = iter_ndjson_lines(records)
+        content_type = "application/x-ndjson"
+        extension = "ndjson"
+    else:
+        chunks = iter_csv_lines(records)
+        content_type = "text/csv"
+        extension = "csv"
+
+    if compress:
+        chunks = iter_gzip(chunks)
+        content_type = "application/gzip"
+        extension = f"{extension}.gz"
+
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    response["Content-Disposition"] = f'attachment; filename="{filename}.{extension}"'
+    # Rows are ordered by (time, id), the id of the last exported row is the resume point.
+    response["X-Export-Resume-Field"] = get_export_time_field(data_type)
+    response["X-Export-Resume-Id-Field"] = "id"
+    return response
@@ -0,0 +1,201 @@
+import bisect
+import logging
+import queue
+import threading
+import time
+import zlib
+
+from django.db import close_old_connections
+
+logger = logging.getLogger('django')
+
+_STOP = object()
+
+# Upper bounds, in milliseconds, of the latency histogram buckets.
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+
+class LatencyHistogram:
+    """Cumulative latency histogram, exported with the health checks."""
+
+    def __init__(self, buckets_ms=LATENCY_BUCKETS_MS):
+        self.buckets_ms = tuple(buckets_ms)
+        self.counts = [0] * (len(self.buckets_ms) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        value_ms = max(0.0, seconds * 1000)
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets_ms, value_ms)] += 1
+            self.count += 1
+            self.total_ms += value_ms
+
+    def snapshot(self):
+        with self._lock:
+            buckets = {}
+            cumulative = 0
+            for bound, count in zip(self.buckets_ms, self.counts):
+                cumulative += count
+                buckets[f"le_{bound}"] = cumulative
+            buckets["le_inf"] = self.count
+            return {
+                "buckets_ms": buckets,
+                "count": self.count,
+                "sum_ms": round(self.total_ms, 3),
+            }
+
+
+class PartitionedWorkerPool:
+    """
+        Bounded, device-partitioned worker pool for message ingestion.
+
+        Every partition key is pinned to a single worker, so messages of the
+        same device are processed in arrival order while different devices are
+        handled concurrently. Each worker owns a bounded queue; when it is full
+        `submit` blocks the caller, pushing back on the producer (e.g. the paho
+        network thread) instead of growing memory without limit.
+    """
+
+    def __init__(self, handler, workers=4, queue_size=1000, name="ingest"):
+        self.handler = handler
+        self.name = name
+        self.workers = max(1, int(workers))
+        self.queue_size = max(1, int(queue_size))
+        self.queues = [queue.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+        self.threads = []
+        self._lock = threading.Lock()
+        self._accepting = False
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.backpressure_waits = 0
+        self.backpressure_seconds = 0.0
+        self.max_depth = 0
+        self.last_error = None
+
+    def start(self):
+        if self.threads:
+            return self
+        self._accepting = True
+        for index, worker_queue in enumerate(self.queues):
+            thread = threading.Thread(
+                target=self._run,
+                args=(worker_queue,),
+                name=f"{self.name}-worker-{index}",
+                daemon=True,
+            )
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def partition_for(self, key):
+        return zlib.crc32(str(key).encode("utf-8")) % self.workers
+
+    def submit(self, key, *args, timeout=None):
+        """
+            Queue `handler(*args)` on the worker owning `key`.
+
+            Blocks while the worker queue is full. Returns False when the pool
+            is shutting down or `timeout` expired before a slot was freed.
+        """
+        if not self._accepting:
+            with self._lock:
+                self.rejected += 1
+            return False
+
+        worker_queue = self.queues[self.partition_for(key)]
+        try:
+            worker_queue.put_nowait(args)
+        except queue.Full:
+            wait_started = time.monotonic()
+            try:
+                worker_queue.put(args, timeout=timeout)
+            except queue.Full:
+                with self._lock:
+                    self.rejected += 1
+                    self.backpressure_waits += 1
+                    self.backpressure_seconds += time.monotonic() - wait_started
+                return False
+            with self._lock:
+                self.backpressure_waits += 1
+                self.backpressure_seconds += time.monotonic() - wait_started
+
+        depth = worker_queue.qsize()
+        with self._lock:
+            self.submitted += 1
+            if depth > self.max_depth:
+                self.max_depth = depth
+        return True
+
+    def _run(self, worker_queue):
+        while True:
+            item = worker_queue.get()
+            try:
+                if item is _STOP:
+                    return
+                try:
+                    self.handler(*item)
+                except Exception as ex:
+                    logger.exception(f'Exception ocurred while processing queued message: {ex}')
+                    with self._lock:
+                        self.failed += 1
+                        self.last_error = str(ex)
+                else:
+                    with self._lock:
+                        self.processed += 1
+            finally:
+                worker_queue.task_done()
+                if item is not _STOP:
+                    close_old_connections()
+
+    def shutdown(self, drain=True, timeout=None):
+        """
+            Stop accepting new work and stop the workers.
+
+            With `drain` the already queued messages are processed first,
+            otherwise they are discarded. Returns the number of messages left
+            unprocessed when `timeout` expires.
+        """
+        self._accepting = False
+        if not drain:
+            for worker_queue in self.queues:
+                while True:
+                    try:
+                        worker_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    worker_queue.task_done()
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for worker_queue in self.queues:
+            worker_queue.put(_STOP)
+        for thread in self.threads:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            thread.join(remaining)
+
+        pending = sum(worker_queue.qsize() for worker_queue in self.queues)
+        # The stop markers of workers that did not finish are still queued.
+        pending -= sum(1 for thread in self.threads if thread.is_alive())
+        self.threads = [thread for thread in self.threads if thread.is_alive()]
+        if pending:
+            logger.warning("%s pool stopped with %s unprocessed messages", self.name, pending)
+        return max(0, pending)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "queue_depth": [worker_queue.qsize() for worker_queue in self.queues],
+                "max_depth": self.max_depth,
+                "submitted": self.submitted,
+                "processed": self.processed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "backpressure_waits": self.backpressure_waits,
+                "backpressure_seconds": round(self.backpressure_seconds, 3),
+                "last_error": self.last_error,
+            }
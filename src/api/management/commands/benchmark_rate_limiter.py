@@ -0,0 +1,104 @@
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from api.throttling import CacheListRateLimiter, CompositeDataIngestionThrottle, MovingWindowRateLimiter
+from django.core.management.base import BaseCommand
+
+LIMITERS = {
+    'cache-list': CacheListRateLimiter,
+    'moving-window': MovingWindowRateLimiter,
+}
+
+
+class Command(BaseCommand):
+
+    """
+        Benchmark the data ingestion rate limiters under concurrent load.
+
+        Every limiter serves the same burst of requests through
+        CompositeDataIngestionThrottle from several threads, and the command
+        reports throughput, latency and how many requests were admitted over
+        the limit.
+    """
+
+    help = 'Benchmarks the data ingestion rate limiters under concurrent load.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16, help='Concurrent request threads')
+        parser.add_argument('--requests', type=int, default=5000, help='Total requests per limiter')
+        parser.add_argument('--keys', type=int, default=50, help='Distinct users/devices')
+        parser.add_argument('--max-requests', type=int, default=20, help='Requests allowed per key in the window')
+        parser.add_argument('--window', type=int, default=60, help='Window size in seconds')
+        parser.add_argument(
+            '--limiter',
+            action='append',
+            choices=sorted(LIMITERS.keys()),
+            help='Limiter to benchmark, repeatable (default: all)',
+        )
+
+    def handle(self, *args, **options):
+        for name in options['limiter'] or sorted(LIMITERS.keys()):
+            result = self.run_benchmark(LIMITERS[name], options)
+            self.stdout.write(
+                f"{name:>14}: {result['throughput']:.0f} req/s, "
+                f"p50 {result['p50_ms']:.3f} ms, p99 {result['p99_ms']:.3f} ms, "
+                f"allowed {result['allowed']}/{options['requests']} "
+                f"(limit {result['expected_allowed']}), over limit {result['over_limit']}"
+            )
+
+    def run_benchmark(self, limiter_class, options):
+        run_id = uuid.uuid4().hex[:8]
+        keys = max(1, options['keys'])
+        max_requests = options['max_requests']
+
+        throttle = CompositeDataIngestionThrottle()
+        throttle.user_throttle.limiter = limiter_class(options['window'], max_requests)
+        throttle.device_throttle.limiter = limiter_class(options['window'], max_requests)
+
+        requests = [
+            SimpleNamespace(
+                user=SimpleNamespace(is_authenticated=True, id=f"bench-{run_id}-{index % keys}"),
+                device=SimpleNamespace(id=f"bench-{run_id}-{index % keys}"),
+                META={},
+            )
+            for index in range(options['requests'])
+        ]
+        allowed_per_key = Counter()
+        latencies = []
+        lock = threading.Lock()
+        start_barrier = threading.Barrier(max(1, options['threads']))
+
+        def worker(worker_requests):
+            start_barrier.wait()
+            worker_latencies = []
+            worker_allowed = Counter()
+            for request in worker_requests:
+                started = time.perf_counter()
+                allowed = throttle.allow_request(request)
+                worker_latencies.append(time.perf_counter() - started)
+                if allowed:
+                    worker_allowed[request.user.id] += 1
+            with lock:
+                latencies.extend(worker_latencies)
+                allowed_per_key.update(worker_allowed)
+
+        threads = max(1, options['threads'])
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(worker, [requests[index::threads] for index in range(threads)]))
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        used_keys = min(keys, len(requests))
+        return {
+            'throughput': len(requests) / elapsed if elapsed > 0 else 0,
+            'p50_ms': latencies[len(latencies) // 2] * 1000 if latencies else 0,
+            'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000 if latencies else 0,
+            'allowed': sum(allowed_per_key.values()),
+            'expected_allowed': min(len(requests), used_keys * max_requests),
+            'over_limit': sum(max(0, count - max_requests) for count in allowed_per_key.values()),
+        }
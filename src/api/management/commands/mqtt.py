@@ -1,14 +1,19 @@
-import sys
 from django.utils import timezone
 import json
 import logging
-import time
 import os
 import hashlib
+import signal
+import uuid
 
 from device.models.ota import DeviceConfig
 import paho.mqtt.client as mqtt
+from api.buffers import device_state_writer, raw_data_bucket_compactor, raw_data_writer
+from api.dispatch import (COMMAND_RESPONSE_CACHE_TTL, CommandDispatcher,
+                          get_indexed_command_id)
+from api.ingestion import PartitionedWorkerPool
 from api.utils import process_raw_data
+from device.device_cache import device_cache
 from device.models import Command as CommandsModal
 from device.models import Device
 from django.conf import settings
@@ -17,6 +22,11 @@ from django.core.management.base import BaseCommand
 
 logger = logging.getLogger('django')
 
+if getattr(settings, 'CLICKHOUSE_ENABLED', False):
+    from device.clickhouse_models import clickhouse_buffer
+else:
+    clickhouse_buffer = None
+
 SOURCE_TYPE_MONA = "mona"
 SOURCE_TYPE_BEKEN = "beken"
 SOURCE_TYPE_ESPHOME = "esphome"
@@ -43,14 +53,6 @@ CLIENT_COUNT_TOPIC = "$SYS/broker/clients/connected"
 # Home Assistant MQTT Discovery
 HOMEASSISTANT_DISCOVERY_PREFIX = "homeassistant"
 
-MQTT_ENABLED_DEVICE_COMMANDS = {
-    'cmd-req': "/{dev_mqtt_user}/devices/{device_alias}/cmd-req",
-    'update-trigger-device': "/{dev_mqtt_user}/devices/{device_alias}/update-trigger",
-    'update-trigger-group': "/{dev_mqtt_user}/groups/{device_group}/update-trigger",
-}
-
-COMMAND_RESPONSE_CACHE_TTL = 60 * 60
-
 
 class Command(BaseCommand):
 
@@ -60,6 +62,9 @@ class Command(BaseCommand):
 
     help = 'Starts the mqtt service.'
 
+    ingest_pool = None
+    command_dispatcher = None
+
     def _write_health(self, state, **extra):
         os.makedirs(settings.MQTT_HEALTH_DIR, exist_ok=True)
         payload = {
@@ -67,6 +72,16 @@ class Command(BaseCommand):
             "state": state,
             "updated_at": timezone.now().isoformat(),
         }
+        if self.ingest_pool is not None:
+            payload["ingest"] = self.ingest_pool.stats()
+            payload["raw_data_writer"] = raw_data_writer.stats()
+            payload["device_state_writer"] = device_state_writer.stats()
+            payload["raw_data_buckets"] = raw_data_bucket_compactor.stats()
+            if clickhouse_buffer is not None:
+                payload["clickhouse_buffer"] = clickhouse_buffer.stats()
+        if self.command_dispatcher is not None:
+            payload["command_dispatch"] = self.command_dispatcher.stats()
+        payload["device_cache"] = device_cache.stats()
         payload.update(extra)
         with open(settings.MQTT_HEALTH_FILE, "w", encoding="utf-8") as handle:
             json.dump(payload, handle)
@@ -79,6 +94,8 @@ class Command(BaseCommand):
         client.on_message = self.on_message
         # client.on_log = self.on_log
         client.on_subscribe = self.on_subscribe
+        self.command_dispatcher = CommandDispatcher(client)
+        client.on_publish = self.command_dispatcher.on_publish
         
         client.username_pw_set(settings.MQTT_USER, settings.MQTT_PASSWORD)
         
@@ -112,10 +129,44 @@ class Command(BaseCommand):
             self._write_health("failed", error=str(ex))
             raise
 
+        self.ingest_pool = PartitionedWorkerPool(
+            self.process_message,
+            workers=settings.MQTT_INGEST_WORKERS,
+            queue_size=settings.MQTT_INGEST_QUEUE_SIZE,
+            name="mqtt-ingest",
+        ).start()
+        signal.signal(signal.SIGTERM, self.on_shutdown_signal)
+
         client.loop_start()
         self.loop_running = True
         self._write_health("running")
-        self.check_and_send_commands(client)
+        try:
+            self.check_and_send_commands(client)
+        finally:
+            self.shutdown(client)
+
+    def on_shutdown_signal(self, signum, frame):
+        logger.info("MQTT listener received signal %s, shutting down", signum)
+        self.loop_running = False
+        # Wake the dispatcher up so the command loop notices right away.
+        self.command_dispatcher.stop()
+
+    def shutdown(self, client):
+        """Stop reading from the broker, then drain the messages already queued."""
+        self.loop_running = False
+        self.command_dispatcher.stop()
+        self._write_health("stopping")
+        client.loop_stop()
+        client.disconnect()
+        unprocessed = self.ingest_pool.shutdown(
+            drain=True,
+            timeout=settings.MQTT_INGEST_SHUTDOWN_TIMEOUT_SECONDS,
+        )
+        raw_data_writer.close()
+        device_state_writer.close()
+        if clickhouse_buffer is not None:
+            clickhouse_buffer.close()
+        self._write_health("stopped", unprocessed=unprocessed)
 
     def on_connect(self, mqtt_client, user_data, flags, rc):
         if rc == 0:
@@ -133,16 +184,22 @@ class Command(BaseCommand):
         mqtt_client.loop_stop()
 
     def on_message(self, mqtt_client, user_data, msg):
-        self._write_health("running")
         logger.info(f'Received message on topic: {msg.topic} with payload: {msg.payload}')
-        try:
+        if self.ingest_pool is None:
             self.process_message(msg, mqtt_client)
-        except Exception as ex:
-            logger.exception(f'Exception ocurred while processing MQTT message: {ex}')
-            self._write_health("failed", error=str(ex))
-            mqtt_client.loop_stop()
-            self.loop_running = False
-            sys.exit(500)
+            return
+        # Runs on the paho network thread: only hand the message over to the
+        # worker owning its device. A full queue blocks here, which stops us
+        # reading from the socket and lets the broker buffer instead.
+        if not self.ingest_pool.submit(self.get_message_partition_key(msg.topic), msg, mqtt_client):
+            logger.warning("MQTT ingestion is shutting down, dropped message on topic: %s", msg.topic)
+
+    def get_message_partition_key(self, topic):
+        topic_data_list = topic.split("/")
+        if len(topic_data_list) > 4:
+            # /{group}/devices/{device}/... keeps one device on one worker
+            return f"{topic_data_list[1]}/{topic_data_list[3]}"
+        return topic
 
     def on_log(self, mqtt_client, obj, level, string):
         logger.info(f"{level}: {string}")
@@ -358,11 +415,16 @@ class Command(BaseCommand):
         cfg.save()
 
     def find_device(self, group_name, device_name, topic_type):
+        logger.info(f"Finding device for group: {group_name}, device: {device_name}, topic: {topic_type}")
+        return device_cache.get(
+            ('group_alias', group_name, device_name),
+            lambda: self.load_device(group_name, device_name),
+        )
 
+    def load_device(self, group_name, device_name):
         dev_identifier = f"devices_list_cached_{group_name}_{device_name}"
         device_id = cache.get(dev_identifier)
         device = None
-        logger.info(f"Finding device for group: {group_name}, device: {device_name}, topic: {topic_type}")
         if device_id is None:
             device = Device.objects.filter(
                 alias=device_name
@@ -692,20 +754,25 @@ class Command(BaseCommand):
 
         compact_command_id = normalized_command_id.replace('-', '')
 
-        sent_commands = CommandsModal.objects.filter(
-            device=device,
-            status__in=['S']
-        ).order_by('-command_in_time')[:200]
-
-        for command in sent_commands:
-            if command.id:
-                command_uuid = str(command.id).lower()
-                command_uuid_compact = command_uuid.replace('-', '')
-                command_short_id = command.id.hex[-10:].lower()
-                if normalized_command_id in [command_short_id, command_uuid, command_uuid_compact]:
-                    return command
-                if compact_command_id in [command_short_id, command_uuid_compact]:
-                    return command
+        # Full ids are looked up directly, short ids through the index
+        # written before the command was published. A short id missing from
+        # it is a stale, unknown or expired one, no command is scanned for it.
+        indexed_command_id = None
+        if len(compact_command_id) == 32:
+            try:
+                indexed_command_id = uuid.UUID(hex=compact_command_id)
+            except ValueError:
+                pass
+        else:
+            indexed_command_id = get_indexed_command_id(device.id, compact_command_id)
+        if indexed_command_id is not None:
+            command = CommandsModal.objects.filter(
+                pk=indexed_command_id,
+                device=device,
+                status__in=['S']
+            ).first()
+            if command is not None:
+                return command
 
         logger.warning(
             "No sent command matched request_id=%s for device %s",
@@ -728,24 +795,29 @@ class Command(BaseCommand):
 
     def build_chunked_command_response(self, command, message_data, response):
         chunk_cache_key = self.get_command_chunk_cache_key(command)
-        chunk_state = cache.get(chunk_cache_key, {}) or {}
-        chunk_parts = dict(chunk_state.get('parts') or {})
         part_index = int(message_data.get('part', 0) or 0)
         parts_total = int(message_data.get('parts_total', 1) or 1)
         response_complete = bool(message_data.get('response_complete', False))
 
-        chunk_parts[part_index] = response or ''
-        chunk_state = {
-            'parts': chunk_parts,
-            'parts_total': parts_total,
-        }
-        cache.set(chunk_cache_key, chunk_state, COMMAND_RESPONSE_CACHE_TTL)
+        # Every part is stored under its own key and counted once, the parts
+        # received earlier are not read back until the response is complete.
+        received_key = f"{chunk_cache_key}_received"
+        cache.set(f"{chunk_cache_key}_total", parts_total, COMMAND_RESPONSE_CACHE_TTL)
+        part_key = f"{chunk_cache_key}_{part_index}"
+        if cache.add(part_key, response or '', COMMAND_RESPONSE_CACHE_TTL):
+            cache.add(received_key, 0, COMMAND_RESPONSE_CACHE_TTL)
+            parts_received = cache.incr(received_key)
+        else:
+            # Retransmitted part, keep the latest copy.
+            cache.set(part_key, response or '', COMMAND_RESPONSE_CACHE_TTL)
+            parts_received = cache.get(received_key, 0)
 
-        if not response_complete and len(chunk_parts) < parts_total:
+        if not response_complete and parts_received < parts_total:
             return command.response, False
 
+        chunk_parts = cache.get_many([f"{chunk_cache_key}_{idx}" for idx in range(parts_total)])
         ordered_response = ''.join(
-            chunk_parts.get(idx, '')
+            chunk_parts.get(f"{chunk_cache_key}_{idx}", '')
             for idx in range(parts_total)
         )
         existing_response = command.response or ''
@@ -768,49 +840,20 @@ class Command(BaseCommand):
         return json.dumps(message_data)
 
     def clear_command_response_state(self, command):
-        cache.delete(self.get_command_chunk_cache_key(command))
+        chunk_cache_key = self.get_command_chunk_cache_key(command)
+        parts_total = cache.get(f"{chunk_cache_key}_total") or 0
+        cache.delete_many(
+            [f"{chunk_cache_key}_total", f"{chunk_cache_key}_received"]
+            + [f"{chunk_cache_key}_{idx}" for idx in range(parts_total)]
+        )
 
     def check_and_send_commands(self, client):
-        """_summary_
-
-        Args:
-            client (_type_): _description_
         """
-        # Get unsent commands
+            Publish pending commands as they are created, see CommandDispatcher.
+        """
+        self.command_dispatcher.start()
         while self.loop_running:
-            commands = CommandsModal.objects.filter(status__iexact='P').order_by('-command_in_time')
-            for command in commands:
-                logger.info("Found command waiting to be processed: %s for device: %s", command.command, command.device.ip_address)
-                device = command.device
-                # get latest active device config
-                cfg = DeviceConfig.objects.filter(
-                    device=device
-                ).order_by('-created_at').first()
-                if cfg is None:
-                    logger.warning("Config not found for device %s", command.device.ip_address)
-                cfg_data = cfg.data if (cfg is not None and cfg.data is not None) else {}
-                dev_mqtt_user = cfg_data.get('mqtt_user', 'Devtest')
-                dev_mqtt_user = dev_mqtt_user if dev_mqtt_user is not None else 'Devtest'
-                dev_mqtt_group = cfg_data.get('group_id', 'Devtest')
-                dev_mqtt_group = dev_mqtt_group if dev_mqtt_group is not None else 'Devtest'
-
-                default_command_topic = MQTT_ENABLED_DEVICE_COMMANDS.get(command.command, '')
-                if default_command_topic is None or default_command_topic == '':
-                    default_command_topic = MQTT_ENABLED_DEVICE_COMMANDS.get('cmd-req', '')
-                command_topic = default_command_topic.format(
-                    dev_mqtt_user=dev_mqtt_user,
-                    device_alias=device.alias,
-                    device_group=dev_mqtt_group
-                )
-                logger.info("Publishing MQTT %s: %s %s", command_topic, command.command, command.param)
-                payload = json.dumps({
-                    "command": f"{command.command} {command.param}".strip(),
-                    "device": device.alias,
-                    "command_id": command.id.hex[-10:],
-                })
-                client.publish(command_topic, payload, 1)
-                command.status = 'S' # Sent
-                command.command_read_time = timezone.now()
-                command.save()
-            self._write_health("running", pending_commands=commands.count())
-            time.sleep(10)
+            published_commands = self.command_dispatcher.dispatch_pending()
+            self.command_dispatcher.expire_unacknowledged()
+            self._write_health("running", published_commands=published_commands)
+            self.command_dispatcher.wait_for_commands()
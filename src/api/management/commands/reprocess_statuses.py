@@ -2,6 +2,7 @@ from datetime import datetime, time, timedelta
 from uuid import UUID
 
 import pytz
+from api.replay import replay_stored_raw_data_for_devices
 from api.utils import replay_stored_raw_data
 from device.models import Device, User
 from django.core.management.base import BaseCommand, CommandError
@@ -10,10 +11,10 @@ from django.utils import timezone
 
 
 class Command(BaseCommand):
-    help = 'Reprocess status calculations from stored raw data for a device and time range.'
+    help = 'Reprocess status calculations from stored raw data for one or more devices and a time range.'
 
     def add_arguments(self, parser):
-        parser.add_argument('device_id', type=str)
+        parser.add_argument('device_id', type=str, nargs='+')
 
         range_group = parser.add_mutually_exclusive_group(required=True)
         range_group.add_argument(
@@ -42,9 +43,19 @@ class Command(BaseCommand):
             action='store_true',
             help='Append rebuilt statuses without deleting existing status rows in the replay window.',
         )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            help='Number of worker processes used when several devices are replayed. '
+                 'Defaults to STATUS_REPLAY_WORKERS.',
+        )
 
     def handle(self, *args, **options):
-        device = self._get_device(options['device_id'])
+        devices = [self._get_device(device_id) for device_id in options['device_id']]
+        if len(devices) > 1:
+            return self._handle_devices(devices, options)
+
+        device = devices[0]
         user = self._get_user(device, options.get('user_id'))
         start_time, end_time = self._resolve_time_window(
             device,
@@ -80,6 +91,61 @@ class Command(BaseCommand):
             )
         )
 
+    def _handle_devices(self, devices, options):
+        users = {}
+        windows = {}
+        for device in devices:
+            user = self._get_user(device, options.get('user_id'))
+            users[device.pk] = user.pk if user is not None else None
+            windows[device.pk] = self._resolve_time_window(
+                device,
+                day=options.get('day'),
+                start=options.get('start'),
+                end=options.get('end'),
+            )
+
+        def on_progress(progress):
+            if progress['phase'] != 'replaying':
+                return
+            self.stdout.write(
+                'Devices {done}/{count}, raw rows {processed}/{total}, {rate} rows/s'.format(
+                    done=progress['devices_completed'],
+                    count=progress['device_count'],
+                    processed=progress['processed_raw_count'],
+                    total=progress['total_raw_count'],
+                    rate=progress['rows_per_second'],
+                )
+            )
+
+        # --day resolves to each device's local day, devices sharing a window share the pool.
+        devices_by_window = {}
+        for device in devices:
+            devices_by_window.setdefault(windows[device.pk], []).append(device)
+
+        errors = {}
+        processed_raw_count = 0
+        for (start_time, end_time), window_devices in devices_by_window.items():
+            replay = replay_stored_raw_data_for_devices(
+                window_devices,
+                start_time,
+                end_time,
+                users=users,
+                workers=options.get('workers'),
+                progress_callback=on_progress,
+                clear_existing_statuses=not options.get('keep_existing_statuses', False),
+            )
+            errors.update(replay['errors'])
+            processed_raw_count += sum(result['processed_raw_count'] for result in replay['results'].values())
+
+        for device_pk, error in errors.items():
+            self.stderr.write(f'Replay failed for device {device_pk}: {error}')
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Reprocessed statuses for {len(devices) - len(errors)} of {len(devices)} devices. '
+                f'Raw rows visited: {processed_raw_count}.'
+            )
+        )
+
     def _get_device(self, device_id):
         device_query = Q(ip_address=device_id) | Q(alias=device_id)
 
@@ -0,0 +1,209 @@
+import logging
+import multiprocessing
+import queue
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import django
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+logger = logging.getLogger('django')
+
+PROGRESS_POLL_SECONDS = 0.5
+
+
+def _init_replay_worker():
+    # Workers may be started with spawn/forkserver, where Django is not set up yet.
+    django.setup()
+    # Connections inherited through fork are shared with the parent, never reuse them.
+    connections.close_all()
+
+
+def _replay_device(device_pk, user_pk, start_time, end_time, replay_options, progress_queue=None,
+                   progress_callback=None):
+    from api.utils import replay_stored_raw_data
+    from device.models import Device, User
+
+    close_old_connections()
+    try:
+        device = Device.objects.get(pk=device_pk)
+        user = User.objects.filter(pk=user_pk).first() if user_pk is not None else None
+
+        if progress_queue is not None:
+            def progress_callback(progress):
+                progress_queue.put((str(device_pk), progress))
+
+        return replay_stored_raw_data(
+            device=device,
+            start_time=start_time,
+            end_time=end_time,
+            user=user,
+            progress_callback=progress_callback,
+            **replay_options,
+        )
+    finally:
+        close_old_connections()
+
+
+class _FleetProgress:
+    """Aggregates per-device replay progress into a single progress payload."""
+
+    def __init__(self, device_pks, progress_callback):
+        self.progress_callback = progress_callback
+        self.device_count = len(device_pks)
+        self.devices = {str(device_pk): {} for device_pk in device_pks}
+        self.finished_devices = set()
+        self.devices_failed = 0
+        self.started = time.monotonic()
+
+    def update(self, device_pk, progress):
+        self.devices[str(device_pk)] = progress
+
+    def emit(self, phase='replaying'):
+        if not callable(self.progress_callback):
+            return
+
+        processed_raw_count = sum(progress.get('processed_raw_count', 0) for progress in self.devices.values())
+        total_raw_count = sum(progress.get('total_raw_count', 0) for progress in self.devices.values())
+        elapsed_seconds = time.monotonic() - self.started
+        # Device totals are only known once its replay started, average the per-device fractions.
+        device_fractions = [
+            progress.get('processed_raw_count', 0) / progress['total_raw_count']
+            if progress.get('total_raw_count') else 0
+            for device_pk, progress in self.devices.items()
+            if device_pk not in self.finished_devices
+        ]
+        progress_percent = min(
+            99,
+            int(((len(self.finished_devices) + sum(device_fractions)) / max(1, self.device_count)) * 100),
+        )
+
+        self.progress_callback({
+            'phase': phase,
+            'device_count': self.device_count,
+            'devices_completed': len(self.finished_devices),
+            'devices_failed': self.devices_failed,
+            'processed_raw_count': processed_raw_count,
+            'replayed_raw_count': sum(progress.get('replayed_raw_count', 0) for progress in self.devices.values()),
+            'inserted_status_count': sum(progress.get('inserted_status_count', 0) for progress in self.devices.values()),
+            'total_raw_count': total_raw_count,
+            'progress_percent': progress_percent,
+            'elapsed_seconds': round(elapsed_seconds, 3),
+            'rows_per_second': round(processed_raw_count / elapsed_seconds, 1) if elapsed_seconds > 0 else 0,
+        })
+
+
+def replay_stored_raw_data_for_devices(
+    devices,
+    start_time,
+    end_time,
+    users=None,
+    workers=None,
+    progress_callback=None,
+    **replay_options,
+):
+    """
+        Replay stored raw data for several devices, one device per task on a
+        process pool.
+
+        Devices are independent, so they are replayed concurrently. The rows of
+        a single device stay on one worker and are processed in order because
+        the status context (first/last snapshots, status intervals) carries
+        over from one day to the next. `users` maps device pk to the user of
+        its user-scoped status types. `replay_options` are passed through to
+        `replay_stored_raw_data`.
+
+        Returns a dict with the per-device results and errors.
+    """
+    users = users or {}
+    device_pks = [device.pk for device in devices]
+    if workers is None:
+        workers = getattr(settings, 'STATUS_REPLAY_WORKERS', 4)
+    workers = max(1, min(int(workers), len(device_pks) or 1))
+
+    fleet_progress = _FleetProgress(device_pks, progress_callback)
+    results = {}
+    errors = {}
+    fleet_progress.emit(phase='starting')
+
+    def record_result(device_pk, result=None, error=None):
+        if error is not None:
+            errors[str(device_pk)] = str(error)
+            fleet_progress.devices_failed += 1
+        else:
+            results[str(device_pk)] = result
+            fleet_progress.update(device_pk, result)
+        fleet_progress.finished_devices.add(str(device_pk))
+
+    if workers == 1:
+        for device_pk in device_pks:
+            def on_device_progress(progress, device_pk=device_pk):
+                fleet_progress.update(device_pk, progress)
+                fleet_progress.emit()
+
+            try:
+                result = _replay_device(
+                    device_pk,
+                    users.get(device_pk),
+                    start_time,
+                    end_time,
+                    replay_options,
+                    progress_callback=on_device_progress,
+                )
+            except Exception as ex:
+                logger.exception('Replay failed for device %s', device_pk)
+                record_result(device_pk, error=ex)
+            else:
+                record_result(device_pk, result=result)
+        fleet_progress.emit(phase='completed')
+        return {'results': results, 'errors': errors, 'workers': workers}
+
+    if getattr(settings, 'CLICKHOUSE_ENABLED', False):
+        # Read the load detection models once, forked workers share them.
+        from utils.load_detection import load_model
+        load_model.targets
+
+    # Children must not inherit open database connections.
+    connections.close_all()
+    with multiprocessing.Manager() as manager:
+        progress_queue = manager.Queue() if callable(progress_callback) else None
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_replay_worker) as executor:
+            futures = {
+                executor.submit(
+                    _replay_device,
+                    device_pk,
+                    users.get(device_pk),
+                    start_time,
+                    end_time,
+                    replay_options,
+                    progress_queue,
+                ): device_pk
+                for device_pk in device_pks
+            }
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=PROGRESS_POLL_SECONDS, return_when=FIRST_COMPLETED)
+                _drain_progress(progress_queue, fleet_progress)
+                for future in done:
+                    device_pk = futures[future]
+                    try:
+                        record_result(device_pk, result=future.result())
+                    except Exception as ex:
+                        logger.error('Replay failed for device %s: %s', device_pk, ex)
+                        record_result(device_pk, error=ex)
+                fleet_progress.emit()
+
+    fleet_progress.emit(phase='completed')
+    return {'results': results, 'errors': errors, 'workers': workers}
+
+
+def _drain_progress(progress_queue, fleet_progress):
+    if progress_queue is None:
+        return
+    while True:
+        try:
+            device_pk, progress = progress_queue.get_nowait()
+        except queue.Empty:
+            return
+        fleet_progress.update(device_pk, progress)
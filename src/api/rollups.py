@@ -0,0 +1,146 @@
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+logger = logging.getLogger('device')
+
+DAILY_ROLLUP_CACHE_KEY_PREFIX = 'daily_rollup:v2:'
+DAILY_ROLLUP_TIMEOUT_SECONDS = getattr(settings, 'DAILY_ROLLUP_TIMEOUT_SECONDS', 2 * 24 * 60 * 60)
+DAILY_ROLLUP_UPDATED_AT_FIELD = 'updated_at'
+
+DAILY_ROLLUP_ENERGY_FIELDS = (
+    "energy_generated_this_day",
+    "energy_generation_limit_this_day",
+    "energy_consumed_this_day",
+    "energy_consumption_limit_this_day",
+    "energy_imported_this_day",
+    "energy_import_limit_this_day",
+    "energy_exported_this_day",
+    "energy_export_limit_this_day",
+)
+
+
+_redis = None
+_redis_checked = False
+_redis_lock = threading.Lock()
+
+
+def _get_redis():
+    """Return the Redis connection of the cache, or None when the cache is not Redis."""
+    global _redis, _redis_checked
+    if not _redis_checked:
+        with _redis_lock:
+            if not _redis_checked:
+                try:
+                    from django_redis import get_redis_connection
+                    _redis = get_redis_connection('default')
+                except (ImportError, NotImplementedError):
+                    _redis = None
+                _redis_checked = True
+    return _redis
+
+
+def get_rollup_day(device=None, reference_time=None):
+    """
+        Return the local date of `reference_time` for the device, the day its
+        `*_this_day` values belong to. Devices without a known timezone, and
+        no device, use the current timezone.
+    """
+    device_timezone = device.get_timezone() if device is not None else None
+    return _get_local_day(device_timezone, reference_time)
+
+
+def _get_local_day(device_timezone, reference_time=None):
+    if reference_time is None:
+        reference_time = timezone.now()
+    elif timezone.is_naive(reference_time):
+        reference_time = timezone.make_aware(reference_time, timezone.get_current_timezone())
+    return reference_time.astimezone(device_timezone or timezone.get_current_timezone()).date()
+
+
+def _get_daily_rollup_key(day, device_pk):
+    return f"{DAILY_ROLLUP_CACHE_KEY_PREFIX}{day.isoformat()}:{device_pk}"
+
+
+def record_device_daily_rollup(device, reference_time=None, values=None):
+    """
+        Mark the device active for its local day of `reference_time` and keep
+        the latest of its `*_this_day` energy values.
+
+        With Redis the entry is a hash written field by field, so concurrent
+        writers of a device never undo each other's fields.
+    """
+    try:
+        cache_key = _get_daily_rollup_key(get_rollup_day(device, reference_time), device.pk)
+        updates = {}
+        for field_name in DAILY_ROLLUP_ENERGY_FIELDS:
+            if values and field_name in values:
+                try:
+                    updates[field_name] = float(values[field_name])
+                except (TypeError, ValueError):
+                    continue
+        updates[DAILY_ROLLUP_UPDATED_AT_FIELD] = timezone.now().isoformat()
+
+        redis_client = _get_redis()
+        if redis_client is None:
+            entry = cache.get(cache_key) or {}
+            entry.update(updates)
+            cache.set(cache_key, entry, DAILY_ROLLUP_TIMEOUT_SECONDS)
+            return
+        pipeline = redis_client.pipeline(transaction=False)
+        pipeline.hset(cache_key, mapping=updates)
+        pipeline.expire(cache_key, DAILY_ROLLUP_TIMEOUT_SECONDS)
+        pipeline.execute()
+    except Exception as ex:
+        logger.warning("Failed to update daily rollup for device %s: %s", device.pk, ex)
+
+
+def _get_daily_rollups(cache_keys):
+    redis_client = _get_redis()
+    if redis_client is None:
+        return list(cache.get_many(cache_keys).values())
+    pipeline = redis_client.pipeline(transaction=False)
+    for cache_key in cache_keys:
+        pipeline.hgetall(cache_key)
+    entries = []
+    for values in pipeline.execute():
+        if values:
+            entries.append({
+                (field_name.decode('utf-8') if isinstance(field_name, bytes) else field_name): (
+                    value.decode('utf-8') if isinstance(value, bytes) else value
+                )
+                for field_name, value in values.items()
+            })
+    return entries
+
+
+def get_daily_summary(device_timezones, day=None):
+    """
+        Return the device count, active device count and energy totals of the
+        devices for the day, read from their rollup entries in one round trip.
+        `device_timezones` is {device pk: timezone or None}; without a `day`
+        each device is read for its current local day, the one its rollups
+        are written under. `rollup_updated_at` is the time of the most recent
+        rollup update.
+    """
+    now = timezone.now()
+    cache_keys = [
+        _get_daily_rollup_key(day or _get_local_day(device_timezone, now), device_pk)
+        for device_pk, device_timezone in device_timezones.items()
+    ]
+    entries = _get_daily_rollups(cache_keys)
+
+    summary = {
+        "total_devices": len(cache_keys),
+        "active_devices": len(entries),
+    }
+    for field_name in DAILY_ROLLUP_ENERGY_FIELDS:
+        summary[f"total_{field_name}"] = sum(float(entry.get(field_name, 0.0)) for entry in entries)
+    summary["rollup_updated_at"] = max(
+        (entry[DAILY_ROLLUP_UPDATED_AT_FIELD] for entry in entries if entry.get(DAILY_ROLLUP_UPDATED_AT_FIELD)),
+        default=None,
+    )
+    return summary
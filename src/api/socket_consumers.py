@@ -1,19 +1,109 @@
+import atexit
 import json
 import logging
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from device.device_cache import device_cache
 from device.models import Device
 from django.conf import settings
+from django.db import close_old_connections
+from api.buffers import device_state_writer
+from api.ingestion import LatencyHistogram, PartitionedWorkerPool
 from api.utils import merge_device_other_data, process_raw_data
 
 
 logger = logging.getLogger('django')
 
+# Receive to ack latency of websocket frames handled by this process.
+SOCKET_ACK_LATENCY_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+socket_ack_latency = LatencyHistogram(SOCKET_ACK_LATENCY_BUCKETS_MS)
+
+_socket_ingest_pool = None
+_socket_ack_executor = None
+socket_inline_frames = 0
+_socket_lock = threading.Lock()
+
+
+def _ingest_socket_frame(device, message_data):
+    process_raw_data(device, message_data, channel='socket', data_type='data')
+
+
+def get_socket_ingest_pool():
+    """Device-partitioned, bounded pool running the ingestion of data frames."""
+    global _socket_ingest_pool
+    if _socket_ingest_pool is None:
+        with _socket_lock:
+            if _socket_ingest_pool is None:
+                _socket_ingest_pool = PartitionedWorkerPool(
+                    _ingest_socket_frame,
+                    workers=getattr(settings, 'SOCKET_INGEST_WORKERS', 4),
+                    queue_size=getattr(settings, 'SOCKET_INGEST_QUEUE_SIZE', 1000),
+                    name="socket-ingest",
+                ).start()
+                atexit.register(
+                    _socket_ingest_pool.shutdown,
+                    drain=True,
+                    timeout=getattr(settings, 'MQTT_INGEST_SHUTDOWN_TIMEOUT_SECONDS', 30),
+                )
+    return _socket_ingest_pool
+
+
+def get_socket_ack_executor():
+    """Threads resolving devices and building acks, SOCKET_ACK_WORKERS at most."""
+    global _socket_ack_executor
+    if _socket_ack_executor is None:
+        with _socket_lock:
+            if _socket_ack_executor is None:
+                _socket_ack_executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'SOCKET_ACK_WORKERS', 8),
+                    thread_name_prefix="socket-ack",
+                )
+    return _socket_ack_executor
+
+
+def queue_socket_frame(device, message_data):
+    """
+        Hand a data frame to the ingest pool.
+
+        Waits at most SOCKET_INGEST_SUBMIT_TIMEOUT_SECONDS for a slot in the
+        device's queue, a slow device must not hold the shared ack threads for
+        long. When the queue stays full, or the pool is shutting down, the
+        frame is ingested inline on the ack thread instead, so it is never lost.
+    """
+    global socket_inline_frames
+    if get_socket_ingest_pool().submit(
+        str(device.pk),
+        device,
+        message_data,
+        timeout=getattr(settings, 'SOCKET_INGEST_SUBMIT_TIMEOUT_SECONDS', 0.05),
+    ):
+        return
+    with _socket_lock:
+        socket_inline_frames += 1
+    logger.warning("Socket ingestion is busy or shutting down, ingesting frame of device %s inline", device.pk)
+    _ingest_socket_frame(device, message_data)
+
+
+def socket_ingest_stats():
+    return {
+        "ingest": _socket_ingest_pool.stats() if _socket_ingest_pool is not None else None,
+        "inline_frames": socket_inline_frames,
+        "ack_latency": socket_ack_latency.snapshot(),
+    }
+
+
 # @database_sync_to_async
-def process_device_message_sync(message):
+def process_device_message_sync(message, ingest=None):
+    """
+        Build the reply to a device frame. Data frames are processed inline,
+        or handed to `ingest(device, message_data)` when given.
+    """
     device = None
     resp = "Error processing message"
     time_to_sync = False
@@ -26,9 +116,11 @@ def process_device_message_sync(message):
         device_mac = message_mac.strip('[]')
         device_id = message.replace(f" {message_mac}", "").strip(f"HEARTBEAT []")
         if device_id != '0' and device_id.isdigit():
-            device = Device.objects.filter(
-                numeric_id=device_id
-            ).first()
+            device = device_cache.get(
+                ('numeric_id', device_id),
+                lambda: Device.objects.filter(numeric_id=device_id).first(),
+            )
+            device_state_writer.merge_into([device])
             if device:
                 other_data = device.other_data
                 if other_data is None:
@@ -49,9 +141,10 @@ def process_device_message_sync(message):
                 merge_device_other_data(device, updates)
             elif device_mac:
                 # Create new device
-                device = Device.objects.filter(
-                    mac=device_mac
-                ).first()
+                device = device_cache.get(
+                    ('mac', device_mac),
+                    lambda: Device.objects.filter(mac=device_mac).first(),
+                )
                 if not device:
                     device = Device(
                         mac=device_mac,
@@ -73,9 +166,10 @@ def process_device_message_sync(message):
 
         device = None
         if device_mac is not None:
-            device = Device.objects.filter(
-                mac=device_mac
-            ).first()
+            device = device_cache.get(
+                ('mac', device_mac),
+                lambda: Device.objects.filter(mac=device_mac).first(),
+            )
             if not device:
                 logger.info(f"New device detected with mac: {device_mac}")
                 device = Device(
@@ -88,14 +182,17 @@ def process_device_message_sync(message):
 
             logger.info(f"Device mac: {device_mac}")
 
-            process_raw_data(device, message_data, channel='socket', data_type='data')
+            if ingest is None:
+                process_raw_data(device, message_data, channel='socket', data_type='data')
+            else:
+                ingest(device, message_data)
             resp = "OK"
 
             if device is not None and device.numeric_id != config_data.get('devId'):
                 resp = f"CONFIG[2] {device.numeric_id}"
 
     if device is not None:
-        command = device.get_command()
+        command = device.get_cached_command()
         if command is not None:
             command.status = 'E'
             command.command_read_time = datetime.utcnow()
@@ -114,6 +211,9 @@ class InputDataConsumer(AsyncWebsocketConsumer):
         self.room_name = '_'.join([str(x) for x in self.client])
         self.room_group_name = 'device_%s' % self.room_name
         logger.debug(f"Connection request from client: {self.room_group_name}")
+        self.frames = 0
+        self.ack_seconds_total = 0.0
+        self.ack_seconds_max = 0.0
 
         # Join room group
         await self.channel_layer.group_add(
@@ -124,16 +224,35 @@ class InputDataConsumer(AsyncWebsocketConsumer):
     
     async def disconnect(self, close_code):
         # Leave room group
-        logger.info(f"Disconnecting from {self.room_group_name}")
+        logger.info(
+            "Disconnecting from %s after %s frames, ack latency avg %.1f ms, max %.1f ms",
+            self.room_group_name,
+            self.frames,
+            (self.ack_seconds_total / self.frames * 1000) if self.frames else 0,
+            self.ack_seconds_max * 1000,
+        )
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
 
     async def receive(self, text_data):
+        received_at = time.perf_counter()
         logger.info(f"Data received from {self.room_group_name}: {text_data}")
-        resp = await sync_to_async(self.device_message)({"message": text_data})
+        # Not thread sensitive, frames of other connections are acked concurrently.
+        resp = await sync_to_async(
+            self.device_message,
+            thread_sensitive=False,
+            executor=get_socket_ack_executor(),
+        )({"message": text_data})
         await self.send(text_data=resp)
+        self.record_ack_latency(time.perf_counter() - received_at)
+
+    def record_ack_latency(self, seconds):
+        self.frames += 1
+        self.ack_seconds_total += seconds
+        self.ack_seconds_max = max(self.ack_seconds_max, seconds)
+        socket_ack_latency.observe(seconds)
 
     def device_message(self, event):
         message = event['message']
@@ -141,10 +260,12 @@ class InputDataConsumer(AsyncWebsocketConsumer):
 
         resp = "Exception processing data"
         try:
-            resp = process_device_message_sync(message)
+            resp = process_device_message_sync(message, ingest=queue_socket_frame)
         except Exception as ex:
             logger.exception(f"Exception processing data: {message}")
             logger.exception(ex)
+        finally:
+            close_old_connections()
 
         logger.info(f"Sending to {self.room_group_name}: {resp}")
         return resp
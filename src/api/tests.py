@@ -1,12 +1,61 @@
-from datetime import datetime
-from unittest.mock import Mock
+import asyncio
+import gzip
+import importlib
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone as dt_timezone
+from types import SimpleNamespace
+from unittest.mock import ANY, Mock, patch
 
+import numpy as np
 import pytz
-from django.test import SimpleTestCase
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models import Q
+from django.db.utils import DatabaseError
+from django.test import SimpleTestCase, override_settings
+from infi.clickhouse_orm.database import Database, ServerError
+from sklearn.linear_model import LinearRegression
 
-from api.utils import refresh_status_processing_context_boundaries
-from device_schemas.schema import (get_status_expression_helper_content,
+from api.buffers import DeviceStateWriter, RawDataBucketCompactor, RawDataWriter
+from api.dispatch import CommandDispatcher, index_sent_commands
+from api.exports import iter_csv_lines, iter_export_records, iter_gzip, iter_ndjson_lines, stream_data_export
+from api.ingestion import PartitionedWorkerPool
+from api.management.commands.mqtt import Command as MqttListenerCommand
+from api.replay import replay_stored_raw_data_for_devices
+from api.rollups import get_daily_summary, record_device_daily_rollup
+from api.socket_consumers import (InputDataConsumer, process_device_message_sync, queue_socket_frame,
+                                  socket_ingest_stats)
+from api.throttling import MovingWindowRateLimiter
+from api.utils import (_build_device_alarm_index, _get_local_midnight_utc, build_status_processing_context,
+                       evaluate_device_status_alarms, flush_deferred_status_writes, get_latest_raw_data, get_local_day_start_utc,
+                       get_local_month_start_utc,
+                       load_status_processing_context,
+                       new_deferred_status_writes,
+                       refresh_status_processing_context_boundaries,
+                       save_status_processing_context, status_processing_context_lock,
+                       update_user_and_device_statuses)
+from api.viewsets.device_details_views import HeartbeatViewSet
+from datascience.train_machine import ModelRegistry
+from device.clickhouse_models.buffer import ClickHouseInsertBuffer
+from device.clickhouse_models.query import ClickHouseQueryClient, format_parameter
+from device.device_cache import DeviceLookupCache
+from device.models import Device, User
+from device.models import device as device_models
+from device.raw_data_store import RawDataPoint, build_raw_data_bucket, extract_fields, iter_raw_data, project_data
+from device_schemas.schema import (compile_calculated_expression,
+								   get_status_expression_helper_content,
 								   translate_data_from_schema)
+from utils.dev_data import DataReports, build_statistics_query, plan_statistics_sources
+from utils.load_detection import get_load_data_ai, get_load_data_ai_batch, load_model
+from utils.weather import WeatherSeries, get_stored_weather_data, store_weather_data
+from utils.weather_fetcher import OpenWeatherMapClient, StubWeatherClient, WeatherFetcher
 
 
 class SchemaTranslationTests(SimpleTestCase):
@@ -266,6 +315,38 @@ class SchemaTranslationTests(SimpleTestCase):
 		)
 
 
+	def _calculated(self, source, data, multiplier=1):
+		schema = [{
+			"target": "device",
+			"name": "DAILY_STATUS",
+			"fields": [{"target": "value", "type": "calculated", "source": source, "multiplier": multiplier, "offset": 0}],
+		}]
+		return translate_data_from_schema(schema, data)["DAILY_STATUS"]["value"]
+
+	def test_calculated_expression_is_compiled_once(self):
+		first = compile_calculated_expression("meter_0.power * 120 / 3600000")
+		second = compile_calculated_expression("meter_0.power * 120 / 3600000")
+
+		self.assertIs(first, second)
+		self.assertIsNotNone(first.code)
+		self.assertEqual(
+			[(token[1], token[2]) for token in first.tokens],
+			[("rawField", "meter_0.power"), ("operator", None), ("operator", None), ("operator", None), ("operator", None)],
+		)
+
+	def test_calculated_expression_keeps_rendered_equation_semantics(self):
+		# Values behave as if they were written into the expression text.
+		self.assertEqual(self._calculated("meter_0.power ** 2", {"meter_0": {"power": -2}}), -4)
+		self.assertEqual(self._calculated("meter_0.power + 1", {"meter_0": {"power": "12"}}), 13)
+		self.assertEqual(self._calculated("meter_0.power * 2 if meter_0.on else meter_0.name", {"meter_0": {"power": 3, "on": True, "name": "On"}}), 6)
+		self.assertIsNone(self._calculated("meter_0.name", {"meter_0": {"name": "On"}}))
+
+	def test_calculated_expression_rejects_unsafe_constructs(self):
+		self.assertIsNone(self._calculated("print( meter_0.power )", {"meter_0": {"power": 1}}))
+		self.assertIsNone(self._calculated("meter_0.name", {"meter_0": {"name": "__import__('os').getcwd()"}}))
+		self.assertEqual(self._calculated("max( meter_0.power , 5 )", {"meter_0": {"power": 1}}), 5)
+
+
 class StatusProcessingContextTests(SimpleTestCase):
 	def test_refresh_context_resets_first_today_on_new_day(self):
 		device = Mock()
@@ -324,6 +405,91 @@ class StatusProcessingContextTests(SimpleTestCase):
 			20,
 		)
 
+	def _build_context(self, day_start_utc, month_start_utc):
+		return {
+			"existing_statuses": {"firstToday": {}, "lastToday": {}, "firstThisMonth": {}},
+			"last_status_models_by_target": {},
+			"current_raw_data": {},
+			"day_start_utc": day_start_utc,
+			"month_start_utc": month_start_utc,
+		}
+
+	def test_persisted_context_is_reused_within_the_same_day(self):
+		device = Mock(pk=7)
+		device.get_timezone.return_value = pytz.utc
+		user = Mock(pk=3, is_authenticated=True)
+		status_cache = LocMemCache("status-context-tests", {})
+		built_context = self._build_context(
+			datetime(2026, 5, 2, 0, 0, tzinfo=pytz.utc),
+			datetime(2026, 5, 1, 0, 0, tzinfo=pytz.utc),
+		)
+
+		with patch("api.utils.cache", status_cache), \
+				patch("api.utils.build_status_processing_context", return_value=built_context) as build_context:
+			context = load_status_processing_context(user, device, None, datetime(2026, 5, 2, 8, 0, tzinfo=pytz.utc))
+			context["existing_statuses"]["lastToday"]["raw"] = {"power": 10}
+			save_status_processing_context(device, context)
+
+			context = load_status_processing_context(user, device, None, datetime(2026, 5, 2, 9, 0, tzinfo=pytz.utc))
+
+		self.assertEqual(build_context.call_count, 1)
+		self.assertEqual(context["existing_statuses"]["lastToday"]["raw"], {"power": 10})
+
+	def test_persisted_context_is_rebuilt_on_new_day_or_other_user(self):
+		device = Mock(pk=7)
+		device.get_timezone.return_value = pytz.utc
+		user = Mock(pk=3, is_authenticated=True)
+		status_cache = LocMemCache("status-context-rebuild-tests", {})
+		cached_context = self._build_context(
+			datetime(2026, 5, 2, 0, 0, tzinfo=pytz.utc),
+			datetime(2026, 5, 1, 0, 0, tzinfo=pytz.utc),
+		)
+		cached_context["user_id"] = user.pk
+
+		with patch("api.utils.cache", status_cache), \
+				patch("api.utils.build_status_processing_context", side_effect=lambda *args, **kwargs: self._build_context(None, None)) as build_context:
+			save_status_processing_context(device, cached_context)
+			load_status_processing_context(user, device, None, datetime(2026, 5, 3, 0, 5, tzinfo=pytz.utc))
+			load_status_processing_context(Mock(pk=4, is_authenticated=True), device, None, datetime(2026, 5, 2, 9, 0, tzinfo=pytz.utc))
+			context = load_status_processing_context(user, device, None, datetime(2026, 5, 2, 9, 0, tzinfo=pytz.utc))
+
+		self.assertEqual(build_context.call_count, 2)
+		self.assertEqual(context["user_id"], user.pk)
+
+	def test_rebuilt_context_includes_rows_buffered_by_the_writer(self):
+		device = Mock(pk=7)
+		device.get_timezone.return_value = pytz.utc
+		writer = RawDataWriter(max_rows=10, max_delay_seconds=60)
+		for arrival, power in ((datetime(2026, 4, 30, 23, 59, tzinfo=pytz.utc), 5), (datetime(2026, 5, 2, 8, 0, tzinfo=pytz.utc), 10), (datetime(2026, 5, 2, 8, 1, tzinfo=pytz.utc), 20)):
+			writer.add(Mock(device=device, device_id=7, data_type="meters-data", data_arrival_time=arrival, data=f'{{"meter_1": {{"power": {power}}}}}'))
+		writer.add(Mock(device=device, device_id=7, data_type="status", data_arrival_time=datetime(2026, 5, 2, 8, 2, tzinfo=pytz.utc), data={"meter_1": {"power": 99}}))
+
+		with patch("api.utils.raw_data_writer", writer), \
+				patch("api.utils.iter_raw_data", return_value=iter([])), \
+				patch("api.utils._get_status_queryset_for_day", return_value=[]):
+			context = build_status_processing_context(None, device, None, as_of_time=datetime(2026, 5, 2, 9, 0, tzinfo=pytz.utc))
+
+		existing_statuses = context["existing_statuses"]
+		self.assertEqual(existing_statuses["firstToday"]["raw"], {"meter_1": {"power": 10}})
+		self.assertEqual(existing_statuses["lastToday"]["raw"], {"meter_1": {"power": 20}})
+		self.assertEqual(existing_statuses["firstThisMonth"]["raw"], {"meter_1": {"power": 10}})
+
+	def test_persisted_context_is_updated_under_a_per_device_lock(self):
+		device = Mock(pk=7)
+		status_cache = LocMemCache("status-context-lock-tests", {})
+		with patch("api.utils.cache", status_cache), \
+				patch("api.utils.STATUS_CONTEXT_LOCK_WAIT_SECONDS", 0), \
+				patch("api.utils._update_user_and_device_statuses") as update_statuses:
+			with status_processing_context_lock(device) as locked:
+				self.assertTrue(locked)
+				# Another writer of the device processes its message without saving the context.
+				update_user_and_device_statuses(None, device, {}, None)
+				self.assertFalse(update_statuses.call_args.kwargs["save_context"])
+			update_user_and_device_statuses(None, device, {}, None)
+			self.assertTrue(update_statuses.call_args.kwargs["save_context"])
+			update_user_and_device_statuses(None, device, {}, None, status_processing_context={})
+			self.assertNotIn("save_context", update_statuses.call_args.kwargs)
+
 	def test_status_expression_helper_content_lists_supported_sections(self):
 		helper_data = get_status_expression_helper_content({
 			"meter_0": {"power": 100, "powerFactor": 0.95},
@@ -337,3 +503,1597 @@ class StatusProcessingContextTests(SimpleTestCase):
 		self.assertTrue(any(item["name"] == "firstToday" for item in helper_data["history_context"]))
 		self.assertIn("meter_0.power", helper_data["available_raw_fields"])
 		self.assertIn("dht.temperature", helper_data["available_raw_fields"])
+
+
+class DeviceTimezoneTests(SimpleTestCase):
+	def setUp(self):
+		device_models._timezone_finder = None
+		device_models.get_timezone_name_at.cache_clear()
+		self.addCleanup(device_models.get_timezone_name_at.cache_clear)
+		self.addCleanup(setattr, device_models, "_timezone_finder", None)
+
+	def test_timezone_finder_is_built_once_and_lookups_are_memoized_by_position(self):
+		with patch("device.models.device.TimezoneFinder") as timezone_finder_class:
+			timezone_finder_class.return_value.timezone_at.side_effect = ["Asia/Kolkata", "Europe/Berlin"]
+			device = Device(ip_address="0.0.0.1", position={"latitude": "28.6", "longitude": "77.2"})
+
+			self.assertEqual(device.get_timezone().zone, "Asia/Kolkata")
+			self.assertEqual(Device(position={"latitude": 28.6, "longitude": 77.2}).get_timezone().zone, "Asia/Kolkata")
+
+			device.position = {"latitude": 52.5, "longitude": 13.4}
+			self.assertEqual(device.get_timezone().zone, "Europe/Berlin")
+
+		timezone_finder_class.assert_called_once_with()
+		self.assertEqual(timezone_finder_class.return_value.timezone_at.call_count, 2)
+
+	def test_local_boundaries_are_memoized_per_local_date_and_offset(self):
+		device = Mock()
+		device.get_timezone.return_value = pytz.timezone("Europe/Berlin")
+		reference_time = datetime(2026, 3, 29, 12, 0, tzinfo=pytz.utc)
+
+		# The UTC offset of the reference time is kept for the boundary.
+		self.assertEqual(get_local_day_start_utc(device, reference_time), datetime(2026, 3, 28, 22, 0, tzinfo=pytz.utc))
+		self.assertEqual(get_local_month_start_utc(device, reference_time), datetime(2026, 2, 28, 22, 0, tzinfo=pytz.utc))
+
+		hits = _get_local_midnight_utc.cache_info().hits
+		get_local_day_start_utc(device, datetime(2026, 3, 29, 13, 0, tzinfo=pytz.utc))
+		self.assertEqual(_get_local_midnight_utc.cache_info().hits, hits + 1)
+
+
+class UserDeviceListTests(SimpleTestCase):
+	def setUp(self):
+		cache_patcher = patch("device.models.device.cache", LocMemCache("user-device-tests", {}))
+		cache_patcher.start()
+		self.addCleanup(cache_patcher.stop)
+		self.user = User(pk="00000000-0000-0000-0000-000000000001", username="owner", subnet_mask="192.168.1.0/15")
+
+	def _device(self, ip_address, active=True):
+		return Mock(pk=ip_address, ip_address=ip_address, ip_address_numeric=User.address_string_to_numeric(ip_address), active=active)
+
+	def test_device_list_uses_range_query_and_caches_until_devices_change(self):
+		devices = [self._device("192.168.1.1"), self._device("192.168.1.4"), self._device("192.168.1.2", active=False)]
+		with patch("device.models.device.Device.objects") as device_objects:
+			device_objects.filter.return_value.only.return_value = devices
+
+			self.assertEqual(self.user.device_list(), ["192.168.1.1", "192.168.1.4"])
+			device_list, next_address = self.user.device_list(return_next_address=True)
+			self.assertEqual(device_objects.filter.call_count, 1)
+			self.assertEqual(next_address, "192.168.1.5")
+
+			device_objects.filter.assert_called_with(
+				ip_address_numeric__gte=User.address_string_to_numeric("192.168.1.0"),
+				ip_address_numeric__lt=User.address_string_to_numeric("192.168.1.15"),
+			)
+
+			device_objects.in_bulk.return_value = {device.pk: device for device in devices}
+			self.assertEqual(self.user.device_list(return_objects=True), devices[:2])
+			self.assertEqual(self.user.device_pks(), ["192.168.1.1", "192.168.1.4"])
+			self.assertEqual(device_objects.filter.call_count, 1)
+
+			device_models.invalidate_user_device_cache()
+			self.user.device_list()
+			self.assertEqual(device_objects.filter.call_count, 2)
+
+	def test_device_id_lookup_does_not_load_the_subnet(self):
+		device = self._device("192.168.1.3")
+		with patch("device.models.device.Device.objects") as device_objects:
+			device_objects.filter.return_value.first.return_value = device
+
+			self.assertIs(self.user.device_list(return_objects=True, device_id="192.168.1.3"), device)
+
+		device_objects.filter.assert_called_once_with(ip_address_numeric=User.address_string_to_numeric("192.168.1.3"))
+
+	def test_save_stores_numeric_address_and_invalidates_on_ownership_change(self):
+		device = Device(ip_address="192.168.1.9", access_token="token")
+		with patch("django.db.models.Model.save"), \
+				patch("device.models.device.invalidate_user_device_cache") as invalidate:
+			device.save()
+			self.assertEqual(device.ip_address_numeric, User.address_string_to_numeric("192.168.1.9"))
+			device._state.adding = False
+
+			device.other_data = {"last_data_sync_time": "now"}
+			device.save()
+			self.assertEqual(invalidate.call_count, 1)
+
+			device.active = False
+			device.save()
+			self.assertEqual(invalidate.call_count, 2)
+
+			device.position = {"latitude": 28.6, "longitude": 77.2}
+			device.save()
+			self.assertEqual(invalidate.call_count, 3)
+
+			# Edited in place, the snapshot taken on the last save is not.
+			device.position["latitude"] = 40.7
+			device.save()
+			self.assertEqual(invalidate.call_count, 4)
+
+
+class DataExportTests(SimpleTestCase):
+	def test_export_records_are_streamed_with_projection_and_resume_point(self):
+		device = Mock(pk=1, ip_address="192.168.1.1")
+		row = Mock(
+			id=uuid.UUID(int=5),
+			device_id=1,
+			data_arrival_time=datetime(2026, 5, 1, 10, 0, tzinfo=pytz.utc),
+			channel="mqtt",
+			data_type="meters-data",
+			data={"power": 10},
+		)
+		resume_from = datetime(2026, 5, 1, 9, 0, tzinfo=pytz.utc)
+
+		with patch("api.exports.RawData.objects") as raw_data_objects:
+			queryset = raw_data_objects.filter.return_value.only.return_value
+			queryset.filter.return_value = queryset
+			queryset.order_by.return_value.iterator.return_value = iter([row])
+
+			records = list(iter_export_records([device], "raw_data", None, None, resume_from=resume_from))
+
+		raw_data_objects.filter.assert_called_once_with(device__in=[1])
+		queryset.filter.assert_called_once_with(data_arrival_time__gt=resume_from)
+		queryset.order_by.assert_called_once_with("data_arrival_time", "id")
+		self.assertEqual(records, [(
+			"2026-05-01T10:00:00Z", "mqtt", "meters-data", "192.168.1.1", {"power": 10}, str(uuid.UUID(int=5)),
+		)])
+
+	def test_export_resumes_after_the_time_and_id_of_the_last_row(self):
+		last_id = uuid.UUID(int=4)
+		last_time = datetime(2026, 5, 1, 9, 0, 0, 250000, tzinfo=pytz.utc)
+
+		with patch("api.exports.AssetStatus.objects") as asset_status_objects:
+			queryset = asset_status_objects.filter.return_value.only.return_value
+			queryset.filter.return_value = queryset
+			queryset.order_by.return_value.iterator.return_value = iter([])
+			asset_status_objects.filter.return_value.values_list.return_value.first.return_value = last_time
+
+			list(iter_export_records(
+				[Mock(pk=1, ip_address="192.168.1.1")],
+				"DAILY_STATUS",
+				None,
+				None,
+				resume_from=datetime(2026, 5, 1, 9, 0, tzinfo=pytz.utc),
+				resume_after_id=last_id,
+			))
+			response = stream_data_export([], "DAILY_STATUS", None, None)
+
+		asset_status_objects.filter.assert_any_call(pk=last_id)
+		self.assertEqual(
+			queryset.filter.call_args.args[0],
+			Q(created_at__gt=last_time) | Q(created_at=last_time, id__gt=last_id),
+		)
+		queryset.order_by.assert_called_once_with("created_at", "id")
+		self.assertEqual(response["X-Export-Resume-Field"], "created_at")
+		self.assertEqual(response["X-Export-Resume-Id-Field"], "id")
+
+	def test_csv_ndjson_and_gzip_writers(self):
+		records = [("2026-05-01T10:00:00Z", "mqtt", "meters-data", "192.168.1.1", {"power": 10}, "row-1")]
+
+		self.assertEqual(
+			"".join(iter_csv_lines(iter(records))).splitlines(),
+			[
+				"data_arrival_time,channel,data_type,device,data,id",
+				'2026-05-01T10:00:00Z,mqtt,meters-data,192.168.1.1,"{""power"": 10}",row-1',
+			],
+		)
+		ndjson = "".join(iter_ndjson_lines(iter(records)))
+		self.assertEqual(ndjson.count("\n"), 1)
+		self.assertIn('"device": "192.168.1.1"', ndjson)
+		self.assertIn('"id": "row-1"', ndjson)
+		self.assertEqual(gzip.decompress(b"".join(iter_gzip(iter(["a,b\n", "c,d\n"])))), b"a,b\nc,d\n")
+
+
+class DailyRollupTests(SimpleTestCase):
+	def _device(self, pk, device_timezone=None):
+		return Mock(pk=pk, get_timezone=Mock(return_value=device_timezone))
+
+	def test_summary_is_read_from_per_device_rollups(self):
+		day_time = datetime(2026, 5, 1, 10, 0, tzinfo=pytz.utc)
+		with patch("api.rollups.cache", LocMemCache(f"daily-rollup-{uuid.uuid4()}", {})), \
+				patch("api.rollups._get_redis", return_value=None):
+			record_device_daily_rollup(self._device(1), day_time)
+			record_device_daily_rollup(self._device(1), day_time, {"energy_consumed_this_day": "2.5", "power": 10})
+			record_device_daily_rollup(self._device(1), day_time, {"energy_consumed_this_day": 3})
+			record_device_daily_rollup(self._device(2), day_time, {"energy_consumed_this_day": 1, "energy_generated_this_day": 4})
+			record_device_daily_rollup(self._device(3), datetime(2026, 4, 30, 23, 0, tzinfo=pytz.utc), {"energy_consumed_this_day": 7})
+
+			summary = get_daily_summary({1: None, 2: None, 3: None, 4: None}, day=day_time.date())
+
+		self.assertEqual(summary["total_devices"], 4)
+		self.assertEqual(summary["active_devices"], 2)
+		self.assertEqual(summary["total_energy_consumed_this_day"], 4.0)
+		self.assertEqual(summary["total_energy_generated_this_day"], 4.0)
+		self.assertEqual(summary["total_energy_exported_this_day"], 0)
+		self.assertIsNotNone(summary["rollup_updated_at"])
+
+	def test_rollups_are_kept_per_local_day_in_redis_hashes(self):
+		kolkata = pytz.timezone("Asia/Kolkata")
+		redis_client = _FakeRedis()
+		with patch("api.rollups._get_redis", return_value=redis_client):
+			# 20:00 UTC on Apr 30 is already May 1 in Kolkata.
+			record_device_daily_rollup(
+				self._device(1, kolkata),
+				datetime(2026, 4, 30, 20, 0, tzinfo=pytz.utc),
+				{"energy_consumed_this_day": 1.5},
+			)
+			record_device_daily_rollup(
+				self._device(1, kolkata),
+				datetime(2026, 4, 30, 21, 0, tzinfo=pytz.utc),
+				{"energy_generated_this_day": 2},
+			)
+			record_device_daily_rollup(
+				self._device(2),
+				datetime(2026, 4, 30, 20, 0, tzinfo=pytz.utc),
+				{"energy_consumed_this_day": 9},
+			)
+
+			summary = get_daily_summary({1: kolkata, 2: None}, day=datetime(2026, 5, 1).date())
+
+		self.assertEqual(summary["active_devices"], 1)
+		self.assertEqual(summary["total_energy_consumed_this_day"], 1.5)
+		self.assertEqual(summary["total_energy_generated_this_day"], 2.0)
+
+	def test_widget_summary_reads_each_device_for_its_local_day(self):
+		now = datetime(2026, 4, 30, 20, 0, tzinfo=pytz.utc)
+		kolkata = pytz.timezone("Asia/Kolkata")
+		new_york = pytz.timezone("America/New_York")
+		user = User(pk="00000000-0000-0000-0000-000000000001", username="owner", subnet_mask="192.168.1.0/15")
+		positions = {1: {"latitude": 28.6, "longitude": 77.2}, 2: {"latitude": 40.7, "longitude": -74.0}, 3: None}
+		devices = [
+			Mock(
+				pk=pk,
+				ip_address=f"192.168.1.{pk}",
+				ip_address_numeric=User.address_string_to_numeric(f"192.168.1.{pk}"),
+				active=True,
+				position=position,
+			)
+			for pk, position in positions.items()
+		]
+		timezone_names = {28.6: "Asia/Kolkata", 40.7: "America/New_York"}
+		with patch("device.models.device.cache", LocMemCache(f"user-devices-{uuid.uuid4()}", {})), \
+				patch("device.models.device.Device.objects") as device_objects, \
+				patch("device.models.device.get_timezone_name_at", side_effect=lambda lat, lng: timezone_names[lat]), \
+				patch("api.rollups._get_redis", return_value=_FakeRedis()), \
+				patch("api.rollups.timezone.now", return_value=now):
+			device_objects.filter.return_value.only.return_value = devices
+			# May 1 in Kolkata, Apr 30 in New York and UTC.
+			record_device_daily_rollup(self._device(1, kolkata), now, {"energy_consumed_this_day": 1})
+			record_device_daily_rollup(self._device(2, new_york), now, {"energy_consumed_this_day": 2})
+			record_device_daily_rollup(self._device(3), now, {"energy_consumed_this_day": 4})
+
+			device_timezones = user.device_timezones()
+			summary = get_daily_summary(device_timezones)
+
+		self.assertEqual(device_timezones, {1: kolkata, 2: new_york, 3: None})
+		self.assertEqual(summary["total_devices"], 3)
+		self.assertEqual(summary["active_devices"], 3)
+		self.assertEqual(summary["total_energy_consumed_this_day"], 7.0)
+
+
+class DeviceAlarmIndexTests(SimpleTestCase):
+	def _alarm(self, pk, typ_id, created_day, last_evaluation_match=False):
+		return Mock(
+			id=pk,
+			device_id=7,
+			typ_id=typ_id,
+			active=True,
+			last_evaluation_match=last_evaluation_match,
+			actions_config=[{"channel": "email"}],
+			created_at=datetime(2026, 5, created_day, tzinfo=pytz.utc),
+		)
+
+	def test_only_rules_for_snapshot_keys_run_and_transitions_are_written(self):
+		alarms = [self._alarm(1, 10, 1), self._alarm(2, 11, 2, last_evaluation_match=True), self._alarm(3, 12, 3)]
+		rules = {
+			10: {"status_key": "battery.voltage", "operator": "lt", "target_value": 11},
+			11: {"status_key": "battery.voltage", "operator": "gt", "target_value": 14},
+			12: {"status_key": "temperature", "operator": "gt", "target_value": 50},
+		}
+		device_event_model = Mock()
+		updates = Mock()
+		device_event_model.objects.filter.side_effect = lambda **kwargs: alarms if "device" in kwargs else updates
+		with patch("api.utils.cache", LocMemCache("alarm-index-tests", {})), \
+				patch("api.utils.DeviceEvent", device_event_model), \
+				patch("api.utils.EventHistory") as event_history_model, \
+				patch("api.utils._get_cached_alarm_type_ids", return_value=[10, 11, 12]), \
+				patch("api.utils._get_cached_event_type_alarm_rules", return_value=rules):
+			evaluate_device_status_alarms(Mock(id=7), {"battery": {"voltage": 10}})
+			evaluate_device_status_alarms(Mock(id=7), {"battery": {"voltage": 10.5}})
+
+		filter_calls = [call.kwargs for call in device_event_model.objects.filter.call_args_list]
+		# The index is built once, then only the two transitions of the first snapshot are written.
+		self.assertEqual(filter_calls, [{"device": 7, "active": True}, {"pk__in": [1]}, {"pk__in": [2]}])
+		self.assertTrue(updates.update.call_args_list[0].kwargs["last_evaluation_match"])
+		self.assertEqual(updates.update.call_args_list[1].kwargs, {"last_evaluation_match": False})
+		event_history_model.objects.create.assert_called_once()
+		self.assertEqual(event_history_model.objects.create.call_args.kwargs["device_event_id"], 1)
+		self.assertEqual(event_history_model.objects.create.call_args.kwargs["result"]["channels"], ["email"])
+
+	def test_index_falls_back_to_the_device_alarms_only(self):
+		inactive = self._alarm(2, 10, 2)
+		inactive.active = False
+		device_event_model = Mock()
+		device_event_model.objects.filter.side_effect = lambda **kwargs: (
+			self._raise(DatabaseError("boolean filter")) if "active" in kwargs else [self._alarm(1, 10, 1), inactive]
+		)
+		with patch("api.utils.DeviceEvent", device_event_model), \
+				patch("api.utils._get_cached_event_type_alarm_rules", return_value={
+					10: {"status_key": "temperature", "operator": "gt", "target_value": 50},
+				}):
+			index = _build_device_alarm_index(7, [10])
+
+		device_event_model.objects.all.assert_not_called()
+		self.assertEqual(device_event_model.objects.filter.call_args.kwargs, {"device": 7})
+		self.assertEqual([rule["alarm_id"] for rule in index["rules_by_key"]["temperature"]], [1])
+
+	def _raise(self, ex):
+		raise ex
+
+
+class CommandDispatcherTests(SimpleTestCase):
+	def test_pending_commands_are_published_in_one_batch_and_acks_tracked(self):
+		command_in_time = datetime(2026, 5, 1, 10, 0, tzinfo=pytz.utc)
+		commands = [
+			Mock(id=uuid.UUID(int=1), device_id=1, command="cmd-req", param="reboot", command_in_time=command_in_time),
+			Mock(id=uuid.UUID(int=2), device_id=2, command="update-trigger-group", param="", command_in_time=command_in_time),
+		]
+		devices = {1: Mock(alias="dev-1", ip_address="1.1.1.1"), 2: Mock(alias="dev-2", ip_address="1.1.1.2")}
+		configs = [
+			Mock(device_id=2, data={"mqtt_user": "u2", "group_id": "g2"}),
+			Mock(device_id=2, data={"mqtt_user": "old", "group_id": "old"}),
+		]
+		client = Mock()
+		client.publish.side_effect = [Mock(rc=0, mid=11), Mock(rc=0, mid=12)]
+		dispatcher = CommandDispatcher(client, batch_size=10, ack_timeout_seconds=0)
+		# The broker acknowledges the first publish before it was tracked.
+		dispatcher.on_publish(client, None, 11)
+
+		with patch("api.dispatch.CommandsModal") as command_model, \
+				patch("api.dispatch.Device") as device_model, \
+				patch("api.dispatch.DeviceConfig") as config_model, \
+				patch("api.dispatch.timezone.now", return_value=datetime(2026, 5, 1, 10, 0, 2, tzinfo=pytz.utc)):
+			command_model.objects.filter.return_value.order_by.return_value.__getitem__.return_value = commands
+			command_model.objects.filter.return_value.update.return_value = 2
+			device_model.objects.in_bulk.return_value = devices
+			config_model.objects.filter.return_value.order_by.return_value.only.return_value = configs
+			published = dispatcher.dispatch_pending()
+
+		self.assertEqual(published, 2)
+		topics = [call.args[0] for call in client.publish.call_args_list]
+		self.assertEqual(topics, ["/Devtest/devices/dev-1/cmd-req", "/u2/groups/g2/update-trigger"])
+		self.assertEqual(client.publish.call_args_list[0].args[2], 1)
+		command_model.objects.filter.return_value.update.assert_called_once()
+		self.assertEqual(command_model.objects.filter.call_args.kwargs, {"pk__in": [uuid.UUID(int=1), uuid.UUID(int=2)]})
+
+		stats = dispatcher.stats()
+		self.assertEqual(stats["acknowledged"], 1)
+		self.assertEqual(stats["inflight"], 1)
+		self.assertEqual(stats["command_to_ack_latency"]["buckets_ms"]["le_2500"], 1)
+		self.assertEqual(stats["command_to_ack_latency"]["buckets_ms"]["le_1000"], 0)
+
+		dispatcher.expire_unacknowledged()
+		self.assertEqual(dispatcher.stats()["unacknowledged"], 1)
+		self.assertEqual(dispatcher.stats()["inflight"], 0)
+
+	def test_commands_of_missing_devices_are_failed_oldest_first(self):
+		command_in_time = datetime(2026, 5, 1, 10, 0, tzinfo=pytz.utc)
+		commands = [
+			Mock(id=uuid.UUID(int=index), device_id=index, command="cmd-req", param="", command_in_time=command_in_time)
+			for index in (1, 2)
+		]
+		client = Mock()
+		dispatcher = CommandDispatcher(client, batch_size=2, ack_timeout_seconds=0)
+
+		with patch("api.dispatch.CommandsModal") as command_model, \
+				patch("api.dispatch.Device") as device_model, \
+				patch("api.dispatch.DeviceConfig"), \
+				patch("api.dispatch.pending_command_event") as pending_event:
+			command_model.objects.filter.return_value.order_by.return_value.__getitem__.return_value = commands
+			command_model.objects.filter.return_value.update.return_value = 0
+			device_model.objects.in_bulk.return_value = {}
+			published = dispatcher.dispatch_pending()
+
+		self.assertEqual(published, 0)
+		client.publish.assert_not_called()
+		command_model.objects.filter.return_value.order_by.assert_called_once_with("command_in_time")
+		command_model.objects.filter.return_value.update.assert_called_once_with(status="F")
+		# Nothing left 'P', a full batch does not trigger another round.
+		pending_event.set.assert_not_called()
+
+
+class CommandResponseCorrelationTests(SimpleTestCase):
+	def test_short_id_is_resolved_through_the_publish_index(self):
+		command = Mock(id=uuid.UUID(int=0xABCDEF1234), device_id=3)
+		device = Mock(id=3, alias="dev-3")
+		with patch("api.dispatch.cache", LocMemCache("command-index-tests", {})) as index_cache, \
+				patch("api.management.commands.mqtt.CommandsModal") as command_model:
+			index_sent_commands([command])
+			command_model.objects.filter.return_value.first.return_value = command
+			found = MqttListenerCommand().find_command_for_response(device, command.id.hex[-10:].upper(), "reboot")
+
+			self.assertIs(found, command)
+			self.assertEqual(
+				command_model.objects.filter.call_args.kwargs,
+				{"pk": command.id, "device": device, "status__in": ["S"]},
+			)
+			self.assertEqual(len(index_cache._cache), 1)
+
+	def test_unindexed_short_id_does_not_scan_sent_commands(self):
+		device = Mock(id=3, alias="dev-3")
+		with patch("api.dispatch.cache", LocMemCache("command-index-miss-tests", {})), \
+				patch("api.management.commands.mqtt.CommandsModal") as command_model:
+			found = MqttListenerCommand().find_command_for_response(device, "0123456789", "reboot")
+
+		self.assertIsNone(found)
+		command_model.objects.filter.assert_not_called()
+
+	def test_chunked_response_is_assembled_in_part_order(self):
+		listener = MqttListenerCommand()
+		command = Mock(id=uuid.UUID(int=5), response=None)
+		with patch("api.management.commands.mqtt.cache", LocMemCache("command-chunk-tests", {})) as chunk_cache:
+			self.assertEqual(
+				listener.build_chunked_command_response(command, {"part": 1, "parts_total": 3}, "b"),
+				(None, False),
+			)
+			listener.build_chunked_command_response(command, {"part": 0, "parts_total": 3}, "a")
+			# A retransmitted part is not counted twice.
+			self.assertEqual(
+				listener.build_chunked_command_response(command, {"part": 0, "parts_total": 3}, "a"),
+				(None, False),
+			)
+			self.assertEqual(
+				listener.build_chunked_command_response(command, {"part": 2, "parts_total": 3}, "c"),
+				("abc", True),
+			)
+			listener.clear_command_response_state(command)
+			self.assertEqual(len(chunk_cache._cache), 0)
+
+
+class DeviceLookupCacheTests(SimpleTestCase):
+	def test_devices_are_served_from_process_cache_until_saved(self):
+		device_cache = DeviceLookupCache(max_size=2, ttl_seconds=60)
+		device = Device(id=uuid.UUID(int=1), mac="aa:bb", alias="dev-1", numeric_id=7)
+		loader = Mock(return_value=device)
+
+		with patch.object(device_cache, "_ensure_listener"), patch.object(device_cache, "_publish_invalidation") as publish:
+			first = device_cache.get(("mac", "aa:bb"), loader)
+			first.other_data = {"changed": True}
+			second = device_cache.get(("mac", "aa:bb"), loader)
+			device_cache.get(("numeric_id", "7"), loader)
+
+			self.assertEqual(loader.call_count, 2)
+			self.assertIsNone(second.other_data)
+			self.assertEqual(device_cache.stats()["hits"], 1)
+			self.assertEqual(device_cache.stats()["misses"], 2)
+
+			# A saved device replaces the cached copies, keys it no longer matches are dropped.
+			device.mac = "cc:dd"
+			device.other_data = {"saved": True}
+			device_cache.refresh(device)
+			publish.assert_called_once_with(device.pk)
+			self.assertEqual(device_cache.get(("numeric_id", "7"), loader).other_data, {"saved": True})
+			device_cache.get(("mac", "aa:bb"), loader)
+			self.assertEqual(loader.call_count, 3)
+
+			device_cache.get(("group_alias", "Devtest", "dev-1"), loader)
+			self.assertEqual(device_cache.stats()["size"], 2)
+
+			device_cache.invalidate(device.pk)
+			self.assertEqual(device_cache.stats()["size"], 0)
+
+	def test_http_heartbeat_resolves_devices_through_the_cache(self):
+		device_cache = DeviceLookupCache(max_size=2, ttl_seconds=60)
+		device = Device(id=uuid.UUID(int=2), mac="aa:cc", other_data={"last_data_sync_time": "2000-01-01T00:00:00Z"})
+		request = SimpleNamespace(data={"mac": "aa:cc"})
+
+		with patch.object(device_cache, "_ensure_listener"), \
+				patch("api.viewsets.device_details_views.device_cache", device_cache), \
+				patch("api.viewsets.device_details_views.device_state_writer"), \
+				patch("api.viewsets.device_details_views.merge_device_other_data"), \
+				patch.object(Device.objects, "filter") as device_filter:
+			device_filter.return_value.first.return_value = device
+			HeartbeatViewSet().post(request)
+			response = HeartbeatViewSet().post(request)
+
+		device_filter.assert_called_once_with(mac="aa:cc")
+		self.assertEqual(response.data, "SYNC [0] {0}")
+
+
+class _FakeRedis:
+	def __init__(self):
+		self.hashes = {}
+		self.sets = {}
+
+	def pipeline(self, transaction=True):
+		return _FakeRedisPipeline(self)
+
+	def hset(self, key, mapping):
+		self.hashes.setdefault(key, {}).update({field.encode(): str(value).encode() for field, value in mapping.items()})
+
+	def expire(self, key, seconds):
+		pass
+
+	def sadd(self, key, *values):
+		self.sets.setdefault(key, set()).update(value.encode() for value in values)
+
+	def spop(self, key, count):
+		members = self.sets.get(key, set())
+		return [members.pop() for _ in range(min(count, len(members)))]
+
+	def hgetall(self, key):
+		return dict(self.hashes.get(key, {}))
+
+
+class _FakeRedisPipeline:
+	def __init__(self, redis_client):
+		self.redis_client = redis_client
+		self.calls = []
+
+	def __getattr__(self, name):
+		return lambda *args, **kwargs: self.calls.append(getattr(self.redis_client, name)(*args, **kwargs))
+
+	def execute(self):
+		calls, self.calls = self.calls, []
+		return calls
+
+
+class DeviceStateWriterTests(SimpleTestCase):
+	@patch("api.buffers.device_cache")
+	@patch("api.buffers.Device")
+	def test_volatile_fields_are_read_fresh_and_flushed_once(self, device_model, device_cache):
+		device_pk = uuid.UUID(int=9)
+		writer = DeviceStateWriter(flush_interval_seconds=60)
+		writer._redis, writer._redis_checked = _FakeRedis(), True
+		stored_device = Mock(pk=device_pk, other_data={"keep": True, "last_heartbeat_time": "t0"})
+		device_queryset = Mock()
+		device_model.objects.filter.side_effect = lambda **lookup: [stored_device] if "pk__in" in lookup else device_queryset
+
+		with patch.object(writer, "_ensure_flusher"):
+			writer.record(device_pk, {"last_heartbeat_time": "t1"})
+			writer.record_many({device_pk: {"last_heartbeat_time": "t2", "voltage": 230.5}})
+
+		self.assertFalse(device_model.objects.filter.called)
+		reader = Mock(pk=device_pk, other_data={"keep": True, "last_heartbeat_time": "t0"})
+		writer.merge_into([reader])
+		self.assertEqual(reader.other_data, {"keep": True, "last_heartbeat_time": "t2", "voltage": 230.5})
+
+		self.assertEqual(writer.flush(), 1)
+		device_queryset.update.assert_called_once_with(
+			other_data={"keep": True, "last_heartbeat_time": "t2", "voltage": 230.5},
+			updated_at=ANY,
+		)
+		self.assertEqual(writer.flush(), 0)
+
+	@patch("api.buffers.device_cache")
+	@patch("api.buffers.Device")
+	def test_devices_saved_during_a_flush_are_merged_again(self, device_model, device_cache):
+		device_pk = uuid.UUID(int=10)
+		writer = DeviceStateWriter(flush_interval_seconds=60)
+		writer._redis, writer._redis_checked = _FakeRedis(), True
+		reads = iter([
+			Mock(pk=device_pk, other_data={"keep": True}, updated_at="t0"),
+			Mock(pk=device_pk, other_data={"keep": True, "saved": True}, updated_at="t1"),
+		])
+		device_queryset = Mock()
+		device_queryset.update.side_effect = [0, 1]
+		device_model.objects.filter.side_effect = lambda **lookup: [next(reads)] if "pk__in" in lookup else device_queryset
+
+		with patch.object(writer, "_ensure_flusher"):
+			writer.record(device_pk, {"last_heartbeat_time": "t2"})
+			self.assertEqual(writer.flush(), 1)
+
+		self.assertEqual(
+			[call.kwargs for call in device_model.objects.filter.call_args_list if "updated_at" in call.kwargs],
+			[{"pk": device_pk, "updated_at": "t0"}, {"pk": device_pk, "updated_at": "t1"}],
+		)
+		self.assertEqual(
+			device_queryset.update.call_args.kwargs["other_data"],
+			{"keep": True, "saved": True, "last_heartbeat_time": "t2"},
+		)
+
+		# A device that keeps changing is left dirty for the next flush.
+		device_queryset.update.side_effect = None
+		device_queryset.update.return_value = 0
+		device_model.objects.filter.side_effect = lambda **lookup: (
+			[Mock(pk=device_pk, other_data={}, updated_at="t3")] if "pk__in" in lookup else device_queryset
+		)
+		with patch.object(writer, "_ensure_flusher"):
+			writer.record(device_pk, {"last_heartbeat_time": "t4"})
+			self.assertEqual(writer.flush(), 0)
+		self.assertEqual(writer._redis.sets[DeviceStateWriter.DIRTY_KEY], {str(device_pk).encode()})
+
+
+class MovingWindowRateLimiterTests(SimpleTestCase):
+	def test_in_process_window_admits_exactly_the_limit_under_concurrency(self):
+		limiter = MovingWindowRateLimiter(window_seconds=60, max_requests=25)
+		results = []
+		lock = threading.Lock()
+
+		def worker():
+			for _ in range(20):
+				allowed = limiter.is_allowed("user:1")[0]
+				with lock:
+					results.append(allowed)
+
+		with patch("api.throttling._get_moving_window_script", return_value=None):
+			threads = [threading.Thread(target=worker) for _ in range(8)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+			allowed, count, reset_in = limiter.is_allowed("user:1")
+
+		self.assertEqual(results.count(True), 25)
+		self.assertEqual((allowed, count), (False, 25))
+		self.assertLessEqual(reset_in, 61)
+
+	def test_redis_script_decides_in_one_call(self):
+		script = Mock(return_value=[0, 10, 42])
+		limiter = MovingWindowRateLimiter(window_seconds=60, max_requests=10)
+		with patch("api.throttling._get_moving_window_script", return_value=script):
+			self.assertEqual(limiter.is_allowed("device:7"), (False, 10, 42))
+
+		self.assertEqual(script.call_args.kwargs["keys"], ["rate_limit:zset:device:7"])
+		self.assertEqual(script.call_args.kwargs["args"][1:3], [60, 10])
+
+
+class SocketIngestionTests(SimpleTestCase):
+	def test_data_frame_is_acked_and_handed_to_background_ingest(self):
+		device = Mock(pk=1, numeric_id=5)
+		device.get_cached_command.return_value = None
+		ingest = Mock()
+		frame = '{"config": {"mac": "aa:bb", "devId": 5}, "meter_1": {"power": 10}}'
+		with patch("api.socket_consumers.device_cache") as device_cache, \
+				patch("api.socket_consumers.process_raw_data") as process_raw_data:
+			device_cache.get.return_value = device
+			resp = process_device_message_sync(frame, ingest=ingest)
+
+		self.assertEqual(resp, "OK")
+		self.assertFalse(process_raw_data.called)
+		ingest.assert_called_once()
+		self.assertIs(ingest.call_args.args[0], device)
+		self.assertEqual(ingest.call_args.args[1]["meter_1"], {"power": 10})
+
+	def test_frames_of_a_full_device_queue_are_ingested_inline(self):
+		device = Mock(pk=1, numeric_id=5)
+		device.get_cached_command.return_value = None
+		pool = Mock()
+		pool.submit.return_value = False
+		frame = '{"config": {"mac": "aa:bb", "devId": 5}, "meter_1": {"power": 10}}'
+		with patch("api.socket_consumers.device_cache") as device_cache, \
+				patch("api.socket_consumers.get_socket_ingest_pool", return_value=pool), \
+				patch("api.socket_consumers.process_raw_data") as process_raw_data:
+			device_cache.get.return_value = device
+			inline_frames = socket_ingest_stats()["inline_frames"]
+			resp = process_device_message_sync(frame, ingest=queue_socket_frame)
+
+		self.assertEqual(resp, "OK")
+		self.assertEqual(socket_ingest_stats()["inline_frames"], inline_frames + 1)
+		self.assertEqual(pool.submit.call_args.kwargs["timeout"], 0.05)
+		process_raw_data.assert_called_once()
+		self.assertIs(process_raw_data.call_args.args[0], device)
+		self.assertEqual(process_raw_data.call_args.kwargs, {"channel": "socket", "data_type": "data"})
+
+	def test_receive_to_ack_latency_is_recorded_per_connection(self):
+		consumer = InputDataConsumer()
+		consumer.room_group_name = "device_test"
+		consumer.frames, consumer.ack_seconds_total, consumer.ack_seconds_max = 0, 0.0, 0.0
+		sent = []
+
+		async def send(text_data):
+			sent.append(text_data)
+
+		consumer.send = send
+		with patch("api.socket_consumers.process_device_message_sync", return_value="HEARTBEAT_ACK [1]") as process, \
+				patch("api.socket_consumers.close_old_connections"):
+			asyncio.run(consumer.receive("HEARTBEAT [0] [aa:bb]"))
+
+		self.assertEqual(sent, ["HEARTBEAT_ACK [1]"])
+		self.assertIsNotNone(process.call_args.kwargs["ingest"])
+		self.assertEqual(consumer.frames, 1)
+		self.assertGreater(consumer.ack_seconds_max, 0)
+
+
+class RawDataStoreTests(SimpleTestCase):
+	def _utc(self, hour, minute=0):
+		return datetime(2026, 3, 1, hour, minute, tzinfo=dt_timezone.utc)
+
+	def test_bucket_holds_columns_of_the_window_in_time_order(self):
+		bucket = build_raw_data_bucket(
+			"device-1",
+			"meters-data",
+			self._utc(10),
+			[
+				(self._utc(10, 30), "mqtt", '{"meter": {"power": 5, "on": true}, "state": "ON"}'),
+				(self._utc(10, 0), "http", {"meter": {"power": 3, "energy": 1.5}}),
+			],
+			compacted_at=self._utc(11, 5),
+		)
+
+		self.assertEqual(bucket.offsets, [0, 30 * 60 * 1000000])
+		self.assertEqual(bucket.channels, ["http", "mqtt"])
+		self.assertEqual(bucket.sample_count, 2)
+		self.assertEqual(bucket.first_arrival_time, self._utc(10, 0))
+		self.assertEqual(bucket.last_arrival_time, self._utc(10, 30))
+		self.assertEqual(bucket.values, {"meter.power": [3, 5], "meter.energy": [1.5, None]})
+		self.assertEqual(bucket.field_names, ["meter", "meter.power", "meter.energy", "meter.on", "state"])
+		self.assertEqual(bucket.payloads[1], {"meter": {"power": 5, "on": True}, "state": "ON"})
+		self.assertIsNone(build_raw_data_bucket("device-1", "meters-data", self._utc(10), []))
+
+	def test_extract_and_project_fields(self):
+		values, names = extract_fields({"a": {"b": 1, "c": False, "d": {"e": {"f": 2}}}, "g": "x"})
+
+		self.assertEqual(values, {"a.b": 1})
+		self.assertEqual(names, ["a", "a.b", "a.c", "a.d", "a.d.e", "g"])
+		data = {"a": {"b": 1, "c": [1, 2]}, "g": "x"}
+		self.assertEqual(project_data(data, ["a.c", "missing.path"]), {"a": {"c": [1, 2]}})
+		self.assertIs(project_data(data, None), data)
+
+	@override_settings(RAW_DATA_STORAGE_LAYOUT="buckets", RAW_DATA_BUCKET_SECONDS=3600)
+	@patch("device.raw_data_store.RawDataBucket")
+	@patch("device.raw_data_store._iter_bucket_pages")
+	@patch("device.raw_data_store._iter_documents")
+	def test_reads_windows_without_buckets_from_documents(self, iter_documents, iter_bucket_pages, bucket_model):
+		def documents(device, data_type, start_time, end_time, include_end, fields, descending, limit=None):
+			yield RawDataPoint(start_time, "mqtt", data_type, {"from": [start_time.hour, end_time.hour]})
+
+		iter_documents.side_effect = documents
+		iter_bucket_pages.side_effect = lambda queryset, descending: iter([{
+			"id": "bucket-1",
+			"bucket_start": self._utc(10),
+			"offsets": [0, 15 * 60 * 1000000],
+			"channels": ["mqtt", "mqtt"],
+			"values": {"meter.power": [3, None]},
+			"field_names": ["meter.power"],
+		}])
+
+		points = list(iter_raw_data(
+			"device-1", data_type="meters-data", start_time=self._utc(9, 30), end_time=self._utc(11, 30),
+			fields=["meter.power"],
+		))
+
+		self.assertEqual([point.data_arrival_time for point in points], [
+			self._utc(9, 30), self._utc(10, 0), self._utc(10, 15), self._utc(11, 0),
+		])
+		self.assertEqual([point.data for point in points], [
+			{"from": [9, 10]}, {"meter": {"power": 3}}, {}, {"from": [11, 11]},
+		])
+		bucket_model.objects.filter.return_value.values_list.assert_not_called()
+		self.assertEqual(
+			[call.args[2:5] for call in iter_documents.call_args_list],
+			[(self._utc(9, 30), self._utc(10), False), (self._utc(11), self._utc(11, 30), False)],
+		)
+
+	@override_settings(RAW_DATA_STORAGE_LAYOUT="buckets")
+	@patch("device.raw_data_store._iter_buckets")
+	@patch("device.raw_data_store._iter_documents")
+	def test_limited_reads_use_documents(self, iter_documents, iter_buckets):
+		iter_documents.return_value = iter([RawDataPoint(self._utc(10), "mqtt", "weather", {})])
+
+		points = list(iter_raw_data("device-1", data_type="weather", descending=True, limit=1))
+
+		self.assertEqual(len(points), 1)
+		iter_buckets.assert_not_called()
+
+	@override_settings(RAW_DATA_STORAGE_LAYOUT="buckets")
+	@patch("api.buffers.cache", LocMemCache("raw-data-bucket-tests", {}))
+	@patch("api.buffers.compact_raw_data_window")
+	def test_compactor_compacts_closed_windows_once(self, compact_raw_data_window):
+		compactor = RawDataBucketCompactor(bucket_seconds=3600, grace_seconds=300)
+		compactor._ensure_worker = Mock()
+		compactor.note([
+			Mock(device_id="a", data_type="meters-data", data_arrival_time=self._utc(10, 5)),
+			Mock(device_id="a", data_type="meters-data", data_arrival_time=self._utc(10, 50)),
+			Mock(device_id="a", data_type="meters-data", data_arrival_time=self._utc(11, 1)),
+		])
+
+		self.assertEqual(compactor.pending_count(), 2)
+		self.assertEqual(compactor.compact_due(now=self._utc(11, 4)), 0)
+		self.assertEqual(compactor.compact_due(now=self._utc(11, 6)), 1)
+		compact_raw_data_window.assert_called_once_with("a", "meters-data", self._utc(10), bucket_seconds=3600)
+		compact_raw_data_window.side_effect = RuntimeError("mongo down")
+		self.assertEqual(compactor.compact_due(now=self._utc(12, 6)), 0)
+		self.assertEqual(compactor.stats(), {"pending_windows": 1, "windows_compacted": 1, "failed_compactions": 1})
+
+	@override_settings(RAW_DATA_STORAGE_LAYOUT="buckets")
+	@patch("api.buffers.compact_raw_data_window")
+	def test_windows_locked_elsewhere_are_kept_and_locks_are_released(self, compact_raw_data_window):
+		compactor_cache = LocMemCache(f"raw-data-bucket-{uuid.uuid4()}", {})
+		compactor = RawDataBucketCompactor(bucket_seconds=3600, grace_seconds=300)
+		compactor._ensure_worker = Mock()
+		lock_key = f"{RawDataBucketCompactor.LOCK_KEY_PREFIX}a:meters-data:{self._utc(10).isoformat()}"
+		row = Mock(device_id="a", data_type="meters-data", data_arrival_time=self._utc(10, 5))
+
+		with patch("api.buffers.cache", compactor_cache):
+			compactor_cache.set(lock_key, "other-process")
+			compactor.note([row])
+			self.assertEqual(compactor.compact_due(now=self._utc(11, 6)), 0)
+			self.assertEqual(compactor.pending_count(), 1)
+
+			compactor_cache.delete(lock_key)
+			self.assertEqual(compactor.compact_due(now=self._utc(11, 7)), 1)
+			self.assertIsNone(compactor_cache.get(lock_key))
+
+			# Rows noted after a compaction have the window compacted again.
+			compactor.note([row])
+			self.assertEqual(compactor.compact_due(now=self._utc(11, 8)), 1)
+		self.assertEqual(compact_raw_data_window.call_count, 2)
+
+
+class StatisticsSourcePlanTests(SimpleTestCase):
+	def test_closed_days_and_hours_come_from_the_views(self):
+		segments = plan_statistics_sources(
+			datetime(2026, 3, 1, 18, 30, tzinfo=pytz.utc),
+			datetime(2026, 3, 4, 18, 30, tzinfo=pytz.utc),
+			datetime(2026, 3, 4, 12, 20, tzinfo=pytz.utc),
+		)
+
+		self.assertEqual(segments, [
+			("meterdata", datetime(2026, 3, 1, 18, 30), datetime(2026, 3, 1, 19)),
+			("meterdata_hourly", datetime(2026, 3, 1, 19), datetime(2026, 3, 2)),
+			("meterdata_daily", datetime(2026, 3, 2), datetime(2026, 3, 4)),
+			("meterdata_hourly", datetime(2026, 3, 4), datetime(2026, 3, 4, 12)),
+			("meterdata", datetime(2026, 3, 4, 12), datetime(2026, 3, 4, 18, 30)),
+		])
+
+	def test_hourly_grouping_and_open_hour(self):
+		now = datetime(2026, 3, 4, 12, 20, tzinfo=pytz.utc)
+
+		self.assertEqual(
+			plan_statistics_sources(datetime(2026, 3, 2), datetime(2026, 3, 3), now, use_daily=False),
+			[("meterdata_hourly", datetime(2026, 3, 2), datetime(2026, 3, 3))],
+		)
+		self.assertEqual(
+			plan_statistics_sources(datetime(2026, 3, 4, 12, 5), datetime(2026, 3, 4, 12, 10), now),
+			[("meterdata", datetime(2026, 3, 4, 12, 5), datetime(2026, 3, 4, 12, 10))],
+		)
+		self.assertEqual(plan_statistics_sources(datetime(2026, 3, 4), datetime(2026, 3, 4), now), [])
+
+	def test_query_merges_the_states_of_every_segment(self):
+		query, params = build_statistics_query(
+			["meter-1"],
+			[
+				("meterdata_daily", datetime(2026, 3, 2), datetime(2026, 3, 4)),
+				("meterdata", datetime(2026, 3, 4, 12), datetime(2026, 3, 4, 12, 30)),
+			],
+			"toDate(bucket)",
+		)
+
+		self.assertEqual(query.count("union all"), 1)
+		self.assertIn("from meterdata_daily", query)
+		self.assertIn("countState() as state_data_points", query)
+		self.assertIn("avgMerge(state_avg_power) as avg_power", query)
+		self.assertIn("toDate(bucket) as aggregation_time", query)
+		self.assertIn("data.data_arrival_time >= {start_1:DateTime('UTC')}", query)
+		self.assertIn("toStartOfHour(data.data_arrival_time, 'UTC') as bucket", query)
+		self.assertEqual(params["meter_ids"], ["meter-1"])
+		self.assertEqual(params["end_0"], datetime(2026, 3, 4))
+
+	def test_each_view_is_backfilled_up_to_a_cutoff_taken_after_it_exists(self):
+		migration = importlib.import_module("device.clickhouse_migrations.0003_meterdata_statistics_views")
+		statements = []
+		database = Mock()
+		database.raw.side_effect = statements.append
+		clock = iter([datetime(2026, 3, 4, 12, 0, 0, 500000), datetime(2026, 3, 4, 12, 0, 7)])
+
+		def now(tz):
+			statements.append("now")
+			return next(clock)
+
+		with patch.object(migration, "datetime", Mock(now=now)):
+			migration.create_statistics_views(database)
+
+		kinds = [
+			"now" if statement == "now" else statement.split("$db.")[1].split()[0]
+			for statement in statements
+		]
+		self.assertEqual(kinds, [
+			"meterdata_hourly", "meterdata_hourly_mv", "now", "meterdata_hourly",
+			"meterdata_daily", "meterdata_daily_mv", "now", "meterdata_daily",
+		])
+		self.assertIn("data_arrival_time < toDateTime('2026-03-04 12:00:01', 'UTC')", statements[3])
+		self.assertIn("data_arrival_time < toDateTime('2026-03-04 12:00:08', 'UTC')", statements[7])
+		self.assertIn("bucket DateTime('UTC')", statements[0])
+		self.assertIn("toStartOfHour(data_arrival_time, 'UTC') AS bucket", statements[1])
+		self.assertIn("toStartOfDay(data_arrival_time, 'UTC') AS bucket", statements[7])
+
+	def test_meterload_rows_inserted_during_the_copy_are_carried_over(self):
+		migration = importlib.import_module("device.clickhouse_migrations.0004_meterload_sort_key")
+		database = Mock()
+		counts = {"$db.meterload": "11\n", "$db.meterload_unsorted": "12\n"}
+		database.raw.side_effect = lambda query: (
+			"device\n" if "system.tables" in query
+			else "1777629600\n" if "max(data_arrival_time)" in query
+			else counts[query.split("FROM ")[1]] if query.startswith("SELECT count()")
+			else ""
+		)
+
+		with self.assertLogs("django", level="WARNING"):
+			migration.resort_meterload(database)
+
+		queries = [call.args[0] for call in database.raw.call_args_list]
+		rename = next(index for index, query in enumerate(queries) if query.startswith("RENAME TABLE"))
+		self.assertEqual(
+			queries[rename + 1],
+			"INSERT INTO $db.meterload SELECT * FROM $db.meterload_unsorted\n"
+			"WHERE data_arrival_time > toDateTime(1777629600)",
+		)
+		self.assertFalse(any("DROP TABLE $db.meterload_unsorted" in query for query in queries))
+
+
+def _row_binary_string(value):
+	data = value.encode("utf-8")
+	return bytes([len(data)]) + data
+
+
+class ClickHouseQueryClientTests(SimpleTestCase):
+	def _client(self, body, chunk=7):
+		client = ClickHouseQueryClient("http://clickhouse:8123", "iot")
+		response = Mock(status_code=200)
+		response.iter_content.return_value = [body[index:index + chunk] for index in range(0, len(body), chunk)]
+		client.session = Mock()
+		client.session.post.return_value = response
+		return client, response
+
+	def _header(self, columns):
+		return (
+			bytes([len(columns)])
+			+ b"".join(_row_binary_string(name) for name, _ in columns)
+			+ b"".join(_row_binary_string(type_name) for _, type_name in columns)
+		)
+
+	def test_rows_are_decoded_from_a_chunked_stream(self):
+		meter = uuid.UUID("12345678-1234-5678-1234-567812345678")
+		body = self._header([
+			("meter", "UUID"), ("time", "DateTime('UTC')"), ("power", "Float64"), ("note", "Nullable(String)"),
+		])
+		for power, note in ((1.5, "on"), (2.25, None)):
+			body += struct.pack("<QQ", meter.int >> 64, meter.int & (2 ** 64 - 1))
+			body += struct.pack("<I", 1772323200)
+			body += struct.pack("<d", power)
+			body += b"\x01" if note is None else b"\x00" + _row_binary_string(note)
+		client, response = self._client(body)
+
+		rows = list(client.iter_rows(
+			"select meter, time, power, note from meterdata where meter = {meter:UUID}", {"meter": meter},
+		))
+
+		self.assertEqual([(row.meter, row.power, row.note) for row in rows], [(meter, 1.5, "on"), (meter, 2.25, None)])
+		self.assertEqual(rows[0].time, datetime(2026, 3, 1, tzinfo=pytz.utc))
+		self.assertEqual(client.session.post.call_args.kwargs["params"]["param_meter"], str(meter))
+		self.assertTrue(client.session.post.call_args.kwargs["data"].endswith(b"FORMAT RowBinaryWithNamesAndTypes"))
+		response.close.assert_called_once()
+
+	def test_fixed_width_columns_are_read_into_arrays(self):
+		body = self._header([("time", "DateTime"), ("energy", "Float64")])
+		for index in range(5):
+			body += struct.pack("<Id", 1772323200 + index * 60, index * 0.5)
+		client, _ = self._client(body, chunk=5)
+
+		arrays = client.select_arrays("select time, energy from meterdata", max_rows_per_read=2)
+
+		np.testing.assert_array_equal(arrays["energy"], [0, 0.5, 1.0, 1.5, 2.0])
+		self.assertEqual(arrays["time"][1], np.datetime64("2026-03-01T00:01:00"))
+		self.assertEqual(client.stats()["rows_read"], 5)
+
+	def test_parameters_are_escaped(self):
+		self.assertEqual(format_parameter(["a'b", 2, None]), "['a\\'b',2,NULL]")
+		self.assertEqual(format_parameter("tab\tline"), "tab\\tline")
+		self.assertEqual(format_parameter(pytz.timezone("Asia/Kolkata").localize(datetime(2026, 3, 1, 5, 30))), "2026-03-01 00:00:00")
+
+
+class ApplianceUsageTests(SimpleTestCase):
+	@patch("utils.dev_data.CLICKHOUSE_ENABLED", True)
+	@patch("utils.dev_data.get_query_client", create=True)
+	def test_usage_is_aggregated_per_equipment_of_the_device(self, get_query_client):
+		row_type = namedtuple("Row", ["equipment_name", "seconds", "energy"])
+		get_query_client.return_value.iter_rows.return_value = iter([
+			row_type("Fan", 5400, 5400 * 60.0),
+			row_type("AC", 600, 600 * 1500.0),
+		])
+		reports = DataReports.__new__(DataReports)
+		reports.device = Mock(id=uuid.uuid4())
+		reports.device.get_timezone.return_value = None
+		reports.device.get_all_equipments.return_value = [Mock(equipment=Mock()), Mock(equipment=Mock())]
+		reports.device.get_all_equipments.return_value[0].equipment.name = "Fan"
+		reports.device.get_all_equipments.return_value[1].equipment.name = "AC"
+		reports.rate = Mock(get_value=Mock(return_value=8.0))
+
+		usage = reports.get_appliances_current_day()
+
+		query, params = get_query_client.return_value.iter_rows.call_args.args
+		self.assertIn("partition by equipment_name", query)
+		self.assertEqual(params["device_id"], reports.device.id)
+		self.assertEqual(params["equipment_names"], ["Fan", "AC"])
+		self.assertEqual((params["max_gap_seconds"], params["substitute_gap_seconds"]), (1000, 300))
+		self.assertEqual(params["to_time"] - params["from_time"], timedelta(days=1))
+		self.assertEqual(usage["Fan"], {"seconds": 5400, "energy": 0.09, "money": 0.72, "hours": 1, "minutes": 30})
+		self.assertAlmostEqual(usage["AC"]["energy"], 0.25)
+
+
+class LoadDetectionBatchTests(SimpleTestCase):
+	def _equipment(self, name, min_power, max_power):
+		return SimpleNamespace(equipment=SimpleNamespace(name=name, min_power=min_power, max_power=max_power))
+
+	def test_batch_matches_the_per_point_loop(self):
+		randomizer = np.random.default_rng(7)
+		names = sorted(load_model.targets) + ["Unknown", "Fan"]
+		equipments = [
+			self._equipment(name, int(randomizer.integers(0, 100)), int(randomizer.integers(100, 1500)))
+			for name in names
+		]
+		start = datetime(2025, 1, 1)
+		points = [
+			(
+				{
+					"data_arrival_time": start + timedelta(minutes=int(randomizer.integers(0, 500000))),
+					"power": float(randomizer.uniform(0, 8000)),
+				},
+				float(randomizer.uniform(-50, 450)),
+				float(randomizer.uniform(0, 100)),
+				float(randomizer.uniform(0, 40)),
+			)
+			for _ in range(300)
+		]
+		points.append(({"data_arrival_time": start, "power": 2500, "temperature": 300}, 0, 0, 0))
+
+		loads = get_load_data_ai_batch(points, equipments)
+
+		expected = [get_load_data_ai(None, data_point, equipments, *weather) for data_point, *weather in points]
+		self.assertEqual(loads, expected)
+		self.assertTrue(any(loads))
+
+	def test_remaining_power_is_allocated_in_equipment_order(self):
+		model = LinearRegression()
+		model.coef_ = np.array([0, 0, 0, 0, 0.001, 0, 0, 0])
+		model.intercept_ = 1.0
+		equipments = [self._equipment("Heater", 400, 600), self._equipment("Heater", 400, 600)]
+		points = [
+			({"data_arrival_time": datetime(2025, 1, 1), "power": 2000}, 0, 0, 0),
+			({"data_arrival_time": datetime(2025, 1, 1), "power": None}, 0, 0, 0),
+		]
+
+		with patch("utils.load_detection.load_model", SimpleNamespace(targets={"Heater": model})):
+			loads = get_load_data_ai_batch(points, equipments)
+			expected = [get_load_data_ai(None, data_point, equipments, *weather) for data_point, *weather in points]
+
+		self.assertEqual(loads, [
+			[{"name": "Heater", "qty": 3, "power": 1500.0}, {"name": "Heater", "qty": 1, "power": 500.0}],
+			[],
+		])
+		self.assertEqual(loads, expected)
+
+
+class ModelRegistryTests(SimpleTestCase):
+	def setUp(self):
+		self.dir_path = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.dir_path)
+
+	def _write(self, name, model, mtime_ns):
+		path = os.path.join(self.dir_path, name + ".coef")
+		with open(path, "wb") as model_file:
+			pickle.dump(model, model_file)
+		os.utime(path, ns=(mtime_ns, mtime_ns))
+
+	def test_models_are_read_on_first_use_and_again_when_a_file_changes(self):
+		self._write("Fan", {"version": 1}, 10 ** 18)
+		registry = ModelRegistry(self.dir_path, check_interval=0)
+		self.assertEqual(registry.reads, 0)
+
+		targets = registry.targets
+		self.assertEqual(targets, {"Fan": {"version": 1}})
+		self.assertIs(registry.targets, targets)
+		self.assertEqual(registry.reads, 1)
+
+		self._write("Fan", {"version": 2}, 10 ** 18 + 1)
+		self._write("AC", {"version": 1}, 10 ** 18)
+		self.assertEqual(registry.targets, {"Fan": {"version": 2}, "AC": {"version": 1}})
+		self.assertEqual(registry.reads, 2)
+
+	def test_models_are_kept_when_a_changed_file_cannot_be_read(self):
+		self._write("Fan", {"version": 1}, 10 ** 18)
+		registry = ModelRegistry(self.dir_path, check_interval=0)
+		targets = registry.targets
+		with open(os.path.join(self.dir_path, "Fan.coef"), "wb") as model_file:
+			model_file.write(b"\x80")
+
+		self.assertIs(registry.targets, targets)
+		self.assertEqual(registry.reads, 1)
+
+	def test_files_are_not_checked_within_the_interval(self):
+		self._write("Fan", {"version": 1}, 10 ** 18)
+		registry = ModelRegistry(self.dir_path, check_interval=3600)
+		targets = registry.targets
+		self._write("Fan", {"version": 2}, 10 ** 18 + 1)
+
+		self.assertIs(registry.targets, targets)
+
+
+class WeatherSeriesTests(SimpleTestCase):
+	def _utc(self, hour):
+		return datetime(2026, 3, 1, hour, tzinfo=dt_timezone.utc)
+
+	def _iter_raw_data(self, device, data_type=None, start_time=None, end_time=None, descending=False, limit=None):
+		entries = [RawDataPoint(self._utc(hour), "weather", "weather", {"hour": hour}) for hour in (1, 5, 9)]
+		if limit is not None:
+			entries = [entry for entry in entries if entry.data_arrival_time < end_time][-1:]
+		else:
+			entries = [entry for entry in entries if entry.data_arrival_time >= start_time]
+		return iter(entries)
+
+	def test_latest_entry_at_or_before_a_time_is_found(self):
+		series = WeatherSeries(self._utc(4), None, [(self._utc(1), "a"), (self._utc(5), "b"), (self._utc(9), "c")])
+
+		self.assertEqual([series.at(self._utc(hour)) for hour in (0, 1, 4, 5, 8, 9, 23)], [None, "a", "a", "b", "b", "c", "c"])
+		self.assertTrue(series.covers(self._utc(2)))
+		self.assertFalse(series.covers(self._utc(0)))
+		self.assertEqual(series.latest(), (self._utc(9), "c"))
+		self.assertFalse(WeatherSeries(self._utc(4), self._utc(9)).covers(self._utc(9)))
+
+	def test_lookups_share_one_series_until_weather_is_stored(self):
+		device = Mock(ip_address="10.0.0.1")
+		weather_cache = LocMemCache(f"weather-series-{uuid.uuid4()}", {})
+		with patch("utils.weather.cache", weather_cache), \
+				patch("utils.weather.timezone.now", return_value=self._utc(4)), \
+				patch("utils.weather.iter_raw_data", side_effect=self._iter_raw_data) as iter_raw_data, \
+				patch("utils.weather.get_latest_raw_data_point", return_value=None) as get_latest_raw_data_point, \
+				patch("utils.weather.RawData.objects.create") as create, \
+				patch("utils.weather.raw_data_bucket_compactor"):
+			lookups = [get_stored_weather_data(device, self._utc(hour)) for hour in (3, 6, 12)]
+			self.assertEqual(lookups, [{"hour": 1}, {"hour": 5}, {"hour": 9}])
+			self.assertEqual(get_stored_weather_data(device), {"hour": 9})
+			self.assertEqual(iter_raw_data.call_count, 2)
+
+			self.assertIsNone(get_stored_weather_data(device, self._utc(0) - timedelta(days=2)))
+			get_latest_raw_data_point.assert_called_once()
+
+			self.assertEqual(store_weather_data(device, {"hour": 9}, self._utc(9)).data, {"hour": 9})
+			create.assert_not_called()
+			# A series read before the weather was stored is left under the old version.
+			stale_series_key = f"10.0.0.1_weather_series:{weather_cache.get('10.0.0.1_weather_series_version')}"
+			store_weather_data(device, {"hour": 10}, self._utc(10))
+			create.assert_called_once()
+			self.assertIsNotNone(weather_cache.get(stale_series_key))
+			get_stored_weather_data(device)
+			self.assertEqual(iter_raw_data.call_count, 4)
+
+
+class WeatherFetcherTests(SimpleTestCase):
+	def setUp(self):
+		cache_patcher = patch("utils.weather_fetcher.cache", LocMemCache(f"weather-fetcher-{uuid.uuid4()}", {}))
+		self.cache = cache_patcher.start()
+		self.addCleanup(cache_patcher.stop)
+		self.client = StubWeatherClient()
+		self.fetcher = WeatherFetcher(self.client, grid_degrees=0.05, refresh_seconds=60, hot_seconds=600)
+		worker_patcher = patch.object(self.fetcher, "_ensure_worker")
+		worker_patcher.start()
+		self.addCleanup(worker_patcher.stop)
+
+	def test_positions_in_one_grid_cell_share_a_fetch(self):
+		first = self.fetcher.get(28.6139, 77.2090)
+		second = self.fetcher.get(28.6151, 77.2101)
+		other = self.fetcher.get(28.70, 77.10)
+
+		self.assertEqual(first, second)
+		self.assertEqual(first["coord"], {"lat": 28.6, "lon": 77.2})
+		self.assertEqual(other["coord"], {"lat": 28.7, "lon": 77.1})
+		self.assertEqual(self.client.fetches, 2)
+
+	def test_misses_without_waiting_are_fetched_in_the_background(self):
+		self.assertIsNone(self.fetcher.get(28.6139, 77.2090, wait=False))
+		self.assertEqual(self.client.fetches, 0)
+
+		self.assertEqual(self.fetcher.refresh_due(), 1)
+		self.assertEqual(self.fetcher.get(28.6139, 77.2090, wait=False)["name"], "stub")
+		self.assertEqual(self.fetcher.refresh_due(), 0)
+
+	def test_stale_cells_are_returned_and_fetched_again(self):
+		self.cache.set("weather:cell:v1:28.6:77.2", {"data": {"name": "old"}, "fetched_at": 0}, 60)
+
+		self.assertEqual(self.fetcher.get(28.6139, 77.2090), {"name": "old"})
+		self.assertEqual(self.fetcher.refresh_due(), 1)
+		self.assertEqual(self.fetcher.get(28.6139, 77.2090)["name"], "stub")
+
+	def test_workers_wait_for_the_cell_fetched_by_another(self):
+		self.cache.add("weather:cell:v1:lock:28.6:77.2", "other-worker", 10)
+		timer = threading.Timer(
+			0.2,
+			self.cache.set,
+			args=("weather:cell:v1:28.6:77.2", {"data": {"name": "other"}, "fetched_at": time.time()}, 60),
+		)
+		timer.start()
+		self.addCleanup(timer.cancel)
+
+		self.assertEqual(self.fetcher.get(28.6139, 77.2090), {"name": "other"})
+		self.assertEqual(self.client.fetches, 0)
+		self.assertEqual(self.fetcher.stats()["coalesced_fetches"], 1)
+
+	def test_failed_fetches_are_not_waited_for(self):
+		self.client.fetch = Mock(side_effect=RuntimeError("api down"))
+
+		self.assertIsNone(self.fetcher.get(28.6139, 77.2090))
+		self.assertEqual(self.fetcher.stats()["failed_fetches"], 1)
+		self.assertIsNone(self.cache.get("weather:cell:v1:lock:28.6:77.2"))
+
+	def test_openweathermap_requests_use_the_session_timeout(self):
+		client = OpenWeatherMapClient(api_key="key", timeout_seconds=3)
+		client.session = Mock()
+		client.session.get.return_value = Mock(status_code=200, json=Mock(return_value={"name": "Delhi"}))
+
+		self.assertEqual(client.fetch(28.6, 77.2), {"name": "Delhi"})
+		self.assertEqual(client.session.get.call_args.kwargs["timeout"], 3.0)
+		self.assertEqual(client.session.get.call_args.kwargs["params"], {"lat": 28.6, "lon": 77.2, "APPID": "key"})
+
+
+class PendingCommandCacheTests(SimpleTestCase):
+	def test_command_created_during_the_lookup_is_not_hidden(self):
+		device = Device(id=uuid.UUID(int=5))
+		created_command = Mock(device_id=device.pk, status="P")
+		lookups = []
+
+		def get_command():
+			lookups.append(1)
+			if len(lookups) == 2:
+				# Created after this query found nothing, before the marker is written.
+				device_models.notify_pending_command_on_create(None, created_command, created=True)
+				return None
+			return created_command if len(lookups) > 2 else None
+
+		with patch("device.models.device.cache", LocMemCache(f"pending-command-{uuid.uuid4()}", {})), \
+				patch("device.models.device.transaction.on_commit"), \
+				patch.object(Device, "get_command", side_effect=get_command):
+			self.assertIsNone(device.get_cached_command())
+			self.assertIsNone(device.get_cached_command())
+			self.assertEqual(len(lookups), 1)
+
+			device_models.notify_pending_command_on_create(None, Mock(device_id=device.pk, status="P"), created=True)
+			self.assertIsNone(device.get_cached_command())
+			self.assertIs(device.get_cached_command(), created_command)
+			self.assertEqual(len(lookups), 3)
+
+
+class StatusReplayTests(SimpleTestCase):
+	def test_deferred_status_writes_are_flushed_in_bulk(self):
+		device = Mock(pk=1)
+		context = {"deferred_writes": new_deferred_status_writes()}
+		context["deferred_writes"]["statuses"].extend(["status-1", "status-2"])
+		context["deferred_writes"]["instances"][("device", 1)] = device
+
+		with patch("api.utils.bulk_create_device_statuses_with_timestamp") as bulk_create:
+			inserted = flush_deferred_status_writes(context)
+			self.assertEqual(flush_deferred_status_writes(context), 0)
+
+		self.assertEqual(inserted, 2)
+		bulk_create.assert_called_once_with(["status-1", "status-2"], batch_size=500)
+		device.save.assert_called_once_with()
+
+	def test_replay_for_devices_aggregates_progress_and_errors(self):
+		devices = [Mock(pk="a"), Mock(pk="b"), Mock(pk="c")]
+		progress_updates = []
+
+		def replay_device(device_pk, user_pk, start_time, end_time, replay_options, progress_callback=None):
+			if device_pk == "c":
+				raise ValueError("broken device")
+			progress_callback({"processed_raw_count": 5, "total_raw_count": 10})
+			return {"processed_raw_count": 10, "total_raw_count": 10, "user_pk": user_pk, **replay_options}
+
+		with patch("api.replay._replay_device", side_effect=replay_device):
+			replay = replay_stored_raw_data_for_devices(
+				devices,
+				None,
+				None,
+				users={"a": 7},
+				workers=1,
+				progress_callback=progress_updates.append,
+				clear_existing_statuses=False,
+			)
+
+		self.assertEqual(replay["workers"], 1)
+		self.assertEqual(replay["results"]["a"]["user_pk"], 7)
+		self.assertFalse(replay["results"]["b"]["clear_existing_statuses"])
+		self.assertEqual(replay["errors"], {"c": "broken device"})
+		self.assertEqual(progress_updates[1]["progress_percent"], 16)
+		self.assertEqual(progress_updates[-1]["phase"], "completed")
+		self.assertEqual(progress_updates[-1]["devices_completed"], 3)
+		self.assertEqual(progress_updates[-1]["devices_failed"], 1)
+		self.assertEqual(progress_updates[-1]["processed_raw_count"], 20)
+
+
+class PartitionedWorkerPoolTests(SimpleTestCase):
+	def test_messages_of_one_device_keep_arrival_order(self):
+		processed = []
+		lock = threading.Lock()
+
+		def handler(device, value):
+			with lock:
+				processed.append((device, value))
+
+		pool = PartitionedWorkerPool(handler, workers=3, queue_size=5).start()
+		for value in range(50):
+			for device in ("dev-a", "dev-b", "dev-c"):
+				self.assertTrue(pool.submit(device, device, value))
+		self.assertEqual(pool.shutdown(drain=True, timeout=10), 0)
+
+		for device in ("dev-a", "dev-b", "dev-c"):
+			self.assertEqual([value for name, value in processed if name == device], list(range(50)))
+		stats = pool.stats()
+		self.assertEqual(stats["submitted"], 150)
+		self.assertEqual(stats["processed"], 150)
+		self.assertLessEqual(stats["max_depth"], 5)
+
+	def test_full_queue_applies_backpressure_and_failures_are_counted(self):
+		release = threading.Event()
+
+		def handler(value):
+			release.wait(5)
+			if value == "bad":
+				raise ValueError("bad payload")
+
+		pool = PartitionedWorkerPool(handler, workers=1, queue_size=1).start()
+		self.assertTrue(pool.submit("dev", "bad"))
+		# Wait for the worker to pick up the first message, then fill the queue.
+		while pool.queues[0].qsize():
+			pass
+		self.assertTrue(pool.submit("dev", "ok"))
+		self.assertFalse(pool.submit("dev", "late", timeout=0.05))
+		release.set()
+		pool.shutdown(drain=True, timeout=10)
+
+		stats = pool.stats()
+		self.assertEqual(stats["failed"], 1)
+		self.assertEqual(stats["processed"], 1)
+		self.assertEqual(stats["rejected"], 1)
+		self.assertEqual(stats["backpressure_waits"], 1)
+		self.assertEqual(stats["last_error"], "bad payload")
+		self.assertFalse(pool.submit("dev", "after-shutdown"))
+
+
+class RawDataWriterTests(SimpleTestCase):
+	def _raw_data(self, device, value):
+		raw_data = Mock(device=device, device_id=device.pk, data={"value": value})
+		return raw_data
+
+	@patch("api.buffers.Device")
+	@patch("api.buffers.RawData")
+	def test_flushes_rows_in_bulk_with_one_update_per_device(self, raw_data_model, device_model):
+		device_a = Mock(pk="a", other_data={"keep": True})
+		device_b = Mock(pk="b", other_data={})
+		stored_devices = [Mock(pk="a", other_data={"keep": True}), Mock(pk="b", other_data=None)]
+		device_queryset = Mock()
+		device_model.objects.filter.side_effect = lambda **lookup: stored_devices if "pk__in" in lookup else device_queryset
+		writer = RawDataWriter(max_rows=4, max_delay_seconds=60)
+
+		writer.add(self._raw_data(device_a, 1), {"last_data_sync_time": "t1"})
+		writer.add(self._raw_data(device_b, 2), {"last_data_sync_time": "t2"})
+		writer.add(self._raw_data(device_a, 3), {"last_data_sync_time": "t3"})
+		self.assertFalse(raw_data_model.objects.bulk_create.called)
+		self.assertEqual(device_a.other_data, {"keep": True, "last_data_sync_time": "t3"})
+		self.assertEqual(writer.get_pending(device_a).data, {"value": 3})
+
+		writer.add(self._raw_data(device_b, 4), {"last_data_sync_time": "t4"})
+		writer.close()
+
+		raw_data_model.objects.bulk_create.assert_called_once()
+		self.assertEqual(len(raw_data_model.objects.bulk_create.call_args[0][0]), 4)
+		updates = [call.kwargs["other_data"] for call in device_queryset.update.call_args_list]
+		self.assertIn({"keep": True, "last_data_sync_time": "t3"}, updates)
+		self.assertIn({"last_data_sync_time": "t4"}, updates)
+		self.assertEqual(writer.pending_count(), 0)
+		self.assertIsNone(writer.get_pending(device_a))
+
+	@patch("api.buffers.Device")
+	@patch("api.buffers.RawData")
+	def test_failed_flush_keeps_rows_for_retry(self, raw_data_model, device_model):
+		device = Mock(pk="a", other_data={})
+		device_model.objects.filter.return_value = []
+		# The batch insert and its row by row retry fail, the next flush succeeds.
+		raw_data_model.objects.bulk_create.side_effect = [RuntimeError("mongo down"), RuntimeError("mongo down"), None]
+		writer = RawDataWriter(max_rows=10, max_delay_seconds=60)
+
+		writer.add(self._raw_data(device, 1))
+		self.assertEqual(writer.flush(), 0)
+		self.assertEqual(writer.pending_count(), 1)
+		self.assertEqual(writer.flush(), 1)
+		self.assertEqual(writer.stats()["failed_flushes"], 1)
+		self.assertEqual(writer.stats()["rows_written"], 1)
+		writer.close()
+
+	@patch("api.buffers.Device")
+	@patch("api.buffers.RawData")
+	def test_failed_batch_is_retried_row_by_row_and_bad_rows_dropped(self, raw_data_model, device_model):
+		device = Mock(pk="a", other_data={})
+		device_model.objects.filter.return_value = []
+		bad_row = self._raw_data(device, "bad")
+		inserted = []
+
+		def bulk_create(rows, batch_size=None):
+			if bad_row in rows:
+				raise ValueError("cannot encode")
+			inserted.extend(rows)
+
+		raw_data_model.objects.bulk_create.side_effect = bulk_create
+		writer = RawDataWriter(max_rows=2, max_delay_seconds=60, max_attempts=2, retry_delay_seconds=0)
+		rows = [self._raw_data(device, 1), bad_row, self._raw_data(device, 2), self._raw_data(device, 3)]
+		writer.add(rows[0])
+		writer.add(bad_row)
+		self.assertEqual(inserted, [rows[0]])
+		self.assertEqual(writer.pending_count(), 1)
+
+		# Retried with the next batch, then dropped after its second failure.
+		writer.add(rows[2])
+		self.assertEqual(inserted, [rows[0], rows[2]])
+		self.assertEqual(writer.pending_count(), 0)
+		writer.add(rows[3])
+		self.assertEqual(writer.flush(), 1)
+
+		self.assertEqual(inserted, [rows[0], rows[2], rows[3]])
+		self.assertEqual(writer.stats()["rows_dropped"], 1)
+		self.assertEqual(writer.stats()["rows_written"], 3)
+		writer.close()
+
+	@patch("api.buffers.Device")
+	@patch("api.buffers.RawData")
+	def test_outage_keeps_untried_batches_and_bounds_pending_rows(self, raw_data_model, device_model):
+		device = Mock(pk="a", other_data={})
+		device_model.objects.filter.return_value = []
+		raw_data_model.objects.bulk_create.side_effect = RuntimeError("mongo down")
+		writer = RawDataWriter(max_rows=2, max_delay_seconds=60, max_pending_rows=5, retry_delay_seconds=60)
+
+		for value in range(2):
+			writer.add(self._raw_data(device, value))
+		# The batch and both rows failed, later batches wait for the retry delay.
+		self.assertEqual(raw_data_model.objects.bulk_create.call_count, 3)
+		for value in range(2, 8):
+			writer.add(self._raw_data(device, value))
+
+		self.assertEqual(raw_data_model.objects.bulk_create.call_count, 3)
+		self.assertEqual(writer.pending_count(), 5)
+		self.assertEqual(writer.stats()["rows_dropped"], 3)
+		self.assertEqual(writer.flush(), 0)
+		# Only the first batch is tried while nothing can be written.
+		self.assertEqual(raw_data_model.objects.bulk_create.call_count, 6)
+		self.assertEqual(writer.pending_count(), 5)
+		writer.close()
+
+	def test_latest_raw_data_reads_buffered_dict_and_string_payloads(self):
+		device = Mock(pk="a", other_data={})
+		writer = RawDataWriter(max_rows=10, max_delay_seconds=60)
+		writer.add(self._raw_data(device, 1))
+
+		with patch("api.utils.raw_data_writer", writer):
+			self.assertEqual(get_latest_raw_data(device), {"value": 1})
+			writer.add(Mock(device=device, device_id=device.pk, data='{"value": 2}'))
+			self.assertEqual(get_latest_raw_data(device), {"value": 2})
+
+
+class _FakeClickHouseRow:
+	objects = Mock()
+
+	def __init__(self, value):
+		self.value = value
+
+	@classmethod
+	def table_name(cls):
+		return "fakerow"
+
+	@classmethod
+	def fields(cls, writable=False):
+		return {"value": None}
+
+	@classmethod
+	def has_funcs_as_defaults(cls):
+		return False
+
+	def to_db_string(self):
+		return f"{self.value}\n".encode("utf-8")
+
+
+class ClickHouseInsertBufferTests(SimpleTestCase):
+	def setUp(self):
+		_FakeClickHouseRow.objects = Mock()
+
+	def test_rows_are_inserted_in_one_batch_per_table(self):
+		buffer = ClickHouseInsertBuffer(batch_size=100, max_delay_seconds=60)
+		for value in range(3):
+			buffer.add(_FakeClickHouseRow(value))
+		buffer.extend([_FakeClickHouseRow(3), _FakeClickHouseRow(4)])
+		self.assertEqual(buffer.stats()["pending_rows"], 5)
+
+		buffer.close()
+
+		_FakeClickHouseRow.objects.bulk_create.assert_called_once()
+		inserted = _FakeClickHouseRow.objects.bulk_create.call_args[0][0]
+		self.assertEqual([row.value for row in inserted], [0, 1, 2, 3, 4])
+		self.assertEqual(buffer.stats()["rows_flushed"], 5)
+		self.assertEqual(buffer.stats()["pending_rows"], 0)
+
+	def test_failed_batch_is_spilled_and_resent_on_next_flush(self):
+		database = Database.__new__(Database)
+		database.db_name = "iot"
+		_FakeClickHouseRow.objects.bulk_create.side_effect = RuntimeError("clickhouse down")
+		_FakeClickHouseRow.objects.get_database.return_value = database
+
+		with tempfile.TemporaryDirectory() as spill_dir:
+			buffer = ClickHouseInsertBuffer(
+				models=(_FakeClickHouseRow,),
+				retries=1,
+				retry_delay_seconds=0,
+				spill_dir=spill_dir,
+			)
+			buffer.extend([_FakeClickHouseRow(1), _FakeClickHouseRow("$db$$2")])
+			buffer.flush()
+
+			self.assertEqual(_FakeClickHouseRow.objects.bulk_create.call_count, 2)
+			with open(os.path.join(spill_dir, "fakerow.tsv"), "rb") as handle:
+				self.assertEqual(handle.read(), b"1\n$db$$2\n")
+			self.assertEqual(buffer.stats()["rows_spilled"], 2)
+
+			_FakeClickHouseRow.objects.bulk_create.side_effect = None
+			buffer.add(_FakeClickHouseRow(3))
+			# The payload goes through the installed ORM's Database.raw, rows are sent verbatim.
+			with patch.object(Database, "_send") as send:
+				buffer.close()
+
+			send.assert_called_once()
+			self.assertEqual(
+				send.call_args.args[0],
+				"INSERT INTO `iot`.`fakerow` (`value`) FORMAT TabSeparated\n1\n$db$$2\n",
+			)
+			self.assertEqual(os.listdir(spill_dir), [])
+			self.assertEqual(buffer.stats()["rows_flushed"], 3)
+			self.assertEqual(buffer.stats()["rows_dropped"], 0)
+
+	def test_rejected_spill_chunk_is_moved_aside_after_repeated_rejections(self):
+		sent = []
+
+		def insert_payload(model, payload):
+			if b"bad" in payload:
+				raise ServerError("Code: 27. DB::Exception: Cannot parse input")
+			sent.append(payload)
+
+		with tempfile.TemporaryDirectory() as spill_dir:
+			buffer = ClickHouseInsertBuffer(
+				models=(_FakeClickHouseRow,),
+				batch_size=2,
+				spill_dir=spill_dir,
+				spill_attempts=2,
+			)
+			with open(os.path.join(spill_dir, "fakerow.tsv"), "wb") as handle:
+				handle.write(b"1\nbad\n3\n4\n")
+
+			with patch.object(buffer, "_insert_payload", side_effect=insert_payload):
+				buffer.flush()
+				self.assertEqual(sent, [])
+				with open(os.path.join(spill_dir, "fakerow.tsv"), "rb") as handle:
+					self.assertEqual(handle.read(), b"1\nbad\n3\n4\n")
+
+				buffer.flush()
+
+			self.assertEqual(sent, [b"3\n4\n"])
+			self.assertEqual(sorted(os.listdir(spill_dir)), ["fakerow.tsv.rejected"])
+			with open(os.path.join(spill_dir, "fakerow.tsv.rejected"), "rb") as handle:
+				self.assertEqual(handle.read(), b"1\nbad\n")
+			self.assertEqual(buffer.stats()["rows_rejected"], 2)
+			self.assertEqual(buffer.stats()["rows_flushed"], 2)
+
+	def test_spill_is_kept_whole_while_clickhouse_is_unreachable(self):
+		with tempfile.TemporaryDirectory() as spill_dir:
+			buffer = ClickHouseInsertBuffer(models=(_FakeClickHouseRow,), batch_size=2, spill_dir=spill_dir, spill_attempts=1)
+			with open(os.path.join(spill_dir, "fakerow.tsv"), "wb") as handle:
+				handle.write(b"1\n2\n3\n")
+
+			with patch.object(buffer, "_insert_payload", side_effect=ConnectionError("refused")):
+				buffer.flush()
+
+			self.assertEqual(os.listdir(spill_dir), ["fakerow.tsv"])
+			with open(os.path.join(spill_dir, "fakerow.tsv"), "rb") as handle:
+				self.assertEqual(handle.read(), b"1\n2\n3\n")
+			self.assertEqual(buffer.stats()["rows_rejected"], 0)
+
+	def test_oldest_rows_are_dropped_when_buffer_is_full(self):
+		buffer = ClickHouseInsertBuffer(batch_size=100, max_delay_seconds=60, max_pending_rows=2)
+		buffer.extend([_FakeClickHouseRow(value) for value in range(3)])
+		buffer.close()
+
+		inserted = _FakeClickHouseRow.objects.bulk_create.call_args[0][0]
+		self.assertEqual([row.value for row in inserted], [1, 2])
+		self.assertEqual(buffer.stats()["rows_dropped"], 1)
@@ -2,22 +2,59 @@
 API rate limiting with Redis-backed moving window implementation.
 Provides configurable throttling per user and per device for data ingestion.
 """
+import logging
+import threading
 import time
-from collections import OrderedDict
+import uuid
+from collections import OrderedDict, deque
 
 from django.conf import settings
 from django.core.cache import cache
 from rest_framework.throttling import BaseThrottle
 from rest_framework.response import Response
 
+logger = logging.getLogger('django')
+
+
+# Sliding window over a sorted set of request times, evaluated atomically on
+# the Redis server. Returns {allowed, count, reset_in}.
+MOVING_WINDOW_SCRIPT = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local max_requests = tonumber(ARGV[3])
+local window_start = now - window
+
+redis.call('ZREMRANGEBYSCORE', key, '-inf', window_start)
+local count = redis.call('ZCARD', key)
+local allowed = 0
+if count < max_requests then
+    redis.call('ZADD', key, now, ARGV[4])
+    count = count + 1
+    allowed = 1
+end
+redis.call('EXPIRE', key, math.ceil(window) + 10)
+
+local reset_in = window
+local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+if oldest[2] then
+    reset_in = math.floor(tonumber(oldest[2]) - window_start + 1)
+end
+return {allowed, count, reset_in}
+"""
+
 
 class MovingWindowRateLimiter:
     """
     Moving window rate limiter using Redis for fast, distributed rate limiting.
     
-    Tracks request timestamps in a moving window. When a new request arrives,
-    it checks how many requests fall within the window and decides to allow or deny.
+    Request times are kept in a Redis sorted set per key. Expiring old
+    requests, counting and recording the new one run as a single server-side
+    script, so concurrent workers cannot both take the last slot. Without a
+    Redis cache the window is kept in process memory.
     """
+
+    KEY_PREFIX = "rate_limit:zset:"
     
     def __init__(self, window_seconds, max_requests):
         """
@@ -27,6 +64,7 @@ class MovingWindowRateLimiter:
         """
         self.window = window_seconds
         self.max_requests = max_requests
+        self.local_limiter = LocalMovingWindowRateLimiter(window_seconds, max_requests)
     
     def is_allowed(self, key):
         """
@@ -38,6 +76,75 @@ class MovingWindowRateLimiter:
         Returns:
             tuple: (allowed: bool, count: int, reset_in: int)
         """
+        script = _get_moving_window_script()
+        if script is None:
+            return self.local_limiter.is_allowed(key)
+
+        current_time = time.time()
+        try:
+            allowed, count, reset_in = script(
+                keys=[f"{self.KEY_PREFIX}{key}"],
+                args=[current_time, self.window, self.max_requests, f"{current_time}:{uuid.uuid4().hex}"],
+            )
+        except Exception as ex:
+            logger.warning("Redis rate limiter failed, using the in-process window: %s", ex)
+            return self.local_limiter.is_allowed(key)
+        return bool(allowed), int(count), int(reset_in)
+
+
+class LocalMovingWindowRateLimiter:
+    """
+    In-process moving window rate limiter, used when Redis is not available.
+
+    Keeps at most `max_requests` request times per key.
+    """
+
+    # Keys idle for a whole window are dropped once this many keys are tracked.
+    MAX_IDLE_KEYS = 10000
+
+    def __init__(self, window_seconds, max_requests):
+        self.window = window_seconds
+        self.max_requests = max_requests
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def is_allowed(self, key):
+        current_time = time.time()
+        window_start = current_time - self.window
+        with self._lock:
+            timestamps = self._windows.get(key)
+            if timestamps is None:
+                if len(self._windows) >= self.MAX_IDLE_KEYS:
+                    self._drop_idle_keys(window_start)
+                timestamps = self._windows[key] = deque(maxlen=max(1, self.max_requests))
+            while timestamps and timestamps[0] <= window_start:
+                timestamps.popleft()
+
+            allowed = len(timestamps) < self.max_requests
+            if allowed:
+                timestamps.append(current_time)
+
+            count = len(timestamps)
+            reset_in = int((timestamps[0] - window_start) + 1) if timestamps else self.window
+        return allowed, count, reset_in
+
+    def _drop_idle_keys(self, window_start):
+        for key in [key for key, timestamps in self._windows.items() if not timestamps or timestamps[-1] <= window_start]:
+            del self._windows[key]
+
+
+class CacheListRateLimiter:
+    """
+    Previous moving window limiter: a pickled list of request times read and
+    written back through the Django cache. Not atomic, kept to benchmark
+    against.
+    """
+
+    def __init__(self, window_seconds, max_requests):
+        self.window = window_seconds
+        self.max_requests = max_requests
+
+    def is_allowed(self, key):
         current_time = time.time()
         window_start = current_time - self.window
         
@@ -64,6 +171,26 @@ class MovingWindowRateLimiter:
         return allowed, len(timestamps), reset_in
 
 
+_moving_window_script = None
+_moving_window_script_checked = False
+_moving_window_script_lock = threading.Lock()
+
+
+def _get_moving_window_script():
+    """Return the registered Redis script, or None when the cache is not Redis."""
+    global _moving_window_script, _moving_window_script_checked
+    if not _moving_window_script_checked:
+        with _moving_window_script_lock:
+            if not _moving_window_script_checked:
+                try:
+                    from django_redis import get_redis_connection
+                    _moving_window_script = get_redis_connection('default').register_script(MOVING_WINDOW_SCRIPT)
+                except (ImportError, NotImplementedError):
+                    _moving_window_script = None
+                _moving_window_script_checked = True
+    return _moving_window_script
+
+
 class DataIngestionUserThrottle(BaseThrottle):
     """
     Throttle for user-level rate limiting on data ingestion.
@@ -1,13 +1,18 @@
 
 import logging
 import re
+import time
+import uuid
+from contextlib import contextmanager
 from copy import deepcopy
-from datetime import datetime
+from datetime import datetime, time as dt_time, timedelta
+from functools import lru_cache
 
 import pytz
 import simplejson as json
 from device.models import (Device, AssetStatus, Meter, RawData, StatusType,
                            User, UserDeviceType)
+from device.raw_data_store import get_latest_raw_data_point, iter_raw_data, parse_raw_data_payload
 from device_schemas.schema import (extract_data, translate_data_from_schema,
                                    validate_data_schema, validate_schema)
 from django.conf import settings
@@ -17,9 +22,11 @@ from django.db.utils import DatabaseError
 from django.utils import timezone
 from event.models import DeviceEvent, EventHistory, EventType
 
+from api.buffers import device_state_writer, raw_data_writer
+from api.rollups import record_device_daily_rollup
 from utils import detect_and_save_meter_loads
 from device.log_handler import set_device_for_logger
-from utils.weather import get_weather_data_cached
+from utils.weather import get_stored_weather_series
 
 logger = logging.getLogger('device')
 
@@ -54,9 +61,19 @@ ALARM_TYPE_IDS_CACHE_KEY = 'alarm_eval:type_ids:v1'
 ALARM_EVENT_TYPE_CACHE_KEY_PREFIX = 'alarm_eval:event_type:'
 ALARM_TYPE_IDS_CACHE_TIMEOUT_SECONDS = 120
 ALARM_EVENT_TYPE_CACHE_TIMEOUT_SECONDS = 300
+ALARM_INDEX_VERSION_CACHE_KEY = 'alarm_eval:index_version:v1'
+ALARM_INDEX_CACHE_KEY_PREFIX = 'alarm_eval:device_index:v1:'
+ALARM_INDEX_CACHE_TIMEOUT_SECONDS = 60 * 60
 
+STATUS_CONTEXT_CACHE_KEY_PREFIX = 'status_context:v1:'
+STATUS_CONTEXT_CACHE_TIMEOUT_SECONDS = getattr(settings, 'STATUS_CONTEXT_CACHE_TIMEOUT_SECONDS', 36 * 60 * 60)
+STATUS_CONTEXT_LOCK_KEY_PREFIX = 'status_context:lock:v1:'
+STATUS_CONTEXT_LOCK_SECONDS = getattr(settings, 'STATUS_CONTEXT_LOCK_SECONDS', 60)
+STATUS_CONTEXT_LOCK_WAIT_SECONDS = getattr(settings, 'STATUS_CONTEXT_LOCK_WAIT_SECONDS', 5)
+STATUS_REPLAY_CHUNK_HOURS = getattr(settings, 'STATUS_REPLAY_CHUNK_HOURS', 24)
 
-def create_device_status_with_timestamp(
+
+def build_device_status_with_timestamp(
     *,
     name,
     device,
@@ -64,7 +81,7 @@ def create_device_status_with_timestamp(
     status_data,
     created_at,
 ):
-    status = AssetStatus(
+    return AssetStatus(
         name=name,
         device=device,
         user=user if user is not None and user.is_authenticated else None,
@@ -73,22 +90,52 @@ def create_device_status_with_timestamp(
         updated_at=created_at,
     )
 
-    created_at_field = status._meta.get_field('created_at')
-    updated_at_field = status._meta.get_field('updated_at')
+
+@contextmanager
+def _explicit_status_timestamps():
+    created_at_field = AssetStatus._meta.get_field('created_at')
+    updated_at_field = AssetStatus._meta.get_field('updated_at')
     original_created_auto_now_add = created_at_field.auto_now_add
     original_updated_auto_now_add = updated_at_field.auto_now_add
 
     try:
         created_at_field.auto_now_add = False
         updated_at_field.auto_now_add = False
-        status.save(force_insert=True)
+        yield
     finally:
         created_at_field.auto_now_add = original_created_auto_now_add
         updated_at_field.auto_now_add = original_updated_auto_now_add
 
+
+def create_device_status_with_timestamp(
+    *,
+    name,
+    device,
+    user,
+    status_data,
+    created_at,
+):
+    status = build_device_status_with_timestamp(
+        name=name,
+        device=device,
+        user=user,
+        status_data=status_data,
+        created_at=created_at,
+    )
+
+    with _explicit_status_timestamps():
+        status.save(force_insert=True)
+
     return status
 
 
+def bulk_create_device_statuses_with_timestamp(statuses, batch_size=500):
+    if not statuses:
+        return []
+    with _explicit_status_timestamps():
+        return AssetStatus.objects.bulk_create(statuses, batch_size=batch_size)
+
+
 def generate_device_alias(dev_identifier_field, dev_id):
     dev_identifier_fields = dev_identifier_field.split('.')
     dev_identifier_field = dev_identifier_fields[-1]
@@ -141,11 +188,14 @@ def assign_ip_address_to_existing_user_devices(user: User, user_device_type: Use
 
 
 def merge_device_other_data(device: Device, updates: dict):
-    latest_device = Device.objects.filter(pk=device.pk).first()
-    other_data = dict((latest_device.other_data if latest_device else device.other_data) or {})
+    """
+        Merge volatile `other_data` values (heartbeat/sync times) into the
+        device. They are written behind, see DeviceStateWriter.
+    """
+    other_data = dict(device.other_data or {})
     other_data.update(updates)
     device.other_data = other_data
-    device.save()
+    device_state_writer.record(device.pk, updates)
     return other_data
 
 
@@ -184,68 +234,60 @@ def get_or_create_user_device(user: User, data: json) -> Device:
 
 def get_latest_raw_data(device):
     try:
-        raw_data = RawData.objects.filter(
-            device=device
-        ).order_by(
-            '-data_arrival_time'
-        )[0]
-        return json.loads(raw_data.data)
+        raw_data = raw_data_writer.get_pending(device)
+        if raw_data is not None:
+            return parse_raw_data_payload(raw_data.data)
+        raw_data = get_latest_raw_data_point(device)
+        return raw_data.data if raw_data is not None else None
     except Exception as ex:
         return None
 
 
-def get_local_month_start_utc(device, reference_time=None):
-    if reference_time is None:
-        local_now = device.get_local_time()
-    else:
-        if timezone.is_naive(reference_time):
-            reference_time = timezone.make_aware(
-                reference_time,
-                timezone.get_current_timezone(),
-            )
-        device_timezone = device.get_timezone()
-        if device_timezone is not None and reference_time.tzinfo is not None:
-            local_now = reference_time.astimezone(device_timezone)
-        else:
-            local_now = reference_time
-
-    local_month_start = local_now.replace(
-        day=1,
-        hour=0,
-        minute=0,
-        second=0,
-        microsecond=0,
-    )
-    if local_month_start.tzinfo is None:
-        return local_month_start
-    return local_month_start.astimezone(pytz.utc)
+@lru_cache(maxsize=8192)
+def _get_local_midnight_utc(local_date, local_tzinfo):
+    # pytz zones hand out one tzinfo instance per UTC offset, so (date, tzinfo)
+    # fully determines the boundary and repeated messages/replayed rows hit here.
+    return datetime.combine(local_date, dt_time.min, tzinfo=local_tzinfo).astimezone(pytz.utc)
 
 
-def get_local_day_start_utc(device, reference_time=None):
+def _get_device_local_time(device, reference_time=None):
     if reference_time is None:
-        local_now = device.get_local_time()
-    else:
-        if timezone.is_naive(reference_time):
-            reference_time = timezone.make_aware(
-                reference_time,
-                timezone.get_current_timezone(),
-            )
+        return device.get_local_time()
 
-        device_timezone = device.get_timezone()
-        if device_timezone is not None and reference_time.tzinfo is not None:
-            local_now = reference_time.astimezone(device_timezone)
-        else:
-            local_now = reference_time
+    if timezone.is_naive(reference_time):
+        reference_time = timezone.make_aware(
+            reference_time,
+            timezone.get_current_timezone(),
+        )
+    device_timezone = device.get_timezone()
+    if device_timezone is not None and reference_time.tzinfo is not None:
+        return reference_time.astimezone(device_timezone)
+    return reference_time
 
-    local_day_start = local_now.replace(
-        hour=0,
-        minute=0,
-        second=0,
-        microsecond=0,
-    )
-    if local_day_start.tzinfo is None:
-        return local_day_start
-    return local_day_start.astimezone(pytz.utc)
+
+def get_local_month_start_utc(device, reference_time=None):
+    local_now = _get_device_local_time(device, reference_time=reference_time)
+    if local_now.tzinfo is None:
+        return local_now.replace(
+            day=1,
+            hour=0,
+            minute=0,
+            second=0,
+            microsecond=0,
+        )
+    return _get_local_midnight_utc(local_now.date().replace(day=1), local_now.tzinfo)
+
+
+def get_local_day_start_utc(device, reference_time=None):
+    local_now = _get_device_local_time(device, reference_time=reference_time)
+    if local_now.tzinfo is None:
+        return local_now.replace(
+            hour=0,
+            minute=0,
+            second=0,
+            microsecond=0,
+        )
+    return _get_local_midnight_utc(local_now.date(), local_now.tzinfo)
 
 
 def _normalize_raw_snapshot(raw_snapshot):
@@ -293,6 +335,20 @@ def _get_status_queryset_for_day(user, device, day_start_utc, as_of_time=None):
     return statuses.order_by('created_at')
 
 
+def _get_raw_snapshots_between(raw_data_rows, start_time, end_time=None, include_end=False):
+    snapshots = []
+    for raw_data in raw_data_rows:
+        data_arrival_time = raw_data.data_arrival_time
+        if data_arrival_time is None or data_arrival_time < start_time:
+            continue
+        if end_time is not None and (
+            data_arrival_time > end_time if include_end else data_arrival_time >= end_time
+        ):
+            continue
+        snapshots.append(parse_raw_data_payload(raw_data.data))
+    return snapshots
+
+
 def build_status_processing_context(user, device, last_raw_data, as_of_time=None):
     day_start_utc = get_local_day_start_utc(device, reference_time=as_of_time)
     month_start_utc = get_local_month_start_utc(device, reference_time=as_of_time)
@@ -303,24 +359,20 @@ def build_status_processing_context(user, device, last_raw_data, as_of_time=None
         day_start_utc,
         as_of_time=as_of_time,
     )
-    raw_data_today = RawData.objects.filter(
-        device=device,
+    raw_data_today = iter_raw_data(
+        device,
         data_type='meters-data',
-        data_arrival_time__gte=day_start_utc
+        start_time=day_start_utc,
+        end_time=as_of_time,
+        include_end=True,
     )
-    if as_of_time is not None:
-        raw_data_today = raw_data_today.filter(data_arrival_time__lte=as_of_time)
-    raw_data_today = raw_data_today.order_by('data_arrival_time')
-
-    raw_data_month = RawData.objects.filter(
-        device=device,
+    # The day starts at or before `as_of_time`, so the month scan ends with it.
+    raw_data_month = iter_raw_data(
+        device,
         data_type='meters-data',
-        data_arrival_time__gte=month_start_utc,
-        data_arrival_time__lt=day_start_utc,
+        start_time=month_start_utc,
+        end_time=day_start_utc,
     )
-    if as_of_time is not None:
-        raw_data_month = raw_data_month.filter(data_arrival_time__lte=as_of_time)
-    raw_data_month = raw_data_month.order_by('data_arrival_time')
 
     raw_data_first = {}
     raw_data_last = {}
@@ -336,6 +388,20 @@ def build_status_processing_context(user, device, last_raw_data, as_of_time=None
             overwrite=True,
         )
 
+    # Rows still buffered by the RawData writer are newer than the stored ones.
+    pending_rows = raw_data_writer.get_pending_rows(device, data_type='meters-data')
+    for raw_data_point in _get_raw_snapshots_between(pending_rows, day_start_utc, as_of_time, include_end=True):
+        raw_data_first = _merge_raw_snapshot(
+            raw_data_first,
+            raw_data_point,
+            overwrite=False,
+        )
+        raw_data_last = _merge_raw_snapshot(
+            raw_data_last,
+            raw_data_point,
+            overwrite=True,
+        )
+
     raw_data_last = _merge_raw_snapshot(raw_data_last, last_raw_data, overwrite=True)
 
     raw_data_month_first = {}
@@ -345,6 +411,12 @@ def build_status_processing_context(user, device, last_raw_data, as_of_time=None
             raw_data_point,
             overwrite=False,
         )
+    for raw_data_point in _get_raw_snapshots_between(pending_rows, month_start_utc, day_start_utc):
+        raw_data_month_first = _merge_raw_snapshot(
+            raw_data_month_first,
+            raw_data_point,
+            overwrite=False,
+        )
 
     if not raw_data_first and raw_data_last:
         raw_data_first = dict(raw_data_last)
@@ -480,14 +552,146 @@ def record_status_in_context(status_processing_context, target_type, status_mode
     ] = status_model
 
 
-def get_existing_status_data_for_today(user, device, last_raw_data, as_of_time=None):
+def new_deferred_status_writes():
+    return {'statuses': [], 'instances': {}}
+
+
+def flush_deferred_status_writes(status_processing_context, batch_size=500):
+    """
+        Write the statuses and device/user updates collected in the context by
+        `update_user_and_device_statuses`: one bulk insert for the statuses and
+        a single save per changed device/user. Returns the inserted count.
+    """
+    deferred_writes = (status_processing_context or {}).get('deferred_writes')
+    if not deferred_writes:
+        return 0
+
+    statuses = deferred_writes['statuses']
+    instances = deferred_writes['instances']
+    deferred_writes['statuses'] = []
+    deferred_writes['instances'] = {}
+
+    if statuses:
+        bulk_create_device_statuses_with_timestamp(statuses, batch_size=batch_size)
+    for instance in instances.values():
+        instance.save()
+    return len(statuses)
+
+
+def _get_status_context_cache_key(device):
+    return f"{STATUS_CONTEXT_CACHE_KEY_PREFIX}{device.pk}"
 
-    status_processing_context = build_status_processing_context(
+
+def _get_status_context_user_id(user):
+    if user is not None and user.is_authenticated:
+        return user.pk
+    return None
+
+
+def get_cached_status_processing_context(user, device, reference_time=None):
+    """
+        Return the persisted status processing context of the device, or None
+        when it is missing, belongs to another user or the local day/month it
+        was built for is over.
+    """
+    status_processing_context = cache.get(_get_status_context_cache_key(device))
+    if not isinstance(status_processing_context, dict):
+        return None
+    if status_processing_context.get('user_id') != _get_status_context_user_id(user):
+        return None
+    day_start_utc = get_local_day_start_utc(device, reference_time=reference_time)
+    month_start_utc = get_local_month_start_utc(device, reference_time=reference_time)
+    if (
+        status_processing_context.get('day_start_utc') != day_start_utc
+        or status_processing_context.get('month_start_utc') != month_start_utc
+    ):
+        return None
+    return status_processing_context
+
+
+def load_status_processing_context(user, device, last_raw_data, reference_time=None):
+    """
+        Return the persisted context of the device, rebuilding it from the
+        stored RawData and statuses only when the cache is cold or a local
+        day/month boundary was crossed since it was built.
+    """
+    status_processing_context = get_cached_status_processing_context(
         user,
         device,
-        last_raw_data,
-        as_of_time=as_of_time,
+        reference_time=reference_time,
     )
+    if status_processing_context is None:
+        status_processing_context = build_status_processing_context(
+            user,
+            device,
+            last_raw_data,
+            as_of_time=reference_time,
+        )
+        status_processing_context['user_id'] = _get_status_context_user_id(user)
+    return status_processing_context
+
+
+@contextmanager
+def status_processing_context_lock(device):
+    """
+        Hold the device's status context lock while its persisted context is
+        loaded, updated and saved, so the ingestion processes handling the
+        device do not overwrite each other's updates. Yields False when the
+        lock was not freed within STATUS_CONTEXT_LOCK_WAIT_SECONDS, the caller
+        must not save the context then.
+    """
+    lock_key = f"{STATUS_CONTEXT_LOCK_KEY_PREFIX}{device.pk}"
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + STATUS_CONTEXT_LOCK_WAIT_SECONDS
+    while True:
+        try:
+            acquired = cache.add(lock_key, token, STATUS_CONTEXT_LOCK_SECONDS)
+        except Exception as ex:
+            logger.warning("Status context lock failed for device %s: %s", device.pk, ex)
+            acquired = True
+        if acquired or time.monotonic() >= deadline:
+            break
+        time.sleep(0.05)
+    if not acquired:
+        logger.warning("Status context of device %s is locked, processing without saving it", device.pk)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            try:
+                if cache.get(lock_key) == token:
+                    cache.delete(lock_key)
+            except Exception as ex:
+                logger.warning("Status context lock release failed for device %s: %s", device.pk, ex)
+
+
+def save_status_processing_context(device, status_processing_context):
+    try:
+        cache.set(
+            _get_status_context_cache_key(device),
+            status_processing_context,
+            STATUS_CONTEXT_CACHE_TIMEOUT_SECONDS,
+        )
+    except Exception as ex:
+        logger.warning("Failed to persist status processing context for device %s: %s", device.pk, ex)
+
+
+def invalidate_status_processing_context(device):
+    cache.delete(_get_status_context_cache_key(device))
+
+
+def get_existing_status_data_for_today(user, device, last_raw_data, as_of_time=None):
+
+    status_processing_context = None
+    if as_of_time is None:
+        status_processing_context = get_cached_status_processing_context(user, device)
+    if status_processing_context is None:
+        status_processing_context = build_status_processing_context(
+            user,
+            device,
+            last_raw_data,
+            as_of_time=as_of_time,
+        )
     return status_processing_context['existing_statuses']
 
 
@@ -671,6 +875,8 @@ def _get_cached_event_type_alarm_rules(event_type_ids):
 
 def invalidate_alarm_evaluation_cache(event_type_ids=None):
     cache.delete(ALARM_TYPE_IDS_CACHE_KEY)
+    # Rule edits can move alarms between devices, drop every device alarm index.
+    cache.set(ALARM_INDEX_VERSION_CACHE_KEY, uuid.uuid4().hex, None)
     if not event_type_ids:
         return
 
@@ -681,23 +887,25 @@ def invalidate_alarm_evaluation_cache(event_type_ids=None):
     ])
 
 
-def evaluate_device_status_alarms(device, status_snapshot, trigger_time=None):
-    if status_snapshot is None or not isinstance(status_snapshot, dict):
-        return
+def _get_alarm_index_cache_key(device_id):
+    version = cache.get(ALARM_INDEX_VERSION_CACHE_KEY)
+    if version is None:
+        cache.add(ALARM_INDEX_VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+        version = cache.get(ALARM_INDEX_VERSION_CACHE_KEY)
+    return f'{ALARM_INDEX_CACHE_KEY_PREFIX}{version}:{device_id}'
 
-    alarm_type_ids = _get_cached_alarm_type_ids()
-    if len(alarm_type_ids) == 0:
-        return
-
-    device_id = getattr(device, 'id', None)
-    if device_id is None:
-        return
 
+def _build_device_alarm_index(device_id, alarm_type_ids):
+    """
+        Compile the active status alarms of a device into rules grouped by the
+        top level status key they read, newest alarm first.
+    """
     try:
-        alarms = list(DeviceEvent.objects.all())
-    except Exception:
-        logger.exception('Failed to query device events for alarm evaluation.')
-        return
+        alarms = list(DeviceEvent.objects.filter(device=device_id, active=True))
+    except DatabaseError as ex:
+        # Checked below, only the device is filtered in the database.
+        logger.warning("Filtering active alarms of device %s failed, reading all its alarms: %s", device_id, ex)
+        alarms = list(DeviceEvent.objects.filter(device=device_id))
 
     alarm_type_ids_set = set(alarm_type_ids)
     alarms = [
@@ -712,35 +920,83 @@ def evaluate_device_status_alarms(device, status_snapshot, trigger_time=None):
         key=lambda alarm: alarm.created_at or timezone.now(),
         reverse=True,
     )
-    if len(alarms) == 0:
-        return
 
     event_type_ids = [alarm.typ_id for alarm in alarms if alarm.typ_id is not None]
     event_types_map = _get_cached_event_type_alarm_rules(event_type_ids)
-    evaluated_at = trigger_time or timezone.now()
 
-    for alarm in alarms:
+    rules_by_key = {}
+    for order, alarm in enumerate(alarms):
         event_type = event_types_map.get(alarm.typ_id)
         if event_type is None:
             continue
-
         status_key = event_type.get('status_key')
-        operator = event_type.get('operator')
-        target_value = event_type.get('target_value')
+        rules_by_key.setdefault(str(status_key).split('.')[0], []).append({
+            'order': order,
+            'alarm_id': alarm.id,
+            'status_key': status_key,
+            'operator': event_type.get('operator'),
+            'target_value': event_type.get('target_value'),
+            'channels': [
+                action.get('channel')
+                for action in (alarm.actions_config or [])
+                if action.get('channel')
+            ],
+            'last_evaluation_match': bool(alarm.last_evaluation_match),
+        })
+    return {'rules_by_key': rules_by_key}
+
+
+def evaluate_device_status_alarms(device, status_snapshot, trigger_time=None):
+    if status_snapshot is None or not isinstance(status_snapshot, dict):
+        return
+
+    alarm_type_ids = _get_cached_alarm_type_ids()
+    if len(alarm_type_ids) == 0:
+        return
+
+    device_id = getattr(device, 'id', None)
+    if device_id is None:
+        return
+
+    index_cache_key = _get_alarm_index_cache_key(device_id)
+    alarm_index = cache.get(index_cache_key)
+    if alarm_index is None:
+        try:
+            alarm_index = _build_device_alarm_index(device_id, alarm_type_ids)
+        except Exception:
+            logger.exception('Failed to query device events for alarm evaluation.')
+            return
+        cache.set(index_cache_key, alarm_index, ALARM_INDEX_CACHE_TIMEOUT_SECONDS)
+
+    rules_by_key = alarm_index['rules_by_key']
+    rules = sorted(
+        (
+            rule
+            for status_name in status_snapshot
+            for rule in rules_by_key.get(str(status_name), [])
+        ),
+        key=lambda rule: rule['order'],
+    )
+    if len(rules) == 0:
+        return
+
+    evaluated_at = trigger_time or timezone.now()
+    triggered_alarm_ids = []
+    cleared_alarm_ids = []
+
+    for rule in rules:
+        status_key = rule['status_key']
+        operator = rule['operator']
+        target_value = rule['target_value']
 
         current_value = _extract_alarm_status_value(status_snapshot, status_key)
         is_match = _is_alarm_match(current_value, operator, target_value)
 
-        if is_match and not alarm.last_evaluation_match:
+        if is_match and not rule['last_evaluation_match']:
             message = f"{status_key} {operator} {target_value} (current: {current_value})"
-            channels = [
-                action.get('channel')
-                for action in (alarm.actions_config or [])
-                if action.get('channel')
-            ]
 
             EventHistory.objects.create(
-                device_event=alarm,
+                device_event_id=rule['alarm_id'],
                 result={
                     'status_key': status_key,
                     'operator': operator,
@@ -748,14 +1004,25 @@ def evaluate_device_status_alarms(device, status_snapshot, trigger_time=None):
                     'status_value': str(current_value) if current_value is not None else None,
                     'status_snapshot': status_snapshot,
                     'message': message,
-                    'channels': channels,
+                    'channels': rule['channels'],
                 }
             )
+            triggered_alarm_ids.append(rule['alarm_id'])
+        elif not is_match and rule['last_evaluation_match']:
+            cleared_alarm_ids.append(rule['alarm_id'])
 
-            alarm.last_trigger_time = evaluated_at
+        rule['last_evaluation_match'] = is_match
 
-        alarm.last_evaluation_match = is_match
-        alarm.save(update_fields=['last_trigger_time', 'last_evaluation_match'])
+    # Only state transitions are written back.
+    if triggered_alarm_ids:
+        DeviceEvent.objects.filter(pk__in=triggered_alarm_ids).update(
+            last_evaluation_match=True,
+            last_trigger_time=evaluated_at,
+        )
+    if cleared_alarm_ids:
+        DeviceEvent.objects.filter(pk__in=cleared_alarm_ids).update(last_evaluation_match=False)
+    if triggered_alarm_ids or cleared_alarm_ids:
+        cache.set(index_cache_key, alarm_index, ALARM_INDEX_CACHE_TIMEOUT_SECONDS)
 
 
 def process_raw_data(device, message_data, channel='unknown', data_type='unknown', user=None):
@@ -799,11 +1066,12 @@ def process_raw_data(device, message_data, channel='unknown', data_type='unknown
         data_arrival_time=data_arrival_time,
         data=message_data
     )
-    raw_data.save()
-
-    other_data = merge_device_other_data(device, {
+    # Row insert and device sync time are batched, see RawDataWriter.
+    raw_data_writer.add(raw_data, {
         "last_data_sync_time": data_arrival_time.strftime(settings.TIME_FORMAT_STRING)
     })
+    record_device_daily_rollup(device, data_arrival_time)
+    other_data = device.other_data or {}
 
     if data_type == 'status':
         logger.info("Status data received, skipping meter data processing.")
@@ -885,6 +1153,36 @@ def update_user_and_device_statuses(
     status_processing_context=None,
     min_status_interval_minutes=10,
     enforce_min_status_interval=False,
+):
+    arguments = dict(
+        weather_and_loads_data=weather_and_loads_data,
+        status_created_at=status_created_at,
+        status_types=status_types,
+        status_processing_context=status_processing_context,
+        min_status_interval_minutes=min_status_interval_minutes,
+        enforce_min_status_interval=enforce_min_status_interval,
+    )
+    if status_processing_context is not None:
+        return _update_user_and_device_statuses(user, device, raw_data, last_raw_data, **arguments)
+    # The persisted context is shared by every process ingesting the device.
+    with status_processing_context_lock(device) as locked:
+        return _update_user_and_device_statuses(
+            user, device, raw_data, last_raw_data, save_context=locked, **arguments
+        )
+
+
+def _update_user_and_device_statuses(
+    user,
+    device,
+    raw_data,
+    last_raw_data,
+    weather_and_loads_data=None,
+    status_created_at=None,
+    status_types=None,
+    status_processing_context=None,
+    min_status_interval_minutes=10,
+    enforce_min_status_interval=False,
+    save_context=True,
 ):
     set_device_for_logger(logger, device.ip_address or str(device.id))
 
@@ -912,13 +1210,18 @@ def update_user_and_device_statuses(
     else:
         normalized_raw_data = raw_data
 
-    if status_processing_context is None:
-        status_processing_context = build_status_processing_context(
+    # Live messages share one context per device, persisted in the cache and
+    # updated incrementally. Replays pass their own in-memory context.
+    persist_status_processing_context = status_processing_context is None
+    save_context = persist_status_processing_context and save_context
+    if persist_status_processing_context:
+        status_processing_context = load_status_processing_context(
             user,
             device,
             last_raw_data,
-            as_of_time=status_created_at,
+            reference_time=status_created_at,
         )
+        merge_raw_into_status_context(status_processing_context, normalized_raw_data)
     else:
         refresh_status_processing_context_boundaries(
             status_processing_context,
@@ -937,6 +1240,8 @@ def update_user_and_device_statuses(
         'last_status_models_by_target',
         {},
     )
+    # Replays collect their writes in the context and flush them per chunk.
+    deferred_writes = status_processing_context.get('deferred_writes')
     calculated_alarm_status_data = {}
 
     for status_type in status_types:
@@ -960,6 +1265,8 @@ def update_user_and_device_statuses(
             )
             if validated_data is None:
                 logger.warning(f"Invalid data! for status {status_type.name}. Data: {current_raw_data}")
+                if save_context:
+                    save_status_processing_context(device, status_processing_context)
                 return "Invalid data! Data doesn't match the schema configured for the device/user."
 
             logger.info(f"Validated data for schema {status_type.name} is: {validated_data}")
@@ -1004,13 +1311,20 @@ def update_user_and_device_statuses(
                     create_new = True
                         
                 if create_new:
-                    status = create_device_status_with_timestamp(
+                    status_builder = (
+                        build_device_status_with_timestamp
+                        if deferred_writes is not None
+                        else create_device_status_with_timestamp
+                    )
+                    status = status_builder(
                         name=status_type.target_type,
                         device=device,
                         user=user,
                         status_data=validated_data,
                         created_at=time_now,
                     )
+                    if deferred_writes is not None:
+                        deferred_writes['statuses'].append(status)
                     record_status_in_context(
                         status_processing_context,
                         status_type.target_type,
@@ -1022,7 +1336,11 @@ def update_user_and_device_statuses(
                         other_data = validated_status_data
                     else:
                         other_data.update(validated_status_data)
-                    device.save()
+                    if deferred_writes is not None:
+                        deferred_writes['instances'][('device', device.pk)] = device
+                    else:
+                        device_state_writer.record(device.pk, validated_status_data)
+                        record_device_daily_rollup(device, status_created_at, validated_status_data)
                 
                 if status_type.target_type == StatusType.STATUS_TARGET_USER:
                     if user is not None and user.is_authenticated:
@@ -1031,12 +1349,18 @@ def update_user_and_device_statuses(
                             other_data = validated_status_data
                         else:
                             other_data.update(validated_status_data)
-                        user.save()
+                        if deferred_writes is not None:
+                            deferred_writes['instances'][('user', user.pk)] = user
+                        else:
+                            user.save()
                 
                 if status_type.target_type == StatusType.STATUS_TARGET_METER:
                     pass
                     # ToDo: Save meter data here
 
+    if save_context:
+        save_status_processing_context(device, status_processing_context)
+
     if any(calculated_alarm_status_data):
         evaluate_device_status_alarms(
             device=device,
@@ -1071,6 +1395,7 @@ def replay_stored_raw_data(
         'current_raw_data': {},
         'day_start_utc': replay_start_time,
         'month_start_utc': replay_month_start_time,
+        'deferred_writes': new_deferred_status_writes(),
     }
     raw_data_queryset = RawData.objects.filter(
         device=device,
@@ -1088,10 +1413,17 @@ def replay_stored_raw_data(
             created_at__gte=replay_start_time,
             created_at__lt=end_time,
         ).delete()
+    # The live context may reference replaced statuses, rebuild it on the next message.
+    invalidate_status_processing_context(device)
+
+    # One query for the whole window instead of a stored weather lookup per raw row.
+    weather_series = get_stored_weather_series(device, replay_start_time, end_time)
 
     processed_raw_count = 0
     replayed_raw_count = 0
     skipped_status_raw_count = 0
+    inserted_status_count = 0
+    replay_started = time.monotonic()
 
     def emit_progress(phase='replaying', force=False, raw_entry=None):
         if not callable(progress_callback):
@@ -1105,12 +1437,14 @@ def replay_stored_raw_data(
         else:
             progress_percent = 99
 
+        elapsed_seconds = time.monotonic() - replay_started
         progress_callback({
             'phase': phase,
             'processed_raw_count': processed_raw_count,
             'replayed_raw_count': replayed_raw_count,
             'skipped_status_raw_count': skipped_status_raw_count,
             'deleted_status_count': deleted_status_count,
+            'inserted_status_count': inserted_status_count,
             'total_raw_count': total_raw_count,
             'current_raw_time': (
                 raw_entry.data_arrival_time.isoformat()
@@ -1118,45 +1452,55 @@ def replay_stored_raw_data(
                 else None
             ),
             'progress_percent': progress_percent,
+            'elapsed_seconds': round(elapsed_seconds, 3),
+            'rows_per_second': round(processed_raw_count / elapsed_seconds, 1) if elapsed_seconds > 0 else 0,
         })
 
     emit_progress(phase='starting', force=True)
 
-    for raw_entry in raw_data_queryset.iterator():
-        processed_raw_count += 1
+    chunk_size = timedelta(hours=max(1, STATUS_REPLAY_CHUNK_HOURS))
+    chunk_start = replay_start_time
+    try:
+        while chunk_start < end_time:
+            chunk_end = min(chunk_start + chunk_size, end_time)
+            raw_data_chunk = raw_data_queryset.filter(
+                data_arrival_time__gte=chunk_start,
+                data_arrival_time__lt=chunk_end,
+            )
+            for raw_entry in raw_data_chunk.iterator():
+                processed_raw_count += 1
 
-        if raw_entry.data_type == 'status':
-            skipped_status_raw_count += 1
-            continue
+                if raw_entry.data_type == 'status':
+                    skipped_status_raw_count += 1
+                    continue
 
-        stored_weather_data = get_weather_data_cached(
-            device,
-            use_cache=False,
-            reference_time=raw_entry.data_arrival_time,
-            allow_fetch=False,
-            store_in_raw_data=False,
-        )
-        replay_context_data = {}
-        if stored_weather_data:
-            replay_context_data['weather'] = stored_weather_data
+                replay_context_data = {}
+                weather_data = weather_series.at(raw_entry.data_arrival_time)
+                if weather_data:
+                    replay_context_data['weather'] = weather_data
 
-        update_user_and_device_statuses(
-            user,
-            device,
-            raw_entry,
-            raw_entry.data,
-            replay_context_data,
-            status_created_at=raw_entry.data_arrival_time,
-            status_types=status_types,
-            status_processing_context=status_processing_context,
-            min_status_interval_minutes=replay_status_interval_minutes,
-            enforce_min_status_interval=True,
-        )
+                update_user_and_device_statuses(
+                    user,
+                    device,
+                    raw_entry,
+                    raw_entry.data,
+                    replay_context_data,
+                    status_created_at=raw_entry.data_arrival_time,
+                    status_types=status_types,
+                    status_processing_context=status_processing_context,
+                    min_status_interval_minutes=replay_status_interval_minutes,
+                    enforce_min_status_interval=True,
+                )
+
+                if raw_entry.data_arrival_time >= start_time:
+                    replayed_raw_count += 1
 
-        if raw_entry.data_arrival_time >= start_time:
-            replayed_raw_count += 1
+                emit_progress(raw_entry=raw_entry)
 
-        emit_progress(raw_entry=raw_entry)
+            inserted_status_count += flush_deferred_status_writes(status_processing_context)
+            chunk_start = chunk_end
+    finally:
+        inserted_status_count += flush_deferred_status_writes(status_processing_context)
 
     emit_progress(phase='completed', force=True)
 
@@ -1165,7 +1509,9 @@ def replay_stored_raw_data(
         'replayed_raw_count': replayed_raw_count,
         'skipped_status_raw_count': skipped_status_raw_count,
         'deleted_status_count': deleted_status_count,
+        'inserted_status_count': inserted_status_count,
         'total_raw_count': total_raw_count,
+        'elapsed_seconds': round(time.monotonic() - replay_started, 3),
         'replay_status_interval_minutes': replay_status_interval_minutes,
         'replay_target_types': list(replay_target_types or []),
         'replay_start_time': replay_start_time,
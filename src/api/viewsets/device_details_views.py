@@ -1,5 +1,4 @@
 import os
-import csv
 import logging
 import tempfile
 import threading
@@ -9,6 +8,8 @@ from datetime import datetime, time, timedelta
 
 import pytz
 import simplejson as json
+from api.buffers import device_state_writer
+from api.exports import EXPORT_FORMAT_CSV, EXPORT_FORMAT_NDJSON, parse_export_time, stream_data_export
 from api.permissions import IsDevice, IsDeviceUser
 from api.serializers import StatusTypeSerializer
 from api.utils import get_existing_status_data_for_today, get_or_create_user_device, invalidate_alarm_evaluation_cache, merge_device_other_data, process_raw_data, replay_stored_raw_data
@@ -18,6 +19,7 @@ if getattr(settings, 'CLICKHOUSE_ENABLED', False):
     from device.clickhouse_models import DerivedData
 else:
     DerivedData = None
+from device.device_cache import device_cache
 from device.models import (Command, Device, AssetStatus, DeviceProperty, Meter, RawData, StatusType,
                            UserDeviceType)
 from device_schemas.schema import (get_status_expression_helper_content,
@@ -28,7 +30,7 @@ from django.core.files.storage import FileSystemStorage
 from django.db import close_old_connections
 from django.db.utils import DatabaseError
 from django.db.models import Q
-from django.http import HttpResponse, FileResponse
+from django.http import FileResponse
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from device.models.ota import DeviceConfig
@@ -138,6 +140,8 @@ def _build_reprocess_response(
         'skipped_status_raw_count': result['skipped_status_raw_count'],
         'deleted_status_count': result['deleted_status_count'],
         'total_raw_count': result.get('total_raw_count', 0),
+        'inserted_status_count': result.get('inserted_status_count', 0),
+        'elapsed_seconds': result.get('elapsed_seconds'),
         'replay_start_time': result['replay_start_time'].isoformat(),
         'start_time': result['start_time'].isoformat(),
         'end_time': result['end_time'].isoformat(),
@@ -177,6 +181,8 @@ def _run_reprocess_job(
             total_raw_count = progress.get('total_raw_count') or 0
             processed_raw_count = progress.get('processed_raw_count') or 0
             progress_message = f'Processed {processed_raw_count} of {total_raw_count} raw entries.'
+            if progress.get('rows_per_second'):
+                progress_message = f"{progress_message} ({progress['rows_per_second']} rows/s)"
             if progress.get('current_raw_time'):
                 progress_message = f"{progress_message} Current raw time: {progress['current_raw_time']}"
 
@@ -255,9 +261,13 @@ class HeartbeatViewSet(viewsets.ViewSet):
         logger.info(f"heartbeat data received: {request.data}")
 
         device_mac = request.data.get("mac")
-        device = Device.objects.filter(
-            mac=device_mac
-        ).first()
+        device = None
+        if device_mac:
+            device = device_cache.get(
+                ('mac', device_mac),
+                lambda: Device.objects.filter(mac=device_mac).first(),
+            )
+        device_state_writer.merge_into([device])
 
         utc_timestamp = int(datetime.utcnow().timestamp())
         resp = f"HEARTBEAT_ACK [{utc_timestamp}]"
@@ -966,8 +976,15 @@ class DeviceDetailsViewSet(viewsets.ViewSet):
         requested_device_id = str(device_id)
         cached_data = cache.get("device_static_data_{}".format(requested_device_id))
 
+        # Volatile other_data fields are written behind, overlay the latest values.
+        device_state = device_state_writer.get_many([device.pk]).get(device.pk)
         if cached_data is not None:
-            return Response(json.loads(cached_data))
+            device_data = json.loads(cached_data)
+            if device_state:
+                device_data['other_data'] = {**(device_data.get('other_data') or {}), **device_state}
+            return Response(device_data)
+        if device_state:
+            device.other_data = {**(device.other_data or {}), **device_state}
 
         latest_status = AssetStatus.objects.filter(
             device=device,
@@ -1291,6 +1308,34 @@ class DeviceDetailsViewSet(viewsets.ViewSet):
         selected_y_params = request.data.get("y_params")
         # aggregate_data = request.GET.get('aggregate', 'yes')
 
+        if export_type != "json":
+            export_devices = list(devices) if isinstance(devices, Iterable) else [devices]
+            try:
+                resume_from = parse_export_time(
+                    request.data.get("resumeFrom") or request.query_params.get("resumeFrom")
+                )
+            except ValueError:
+                return Response({"error": "Invalid resumeFrom value."}, status=status.HTTP_400_BAD_REQUEST)
+            resume_after_id = request.data.get("resumeAfterId") or request.query_params.get("resumeAfterId")
+            if resume_after_id:
+                try:
+                    resume_after_id = uuid.UUID(str(resume_after_id))
+                except ValueError:
+                    return Response({"error": "Invalid resumeAfterId value."}, status=status.HTTP_400_BAD_REQUEST)
+            else:
+                resume_after_id = None
+            return stream_data_export(
+                export_devices,
+                data_type,
+                start_time,
+                end_time,
+                export_format=EXPORT_FORMAT_NDJSON if export_type == EXPORT_FORMAT_NDJSON else EXPORT_FORMAT_CSV,
+                compress=str(request.data.get("compress", "")).lower() in ("1", "true", "gzip"),
+                resume_from=resume_from,
+                resume_after_id=resume_after_id,
+                filename=f"{device_id}-{data_type}",
+            )
+
         data_report = DataReports(devices, multiple=isinstance(devices, Iterable))
         data = None
         if data_type in ["raw", "raw_data"]:
@@ -1303,8 +1348,6 @@ class DeviceDetailsViewSet(viewsets.ViewSet):
                     Meter.HOUSEHOLD_AC_METER, Meter.LOAD_AC_METER
                 ]
             )
-        elif export_type != "json":
-            data = data_report.get_status_data([data_type], start_time, end_time)
         if export_type == "json":
             if data_type == "status":
                 data = data_report.get_current_day_status_data(start_time)
@@ -1360,45 +1403,6 @@ class DeviceDetailsViewSet(viewsets.ViewSet):
                     dynamic_data[param] = data_list
                 data = {"error": "success", "dynamic_data": dynamic_data}
             return Response(data)
-        else:
-            header = ["data_arrival_time", "device", "channel", "data_type", "data"]
-            csv_data = []
-            if data is not None:
-                for dt in data:
-                    if isinstance(dt, dict):
-                        rl_data = dt.get("status")
-                        data_arrival_time = dt.get("created_at")
-                        channel = "calculated"
-                        data_type = dt.get("name")
-                        ip_address = data_report.device.ip_address
-                    else:
-                        rl_data = dt.data
-                        data_arrival_time = dt.data_arrival_time.strftime(settings.TIME_FORMAT_STRING)
-                        channel = dt.channel
-                        data_type = dt.data_type
-                        ip_address = dt.device.ip_address
-
-                    if data_arrival_time is None:
-                        data_arrival_time = dt.created_at
-
-                    csv_data.append([
-                        data_arrival_time,
-                        channel,
-                        data_type,
-                        ip_address,
-                        json.dumps(rl_data)
-                    ])
-            # Create the HttpResponse object with the appropriate CSV header.
-            response = HttpResponse(
-                content_type="text/csv",
-                headers={"Content-Disposition": f'attachment; filename="{device_id}-{data_type}.csv"'},
-            )
-
-            writer = csv.writer(response)
-            writer.writerow(header)
-            writer.writerows(csv_data)
-
-            return response
 
     def send_command(self, request, device_id):
         device, is_admin = is_device_admin(request.user, device_id)
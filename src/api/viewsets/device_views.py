@@ -1,6 +1,7 @@
 import datetime
 import logging
 
+from api.buffers import device_state_writer
 from api.permissions import IsDeviceUser
 from device.models import Device, UserDeviceType
 from dashboard.models import Widget, UserWidget
@@ -53,6 +54,8 @@ class DeviceViewSet(viewsets.ViewSet):
         devices_list = []
         error = "success"
 
+        # Volatile other_data fields are written behind, overlay the latest values.
+        device_state_writer.merge_into(page_obj)
         for device in page_obj:
             other_data = device.other_data
 
@@ -2,6 +2,7 @@ import os
 import json
 from datetime import datetime, timezone as dt_timezone
 
+from device.device_cache import device_cache
 from django.conf import settings
 from django.utils import timezone
 from rest_framework import viewsets
@@ -53,6 +54,8 @@ class HealthViewSet(viewsets.ViewSet):
             "mqtt-listener": self._check_mqtt_listener(),
             "celery-workers": self._check_celery_workers(),
             "clickhouse-sync": self._check_clickhouse_sync(),
+            "device-cache": self._check_device_cache(),
+            "websocket-ingest": self._check_websocket_ingest(),
         }
 
     def _check_mqtt_listener(self):
@@ -114,8 +117,17 @@ class HealthViewSet(viewsets.ViewSet):
             "heartbeat_file": settings.MQTT_HEALTH_FILE,
         }
 
+        ingest = payload.get("ingest")
+        if ingest:
+            response["ingest"] = ingest
+        if payload.get("device_cache"):
+            response["device_cache"] = payload["device_cache"]
+
         if check_status == "unhealthy":
             response["reason"] = "MQTT heartbeat is stale."
+        elif ingest and any(depth >= ingest.get("queue_size", 0) for depth in ingest.get("queue_depth", [])):
+            response["status"] = "degraded"
+            response["reason"] = "MQTT ingestion queue is full, the listener is applying backpressure."
 
         return response
 
@@ -200,6 +212,27 @@ class HealthViewSet(viewsets.ViewSet):
 
         return payload
 
+    def _check_device_cache(self):
+        # Lookups made by this process, e.g. websocket ingestion; the MQTT
+        # listener reports its own cache with its heartbeat.
+        return {
+            "status": "healthy",
+            **device_cache.stats(),
+        }
+
+    def _check_websocket_ingest(self):
+        from api.socket_consumers import socket_ingest_stats
+
+        stats = socket_ingest_stats()
+        ingest = stats["ingest"]
+        response = {"status": "healthy" if ingest is not None else "disabled", **stats}
+        if ingest is None:
+            response["reason"] = "No websocket frames were ingested by this process."
+        elif any(depth >= ingest.get("queue_size", 0) for depth in ingest.get("queue_depth", [])):
+            response["status"] = "degraded"
+            response["reason"] = "Websocket ingestion queue is full, acks are delayed."
+        return response
+
     def _calculate_overall_status(self, checks):
         statuses = [check.get("status", "unknown") for check in checks.values()]
         if "unhealthy" in statuses:
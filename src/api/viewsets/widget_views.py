@@ -1,6 +1,6 @@
 from api.permissions import IsDeviceUser
+from api.rollups import get_daily_summary
 from dashboard.models import DASHBOARD_SOURCES, Widget
-from device.models import DeviceProperty, RawData
 from django.conf import settings
 from django.utils import timezone
 from rest_framework import viewsets
@@ -31,8 +31,6 @@ class WidgetViewSet(viewsets.ViewSet):
     def get_widgets(self, request):
 
         user = request.user
-        now = timezone.now()
-        today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
         user_data = {
             "results": []
         }
@@ -46,76 +44,8 @@ class WidgetViewSet(viewsets.ViewSet):
             for widget in Widget.objects.filter(name__in=widget_ids)
         }
 
-        total_devices = 0
-        active_devices = 0
-        total_energy_generated_this_day = 0
-        total_energy_generation_limit_this_day = 0
-        total_energy_consumed_this_day = 0
-        total_energy_consumption_limit_this_day = 0
-        total_energy_imported_this_day = 0
-        total_energy_import_limit_this_day = 0
-        total_energy_exported_this_day = 0
-        total_energy_export_limit_this_day = 0
-
-        user_devices = user.device_list(return_objects=True)
-        user_device_ids = [d.id for d in user_devices]
-
-        active_device_ids = set(
-            RawData.objects.filter(
-                device_id__in=user_device_ids,
-                data_arrival_time__gte=today_start
-            ).values_list('device_id', flat=True).distinct()
-        )
-        active_devices = len(active_device_ids)
-
-        required_property_names = [
-            "energy_generated_this_day",
-            "energy_generation_limit_this_day",
-            "energy_consumed_this_day",
-            "energy_consumption_limit_this_day",
-            "energy_imported_this_day",
-            "energy_import_limit_this_day",
-            "energy_exported_this_day",
-            "energy_export_limit_this_day",
-        ]
-        all_dev_props = DeviceProperty.objects.filter(
-            device_id__in=user_device_ids,
-            name__in=required_property_names
-        ).values_list('device_id', 'name', 'value')
-        all_dev_prop_values = {}
-        for device_id, property_name, property_value in all_dev_props:
-            existing_values = all_dev_prop_values.get(str(device_id), {})
-            existing_values[property_name] = property_value
-            all_dev_prop_values[str(device_id)] = existing_values
-
-        for device in user_devices:
-            properties = all_dev_prop_values.get(str(device.id), {})
-            total_devices += 1
-
-            total_energy_generated_this_day += float(properties.get("energy_generated_this_day", 0.0))
-            total_energy_generation_limit_this_day += float(properties.get("energy_generation_limit_this_day", 0.0))
-
-            total_energy_consumed_this_day += float(properties.get("energy_consumed_this_day", 0.0))
-            total_energy_consumption_limit_this_day += float(properties.get("energy_consumption_limit_this_day", 0.0))
-
-            total_energy_imported_this_day += float(properties.get("energy_imported_this_day", 0.0))
-            total_energy_import_limit_this_day += float(properties.get("energy_import_limit_this_day", 0.0))
-
-            total_energy_exported_this_day += float(properties.get("energy_exported_this_day", 0.0))
-            total_energy_export_limit_this_day += float(properties.get("energy_export_limit_this_day", 0.0))
-
-        summary_daya = {
-            "total_devices": total_devices,
-            "active_devices": active_devices,
-            "total_energy_generated_this_day": total_energy_generated_this_day,
-            "total_energy_generation_limit_this_day": total_energy_generation_limit_this_day,
-            "total_energy_consumed_this_day": total_energy_consumed_this_day,
-            "total_energy_consumption_limit_this_day": total_energy_consumption_limit_this_day,
-            "total_energy_imported_this_day": total_energy_imported_this_day,
-            "total_energy_import_limit_this_day": total_energy_import_limit_this_day,
-            "total_energy_exported_this_day": total_energy_exported_this_day,
-            "total_energy_export_limit_this_day": total_energy_export_limit_this_day,
-        }
+        # Maintained per device as data and statuses arrive, see api.rollups.
+        summary_daya = get_daily_summary(user.device_timezones())
 
         dashboard_details_cache = {}
 
@@ -1,8 +1,27 @@
-from sklearn import linear_model
-from sklearn.neural_network import MLPClassifier
 import os
 import csv
 import pickle
+import threading
+import time
+
+MODEL_EXTENSION = '.coef'
+MODELS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def model_files(dir_path):
+    """
+        Returns the model names and paths of the .coef files in dir_path.
+    """
+    return {
+        file_name[:-len(MODEL_EXTENSION)]: os.path.join(dir_path, file_name)
+        for file_name in os.listdir(dir_path)
+        if file_name.endswith(MODEL_EXTENSION)
+    }
+
+
+def read_model(path):
+    with open(path, 'rb') as model_file:
+        return pickle.load(model_file)
 
 
 class Train(object):
@@ -14,13 +33,8 @@ class Train(object):
         self.read_models()
 
     def read_models(self):
-        self.targets = {}
-        self.dir_path = os.path.dirname(os.path.abspath(__file__))
-
-        files_list = os.listdir(self.dir_path)
-        for file_name in files_list:
-            if file_name.endswith('.coef'):
-                self.targets[file_name.strip('.coef')] = pickle.load(open(os.path.join(self.dir_path, file_name), 'rb'))
+        self.dir_path = MODELS_DIR
+        self.targets = {name: read_model(path) for name, path in model_files(self.dir_path).items()}
 
     def read_csv(self, filename):
         X = []
@@ -45,6 +59,8 @@ class Train(object):
         return X, Y
 
     def train(self):
+        from sklearn import linear_model
+
         self.model_list = []
         X = []
         Y = []
@@ -67,6 +83,71 @@ class Train(object):
             pickle.dump(self.reg, open(self.dir_path + "/{}.coef".format(self.y_header[i]), 'wb'))
 
 
+class ModelRegistry(object):
+    """
+        Process wide registry of the trained models, read on first use.
+
+        The models are read again when a .coef file is added, removed or
+        modified, checked at most every check_interval seconds. A registry
+        read before a fork is shared with the children.
+    """
+
+    def __init__(self, dir_path=MODELS_DIR, check_interval=60):
+        self.dir_path = dir_path
+        self.check_interval = check_interval
+        self.reads = 0
+        self._targets = None
+        self._signature = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        # A thread of the parent may have held the lock while forking.
+        self._lock = threading.Lock()
+
+    def signature(self):
+        signature = []
+        for name, path in sorted(model_files(self.dir_path).items()):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            signature.append((name, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    @property
+    def targets(self):
+        """
+            Returns the models by name, the same dict until they are read again.
+        """
+        checked_at = self._checked_at
+        if checked_at is not None and time.monotonic() - checked_at < self.check_interval:
+            return self._targets
+        with self._lock:
+            if self._checked_at is checked_at:
+                self._refresh()
+            return self._targets
+
+    def _refresh(self):
+        signature = self.signature()
+        if signature != self._signature:
+            try:
+                self._targets = {
+                    name: read_model(os.path.join(self.dir_path, name + MODEL_EXTENSION))
+                    for name, _, _ in signature
+                }
+            except Exception:
+                # A file may be read while it is written, keep the models read before.
+                if self._targets is None:
+                    raise
+            else:
+                self._signature = signature
+                self.reads += 1
+        self._checked_at = time.monotonic()
+
+
 if __name__ == '__main__':
 
     model = Train()
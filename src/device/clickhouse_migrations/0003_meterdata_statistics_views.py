@@ -0,0 +1,91 @@
+"""
+Hourly and daily pre-aggregated meterdata statistics.
+
+Each granularity is an AggregatingMergeTree table holding the aggregate states
+of every (meter, bucket), filled by a materialized view on inserts into
+meterdata. Each view takes its cutoff right after it is created, and rows
+stored before that are copied in by a backfill of `data_arrival_time <
+cutoff`; rows inserted once the view exists go through it, so the only rows
+counted twice are the ones inserted within about a second of creating a
+view with a time before its cutoff.
+
+Buckets start on UTC hours and days, whatever the server timezone, to line up
+with the segments `plan_statistics_sources` splits a range into.
+"""
+from datetime import datetime, timedelta, timezone
+
+from device.clickhouse_models.data import MeterData
+from django_clickhouse import migrations
+
+STATISTICS_FIELDS = (
+    ('voltage', 'Float64'),
+    ('current', 'Float64'),
+    ('power', 'Float64'),
+    ('energy', 'Float64'),
+    ('runtime', 'Int64'),
+    ('frequency', 'Float64'),
+    ('temperature', 'Float64'),
+)
+
+VIEWS = (
+    ('meterdata_hourly', 'toStartOfHour'),
+    ('meterdata_daily', 'toStartOfDay'),
+)
+
+
+def _columns():
+    columns = [
+        'meter UUID',
+        "bucket DateTime('UTC')",
+        'data_points AggregateFunction(count)',
+        'initial_time AggregateFunction(min, DateTime)',
+        'final_time AggregateFunction(max, DateTime)',
+    ]
+    for field, field_type in STATISTICS_FIELDS:
+        for function in ('avg', 'min', 'max'):
+            columns.append(f'{function}_{field} AggregateFunction({function}, {field_type})')
+    return ',\n    '.join(columns)
+
+
+def _select_states(bucket_function):
+    states = [
+        'meter',
+        f"{bucket_function}(data_arrival_time, 'UTC') AS bucket",
+        'countState() AS data_points',
+        'minState(data_arrival_time) AS initial_time',
+        'maxState(data_arrival_time) AS final_time',
+    ]
+    for field, _ in STATISTICS_FIELDS:
+        for function in ('avg', 'min', 'max'):
+            states.append(f'{function}State({field}) AS {function}_{field}')
+    return 'SELECT\n    ' + ',\n    '.join(states) + '\nFROM $db.meterdata'
+
+
+def create_statistics_views(database):
+    for table, bucket_function in VIEWS:
+        database.raw(
+            f'CREATE TABLE IF NOT EXISTS $db.{table} (\n    {_columns()}\n)\n'
+            f'ENGINE = AggregatingMergeTree()\n'
+            f'PARTITION BY toYYYYMM(bucket)\n'
+            f'ORDER BY (meter, bucket)'
+        )
+        database.raw(
+            f'CREATE MATERIALIZED VIEW IF NOT EXISTS $db.{table}_mv TO $db.{table} AS\n'
+            f'{_select_states(bucket_function)}\n'
+            f'GROUP BY meter, bucket'
+        )
+        # Taken once the view exists and rounded up to the second, so no row stored before
+        # it falls between the backfill and the view.
+        cutoff = (datetime.now(timezone.utc) + timedelta(seconds=1)).strftime('%Y-%m-%d %H:%M:%S')
+        database.raw(
+            f'INSERT INTO $db.{table}\n'
+            f"{_select_states(bucket_function)}\n"
+            f"WHERE data_arrival_time < toDateTime('{cutoff}', 'UTC')\n"
+            f'GROUP BY meter, bucket'
+        )
+
+
+class Migration(migrations.Migration):
+    operations = [
+        migrations.RunPython(create_statistics_views, hints={'model': MeterData})
+    ]
@@ -0,0 +1,66 @@
+"""
+Sort meterload by (device, data_arrival_time) instead of (device) alone, so
+the loads of one device in a time window are read without scanning all of
+that device's rows.
+
+ClickHouse cannot extend the sorting key of an existing MergeTree with a
+column, the table is copied into one with the new key and swapped in. Loads
+inserted during the copy are copied over from the old table after the swap,
+by `data_arrival_time` above the newest copied load. The old table is kept
+as meterload_unsorted; drop it once the row counts are checked.
+"""
+import logging
+
+from device.clickhouse_models.data import MeterLoad
+from django_clickhouse import migrations
+
+logger = logging.getLogger('django')
+
+SORTING_KEY = 'device, data_arrival_time'
+
+
+def _count(database, table):
+    return int(database.raw(f'SELECT count() FROM $db.{table}').strip())
+
+
+def resort_meterload(database):
+    sorting_key = database.raw(
+        "SELECT sorting_key FROM system.tables WHERE database = currentDatabase() AND name = 'meterload'"
+    ).strip()
+    if sorting_key == SORTING_KEY:
+        return
+
+    database.raw('DROP TABLE IF EXISTS $db.meterload_resorted')
+    database.raw(
+        'CREATE TABLE $db.meterload_resorted AS $db.meterload\n'
+        'ENGINE = MergeTree()\n'
+        'PARTITION BY toYYYYMM(data_arrival_time)\n'
+        f'ORDER BY ({SORTING_KEY})'
+    )
+    database.raw('INSERT INTO $db.meterload_resorted SELECT * FROM $db.meterload')
+    copied_until = int(database.raw(
+        'SELECT toUnixTimestamp(max(data_arrival_time)) FROM $db.meterload_resorted'
+    ).strip())
+    database.raw(
+        'RENAME TABLE $db.meterload TO $db.meterload_unsorted, $db.meterload_resorted TO $db.meterload'
+    )
+    # Loads inserted into the old table while it was copied.
+    database.raw(
+        'INSERT INTO $db.meterload SELECT * FROM $db.meterload_unsorted\n'
+        f'WHERE data_arrival_time > toDateTime({copied_until})'
+    )
+
+    resorted = _count(database, 'meterload')
+    unsorted = _count(database, 'meterload_unsorted')
+    if resorted < unsorted:
+        logger.warning(
+            "meterload has %s rows after resorting, meterload_unsorted %s; "
+            "compare them before dropping meterload_unsorted",
+            resorted, unsorted,
+        )
+
+
+class Migration(migrations.Migration):
+    operations = [
+        migrations.RunPython(resort_meterload, hints={'model': MeterLoad})
+    ]
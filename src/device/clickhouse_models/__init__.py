@@ -3,6 +3,7 @@ from .data import (
     WeatherData,
     DerivedData,
     MeterLoad,
+    clickhouse_buffer,
     create_model_instance
 )
 
@@ -11,5 +12,6 @@ __all__ = (
     'WeatherData',
     'DerivedData',
     'MeterLoad',
+    'clickhouse_buffer',
     'create_model_instance'
 )
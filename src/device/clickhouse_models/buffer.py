@@ -0,0 +1,266 @@
+import atexit
+import logging
+import os
+import threading
+import time
+import zlib
+
+from django.conf import settings
+from infi.clickhouse_orm.database import ServerError
+
+logger = logging.getLogger('django')
+
+
+class ClickHouseInsertBuffer:
+    """
+        Shared insert buffer for ClickHouse models.
+
+        Instances are collected per model and written with one INSERT per
+        table once `batch_size` rows are pending or the oldest row is
+        `max_delay_seconds` old, which keeps MergeTree part counts low. Writes
+        happen on a background thread and are retried; when ClickHouse stays
+        unreachable the batch is spilled to `spill_dir` as TabSeparated rows and
+        re-sent ahead of new data by the next successful flush, `batch_size`
+        rows per insert. A spilled chunk ClickHouse rejects `spill_attempts`
+        times is moved to a `.rejected` file, so it does not hold back the rest.
+    """
+
+    def __init__(self, models=(), batch_size=500, max_delay_seconds=5.0, max_pending_rows=50000,
+                 retries=3, retry_delay_seconds=0.5, spill_dir=None, spill_attempts=3):
+        self.batch_size = max(1, int(batch_size))
+        self.max_delay_seconds = float(max_delay_seconds)
+        self.max_pending_rows = int(max_pending_rows)
+        self.retries = max(0, int(retries))
+        self.retry_delay_seconds = float(retry_delay_seconds)
+        self.spill_dir = spill_dir
+        self.spill_attempts = max(1, int(spill_attempts))
+        # Rejections of spilled chunks, by (table, crc32 of the chunk).
+        self._spill_rejections = {}
+        self._models = {model.table_name(): model for model in models}
+        self._pending = {}
+        self._pending_since = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._flusher = None
+        self.rows_buffered = 0
+        self.rows_flushed = 0
+        self.rows_spilled = 0
+        self.rows_dropped = 0
+        self.rows_rejected = 0
+        self.failed_flushes = 0
+
+    def add(self, instance):
+        self.extend([instance])
+        return instance
+
+    def extend(self, instances):
+        instances = list(instances)
+        if not instances:
+            return
+        model = instances[0].__class__
+        with self._lock:
+            self._models.setdefault(model.table_name(), model)
+            pending = self._pending.setdefault(model, [])
+            pending.extend(instances)
+            self.rows_buffered += len(instances)
+            overflow = len(pending) - self.max_pending_rows
+            if overflow > 0:
+                del pending[:overflow]
+                self.rows_dropped += overflow
+                logger.warning("ClickHouse buffer for %s is full, dropped %s oldest rows", model.table_name(), overflow)
+            if self._pending_since is None:
+                self._pending_since = time.monotonic()
+            if len(pending) >= self.batch_size:
+                self._wakeup.set()
+        self._ensure_flusher()
+
+    def flush(self):
+        """Write every pending batch, retrying and spilling to disk on failure."""
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = {}
+                self._pending_since = None
+
+            self._send_spilled()
+            for model, instances in pending.items():
+                if instances:
+                    self._flush_model(model, instances)
+
+    def _flush_model(self, model, instances):
+        for attempt in range(self.retries + 1):
+            try:
+                model.objects.bulk_create(instances, batch_size=max(self.batch_size, len(instances)))
+            except Exception as ex:
+                logger.warning(
+                    "ClickHouse insert of %s rows into %s failed (attempt %s): %s",
+                    len(instances), model.table_name(), attempt + 1, ex,
+                )
+                if attempt < self.retries and not self._stopped.is_set():
+                    time.sleep(self.retry_delay_seconds * (2 ** attempt))
+            else:
+                self.rows_flushed += len(instances)
+                return True
+
+        self.failed_flushes += 1
+        self._spill(model, instances)
+        return False
+
+    def _spill_path(self, table_name):
+        return os.path.join(self.spill_dir, f"{table_name}.tsv")
+
+    def _spill(self, model, instances):
+        if not self.spill_dir:
+            self.rows_dropped += len(instances)
+            logger.error("Dropped %s rows for %s, no spill directory configured", len(instances), model.table_name())
+            return
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            with open(self._spill_path(model.table_name()), "ab") as handle:
+                for instance in instances:
+                    handle.write(instance.to_db_string())
+        except Exception as ex:
+            self.rows_dropped += len(instances)
+            logger.exception("Failed to spill %s rows for %s: %s", len(instances), model.table_name(), ex)
+        else:
+            self.rows_spilled += len(instances)
+
+    def _send_spilled(self):
+        if not self.spill_dir or not os.path.isdir(self.spill_dir):
+            return
+        for file_name in sorted(os.listdir(self.spill_dir)):
+            model = self._models.get(file_name[:-len(".tsv")]) if file_name.endswith(".tsv") else None
+            if model is None:
+                continue
+            path = os.path.join(self.spill_dir, file_name)
+            # Rename first so rows spilled while sending land in a fresh file.
+            sending_path = f"{path}.sending"
+            try:
+                os.replace(path, sending_path)
+                with open(sending_path, "rb") as handle:
+                    rows = handle.read().splitlines(keepends=True)
+            except Exception as ex:
+                logger.warning("Reading spilled rows for %s failed: %s", model.table_name(), ex)
+                self._restore_spill(sending_path, path)
+                return
+            sent = 0
+            while sent < len(rows):
+                chunk = b"".join(rows[sent:sent + self.batch_size])
+                if not self._send_spilled_chunk(model, path, chunk):
+                    self._restore_spill(sending_path, path, b"".join(rows[sent:]))
+                    return
+                sent += self.batch_size
+            os.remove(sending_path)
+            logger.info("Re-sent spilled ClickHouse rows for %s", model.table_name())
+
+    def _send_spilled_chunk(self, model, path, chunk):
+        """Insert a chunk of spilled rows, returns False when the rest must wait for a later flush."""
+        rejection_key = (model.table_name(), zlib.crc32(chunk))
+        try:
+            self._insert_payload(model, chunk)
+        except ServerError as ex:
+            rejections = self._spill_rejections.get(rejection_key, 0) + 1
+            if rejections < self.spill_attempts:
+                self._spill_rejections[rejection_key] = rejections
+                logger.warning("ClickHouse rejected spilled rows for %s (attempt %s): %s",
+                               model.table_name(), rejections, ex)
+                return False
+            self._spill_rejections.pop(rejection_key, None)
+            with open(f"{path}.rejected", "ab") as handle:
+                handle.write(chunk)
+            self.rows_rejected += chunk.count(b"\n")
+            logger.error("Moved %s spilled rows for %s to %s.rejected after %s rejections: %s",
+                         chunk.count(b"\n"), model.table_name(), path, rejections, ex)
+            return True
+        except Exception as ex:
+            logger.warning("Re-sending spilled rows for %s failed: %s", model.table_name(), ex)
+            return False
+        self._spill_rejections.pop(rejection_key, None)
+        self.rows_flushed += chunk.count(b"\n")
+        return True
+
+    def _insert_payload(self, model, payload):
+        """Insert rows serialized by `to_db_string` through the public Database.raw."""
+        database = model.objects.get_database(for_write=True)
+        fields_list = ','.join('`%s`' % name for name in model.fields(writable=True))
+        row_format = 'TSKV' if model.has_funcs_as_defaults() else 'TabSeparated'
+        # raw() fills in $db with string.Template, which reads `$$` as an escaped `$`.
+        database.raw(
+            'INSERT INTO $db.`%s` (%s) FORMAT %s\n' % (model.table_name(), fields_list, row_format)
+            + payload.decode('utf-8').replace('$', '$$')
+        )
+
+    def _restore_spill(self, sending_path, path, payload=None):
+        """Put the unsent rows back ahead of the rows spilled meanwhile."""
+        if not os.path.exists(sending_path):
+            return
+        if payload is None:
+            with open(sending_path, "rb") as handle:
+                payload = handle.read()
+        if os.path.exists(path):
+            with open(path, "rb") as handle:
+                payload += handle.read()
+        with open(sending_path, "wb") as handle:
+            handle.write(payload)
+        os.replace(sending_path, path)
+
+    def _ensure_flusher(self):
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        self._stopped.clear()
+        self._flusher = threading.Thread(
+            target=self._run_flusher,
+            name="clickhouse-flusher",
+            daemon=True,
+        )
+        self._flusher.start()
+
+    def _run_flusher(self):
+        interval = max(0.05, self.max_delay_seconds / 4)
+        while not self._stopped.is_set():
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+            with self._lock:
+                pending_since = self._pending_since
+                batch_ready = any(len(instances) >= self.batch_size for instances in self._pending.values())
+            if pending_since is None:
+                continue
+            if batch_ready or time.monotonic() - pending_since >= self.max_delay_seconds:
+                try:
+                    self.flush()
+                except Exception as ex:
+                    logger.exception("ClickHouse buffer flush failed: %s", ex)
+
+    def close(self):
+        self._stopped.set()
+        self._wakeup.set()
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            pending_rows = sum(len(instances) for instances in self._pending.values())
+        return {
+            "pending_rows": pending_rows,
+            "rows_buffered": self.rows_buffered,
+            "rows_flushed": self.rows_flushed,
+            "rows_spilled": self.rows_spilled,
+            "rows_dropped": self.rows_dropped,
+            "rows_rejected": self.rows_rejected,
+            "failed_flushes": self.failed_flushes,
+        }
+
+
+def build_default_buffer(models):
+    buffer = ClickHouseInsertBuffer(
+        models=models,
+        batch_size=getattr(settings, 'CLICKHOUSE_INSERT_BATCH_SIZE', 500),
+        max_delay_seconds=getattr(settings, 'CLICKHOUSE_INSERT_MAX_DELAY_SECONDS', 5),
+        max_pending_rows=getattr(settings, 'CLICKHOUSE_INSERT_MAX_PENDING_ROWS', 50000),
+        retries=getattr(settings, 'CLICKHOUSE_INSERT_RETRIES', 3),
+        spill_dir=getattr(settings, 'CLICKHOUSE_SPILL_DIR', None),
+        spill_attempts=getattr(settings, 'CLICKHOUSE_SPILL_ATTEMPTS', 3),
+    )
+    atexit.register(buffer.close)
+    return buffer
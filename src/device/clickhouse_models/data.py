@@ -8,6 +8,8 @@ from django_clickhouse.engines import MergeTree
 from infi.clickhouse_orm import fields
 from infi.clickhouse_orm.utils import escape
 
+from .buffer import build_default_buffer
+
 
 class ForeignKeyField(fields.Field):
     class_default = UUID(int=0)
@@ -163,13 +165,17 @@ class MeterLoad(ClickHouseModel):
     power = fields.DecimalField(precision=8, scale=3)
     data_arrival_time = fields.DateTimeField()
 
-    engine = MergeTree('data_arrival_time', ('device', ))
+    engine = MergeTree('data_arrival_time', ('device', 'data_arrival_time'))
+
+
+clickhouse_buffer = build_default_buffer((MeterData, WeatherData, MeterLoad))
 
 
 def create_model_instance(model: ClickHouseModel, data):
     """
-        Method to create model instances
+        Method to create model instances.
+        The insert is buffered and written in batches, see ClickHouseInsertBuffer.
     """
     if 'id' not in data:
         data['id'] = str(uuid4())
-    return model.objects.create(**data)
+    return clickhouse_buffer.add(model(**data))
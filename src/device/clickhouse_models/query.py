@@ -0,0 +1,430 @@
+import datetime
+import logging
+import re
+import struct
+import threading
+import uuid
+from collections import namedtuple
+from decimal import Decimal
+
+import numpy as np
+import requests
+from django.conf import settings
+from infi.clickhouse_orm.database import ServerError
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger('django')
+
+ROW_BINARY_FORMAT = 'RowBinaryWithNamesAndTypes'
+
+_EPOCH_DATE = datetime.date(1970, 1, 1)
+_UUID_HALVES = struct.Struct('<QQ')
+
+
+def _uuid_from_bytes(value):
+    high, low = _UUID_HALVES.unpack(value)
+    return uuid.UUID(int=(high << 64) | low)
+
+
+def _date_from_days(value):
+    return _EPOCH_DATE + datetime.timedelta(days=value)
+
+
+def _datetime_from_timestamp(value):
+    return datetime.datetime.fromtimestamp(value, tz=datetime.timezone.utc)
+
+
+# struct formats and converters of the fixed width types, runs of these
+# columns are unpacked with one struct call per row.
+_FIXED_FORMATS = {
+    'UInt8': ('B', None),
+    'UInt16': ('H', None),
+    'UInt32': ('I', None),
+    'UInt64': ('Q', None),
+    'Int8': ('b', None),
+    'Int16': ('h', None),
+    'Int32': ('i', None),
+    'Int64': ('q', None),
+    'Float32': ('f', None),
+    'Float64': ('d', None),
+    'Bool': ('?', None),
+    'UUID': ('16s', _uuid_from_bytes),
+    'Date': ('H', _date_from_days),
+    'Date32': ('i', _date_from_days),
+    'DateTime': ('I', _datetime_from_timestamp),
+}
+# Types read straight into NumPy arrays by `select_arrays`, with the dtype
+# the raw values are converted to.
+_NUMPY_TYPES = {
+    'UInt8': ('<u1', None),
+    'UInt16': ('<u2', None),
+    'UInt32': ('<u4', None),
+    'UInt64': ('<u8', None),
+    'Int8': ('<i1', None),
+    'Int16': ('<i2', None),
+    'Int32': ('<i4', None),
+    'Int64': ('<i8', None),
+    'Float32': ('<f4', None),
+    'Float64': ('<f8', None),
+    'Bool': ('<u1', 'bool'),
+    'Date': ('<u2', 'datetime64[D]'),
+    'DateTime': ('<u4', 'datetime64[s]'),
+}
+_TYPE_PATTERN = re.compile(r"^(\w+)(?:\((.*)\))?$", re.DOTALL)
+
+
+def _split_type_arguments(arguments):
+    parts, depth, quoted, start = [], 0, False, 0
+    for index, char in enumerate(arguments):
+        if char == "'" and (index == 0 or arguments[index - 1] != '\\'):
+            quoted = not quoted
+        elif not quoted and char == '(':
+            depth += 1
+        elif not quoted and char == ')':
+            depth -= 1
+        elif not quoted and depth == 0 and char == ',':
+            parts.append(arguments[start:index].strip())
+            start = index + 1
+    parts.append(arguments[start:].strip())
+    return [part for part in parts if part]
+
+
+def _base_type(type_name):
+    match = _TYPE_PATTERN.match(type_name.strip())
+    if match is None:
+        raise ValueError(f"Unsupported ClickHouse type {type_name}")
+    name, arguments = match.group(1), match.group(2)
+    if name == 'DateTime':
+        # DateTime('UTC') is stored like DateTime.
+        return 'DateTime', []
+    return name, _split_type_arguments(arguments) if arguments else []
+
+
+def _decoder(type_name):
+    """Return a function reading one value of `type_name` from a _RowBinaryReader."""
+    name, arguments = _base_type(type_name)
+    if name in _FIXED_FORMATS:
+        fixed_format, convert = _FIXED_FORMATS[name]
+        unpacker = struct.Struct('<' + fixed_format)
+        if convert is None:
+            return lambda reader: unpacker.unpack(reader.read(unpacker.size))[0]
+        return lambda reader: convert(unpacker.unpack(reader.read(unpacker.size))[0])
+    if name == 'String':
+        return lambda reader: reader.read(reader.read_varint()).decode('utf-8', errors='replace')
+    if name == 'FixedString':
+        size = int(arguments[0])
+        return lambda reader: reader.read(size).rstrip(b'\0').decode('utf-8', errors='replace')
+    if name == 'DateTime64':
+        unpacker = struct.Struct('<q')
+        scale = 10 ** int(arguments[0])
+        return lambda reader: datetime.datetime.fromtimestamp(
+            unpacker.unpack(reader.read(8))[0] / scale, tz=datetime.timezone.utc
+        )
+    if name.startswith('Decimal'):
+        precision, scale = (int(arguments[0]), int(arguments[1])) if name == 'Decimal' else (
+            {'Decimal32': 9, 'Decimal64': 18, 'Decimal128': 38}[name], int(arguments[0])
+        )
+        size = 4 if precision <= 9 else 8 if precision <= 18 else 16
+        return lambda reader: Decimal(int.from_bytes(reader.read(size), 'little', signed=True)).scaleb(-scale)
+    if name == 'Nullable':
+        read_value = _decoder(arguments[0])
+        return lambda reader: None if reader.read(1) != b'\0' else read_value(reader)
+    if name == 'LowCardinality':
+        return _decoder(arguments[0])
+    if name == 'Array':
+        read_value = _decoder(arguments[0])
+        return lambda reader: [read_value(reader) for _ in range(reader.read_varint())]
+    raise ValueError(f"Unsupported ClickHouse type {type_name}")
+
+
+def _row_decoder(types):
+    """
+        Return (row_struct, converters, decode) for rows of `types`. When every
+        column is fixed width `row_struct` is the struct of the whole row and
+        `converters` the per column converters, else both are None. `decode`
+        reads one row from a _RowBinaryReader as a list.
+    """
+    steps = []
+    run_formats, run_converters = [], []
+
+    def close_run():
+        if run_formats:
+            unpacker = struct.Struct('<' + ''.join(run_formats))
+            steps.append((unpacker, tuple(run_converters)))
+            run_formats.clear()
+            run_converters.clear()
+
+    for type_name in types:
+        name = _base_type(type_name)[0]
+        if name in _FIXED_FORMATS:
+            fixed_format, convert = _FIXED_FORMATS[name]
+            run_formats.append(fixed_format)
+            run_converters.append(convert)
+        else:
+            close_run()
+            steps.append((None, _decoder(type_name)))
+    close_run()
+
+    def decode(reader):
+        row = []
+        for unpacker, step in steps:
+            if unpacker is None:
+                row.append(step(reader))
+            else:
+                values = unpacker.unpack(reader.read(unpacker.size))
+                row.extend(
+                    value if convert is None else convert(value) for value, convert in zip(values, step)
+                )
+        return row
+
+    if len(steps) == 1 and steps[0][0] is not None:
+        return steps[0][0], steps[0][1], decode
+    return None, None, decode
+
+
+def format_parameter(value):
+    """Format a query parameter value the way ClickHouse parses `{name:Type}` values."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, (list, tuple, set)):
+        return '[' + ','.join(_format_array_element(item) for item in value) + ']'
+    value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+def _format_array_element(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return str(value)
+    formatted = format_parameter(value)
+    if isinstance(value, (bool, list, tuple, set)):
+        return formatted
+    return "'" + formatted.replace("'", "\\'") + "'"
+
+
+class _RowBinaryReader:
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+        self._offset = 0
+
+    def _fill(self, size):
+        # Keeps at least `size` unread bytes buffered, returns False at the end of the stream.
+        parts = [self._buffer[self._offset:]]
+        available = len(parts[0])
+        while available < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._buffer, self._offset = b''.join(parts), 0
+                return False
+            if chunk:
+                parts.append(chunk)
+                available += len(chunk)
+        self._buffer, self._offset = b''.join(parts), 0
+        return True
+
+    def read(self, size):
+        end = self._offset + size
+        if end > len(self._buffer):
+            if not self._fill(size):
+                raise ServerError(
+                    "ClickHouse response ended in the middle of a value: "
+                    + self._buffer[self._offset:].decode('utf-8', errors='replace')[-500:]
+                )
+            end = size
+        data = self._buffer[self._offset:end]
+        self._offset = end
+        return data
+
+    def read_varint(self):
+        shift = result = 0
+        while True:
+            byte = self.read(1)[0]
+            result |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    def at_end(self):
+        return self._offset >= len(self._buffer) and not self._fill(1)
+
+    def read_rows(self, row_size, max_rows):
+        """Return the bytes of up to `max_rows` whole fixed size rows, b'' at the end."""
+        self._fill(row_size * max_rows)
+        rows = min(max_rows, (len(self._buffer) - self._offset) // row_size)
+        if rows == 0 and self._offset < len(self._buffer):
+            self.read(row_size)
+        return self.read(rows * row_size) if rows else b''
+
+
+class ClickHouseQueryClient:
+    """
+        Streaming ClickHouse query client over HTTP.
+
+        Queries bind their values as `{name:Type}` parameters, sent next to the
+        query instead of being formatted into it, and results are read as
+        RowBinaryWithNamesAndTypes in `chunk_size` pieces while they are
+        decoded, so memory stays flat however many rows a query returns.
+        Connections are kept alive in a pool of `pool_size` per process.
+    """
+
+    def __init__(self, db_url, db_name, username=None, password=None, pool_size=10, timeout_seconds=60,
+                 chunk_size=64 * 1024):
+        self.db_url = db_url
+        self.db_name = db_name
+        self.timeout_seconds = float(timeout_seconds)
+        self.chunk_size = max(1024, int(chunk_size))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, int(pool_size)))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if username:
+            self.session.auth = (username, password or '')
+        self.queries = 0
+        self.rows_read = 0
+
+    def _execute(self, query, params=None):
+        request_params = {'database': self.db_name}
+        for name, value in (params or {}).items():
+            request_params[f'param_{name}'] = format_parameter(value)
+        response = self.session.post(
+            self.db_url,
+            params=request_params,
+            data=f'{query.strip()}\nFORMAT {ROW_BINARY_FORMAT}'.encode('utf-8'),
+            stream=True,
+            timeout=self.timeout_seconds,
+        )
+        self.queries += 1
+        if response.status_code != 200:
+            try:
+                raise ServerError(response.text)
+            finally:
+                response.close()
+        return response
+
+    def _read_header(self, reader):
+        columns = reader.read_varint()
+        names = [reader.read(reader.read_varint()).decode('utf-8') for _ in range(columns)]
+        types = [reader.read(reader.read_varint()).decode('utf-8') for _ in range(columns)]
+        return names, types
+
+    def iter_rows(self, query, params=None):
+        """Yield the rows of `query` as namedtuples of typed values."""
+        response = self._execute(query, params)
+        try:
+            reader = _RowBinaryReader(response.iter_content(self.chunk_size))
+            if reader.at_end():
+                return
+            names, types = self._read_header(reader)
+            row_type = namedtuple('Row', names, rename=True)
+            row_struct, converters, decode = _row_decoder(types)
+            if row_struct is None:
+                while not reader.at_end():
+                    self.rows_read += 1
+                    yield row_type._make(decode(reader))
+                return
+
+            # Fixed width rows are unpacked a chunk at a time.
+            convert = any(converter is not None for converter in converters)
+            while True:
+                data = reader.read_rows(row_struct.size, max(1, self.chunk_size // row_struct.size))
+                if not data:
+                    return
+                for values in row_struct.iter_unpack(data):
+                    self.rows_read += 1
+                    if convert:
+                        values = [
+                            value if converter is None else converter(value)
+                            for value, converter in zip(values, converters)
+                        ]
+                    yield row_type._make(values)
+        finally:
+            response.close()
+
+    def select_arrays(self, query, params=None, max_rows_per_read=8192):
+        """
+            Return {column: numpy array} of `query`. Numeric, Date and DateTime
+            columns are read into typed arrays without per value objects, other
+            columns into object arrays.
+        """
+        response = self._execute(query, params)
+        try:
+            reader = _RowBinaryReader(response.iter_content(self.chunk_size))
+            if reader.at_end():
+                return {}
+            names, types = self._read_header(reader)
+            base_types = [_base_type(type_name)[0] for type_name in types]
+            if not all(base_type in _NUMPY_TYPES for base_type in base_types):
+                rows = [[] for _ in names]
+                decoders = [_decoder(type_name) for type_name in types]
+                while not reader.at_end():
+                    self.rows_read += 1
+                    for column, decode in zip(rows, decoders):
+                        column.append(decode(reader))
+                return {name: np.array(column, dtype=object) for name, column in zip(names, rows)}
+
+            dtype = np.dtype([
+                (f'f{index}', _NUMPY_TYPES[base_type][0]) for index, base_type in enumerate(base_types)
+            ])
+            pieces = []
+            while True:
+                data = reader.read_rows(dtype.itemsize, max_rows_per_read)
+                if not data:
+                    break
+                pieces.append(np.frombuffer(data, dtype=dtype))
+            records = np.concatenate(pieces) if pieces else np.zeros(0, dtype=dtype)
+            self.rows_read += len(records)
+            arrays = {}
+            for index, (name, base_type) in enumerate(zip(names, base_types)):
+                column = records[f'f{index}']
+                converted_type = _NUMPY_TYPES[base_type][1]
+                if converted_type is None:
+                    arrays[name] = column.copy()
+                elif converted_type == 'bool':
+                    arrays[name] = column.astype(bool)
+                else:
+                    arrays[name] = column.astype('int64').astype(converted_type)
+            return arrays
+        finally:
+            response.close()
+
+    def close(self):
+        self.session.close()
+
+    def stats(self):
+        return {
+            "queries": self.queries,
+            "rows_read": self.rows_read,
+        }
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_query_client(alias=None):
+    """Return the process-wide ClickHouseQueryClient of a CLICKHOUSE_DATABASES alias."""
+    from django_clickhouse.configuration import config
+
+    alias = alias or config.DEFAULT_DB_ALIAS
+    with _clients_lock:
+        client = _clients.get(alias)
+        if client is None:
+            database = config.DATABASES[alias]
+            client = _clients[alias] = ClickHouseQueryClient(
+                database.get('db_url', 'http://localhost:8123/'),
+                database['db_name'],
+                username=database.get('username'),
+                password=database.get('password'),
+                pool_size=getattr(settings, 'CLICKHOUSE_QUERY_POOL_SIZE', 10),
+                timeout_seconds=getattr(settings, 'CLICKHOUSE_QUERY_TIMEOUT_SECONDS', 60),
+            )
+        return client
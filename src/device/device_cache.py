@@ -0,0 +1,203 @@
+import copy
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+
+logger = logging.getLogger('django')
+
+DEVICE_CACHE_INVALIDATION_CHANNEL = 'device_cache:invalidate'
+
+# Lookup key kind -> Device field the key value must still match.
+KEY_FIELDS = {
+    'group_alias': 'alias',
+    'mac': 'mac',
+    'numeric_id': 'numeric_id',
+}
+
+
+class DeviceLookupCache:
+    """
+        In-process LRU cache of Device rows used to resolve incoming messages.
+
+        Devices are looked up by MQTT group/alias, MAC or numeric id; each
+        lookup key maps to a private copy of the device which expires after
+        `ttl_seconds`. Saving a device replaces the cached copy in the saving
+        process and publishes an invalidation on Redis, which every other
+        process drops the device on. Without Redis the TTL bounds staleness.
+    """
+
+    def __init__(self, max_size=2048, ttl_seconds=60):
+        self.max_size = max(1, int(max_size))
+        self.ttl_seconds = float(ttl_seconds)
+        self._entries = OrderedDict()
+        self._keys_by_pk = {}
+        self._lock = threading.Lock()
+        self._instance_id = uuid.uuid4().hex
+        self._listener = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key, loader):
+        """Return the device cached for `key`, or load it with `loader()`."""
+        self._ensure_listener()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                device = entry[0]
+            else:
+                if entry is not None:
+                    self._remove_key(key)
+                self.misses += 1
+                device = None
+        if device is not None:
+            return copy.deepcopy(device)
+
+        device = loader()
+        if device is not None and device.pk is not None:
+            self.put(key, device)
+        return device
+
+    def put(self, key, device):
+        snapshot = copy.deepcopy(device)
+        with self._lock:
+            self._remove_key(key)
+            self._entries[key] = (snapshot, time.monotonic() + self.ttl_seconds)
+            self._keys_by_pk.setdefault(snapshot.pk, set()).add(key)
+            while len(self._entries) > self.max_size:
+                oldest_key = next(iter(self._entries))
+                self._remove_key(oldest_key)
+
+    def _remove_key(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        keys = self._keys_by_pk.get(entry[0].pk)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_pk[entry[0].pk]
+
+    def _drop_device(self, pk):
+        with self._lock:
+            for key in list(self._keys_by_pk.get(pk, ())):
+                self._remove_key(key)
+            self.invalidations += 1
+
+    def refresh(self, device):
+        """Replace the cached copies of a saved device and drop it elsewhere."""
+        with self._lock:
+            keys = list(self._keys_by_pk.get(device.pk, ()))
+        if keys:
+            snapshot = copy.deepcopy(device)
+            expires_at = time.monotonic() + self.ttl_seconds
+            with self._lock:
+                for key in keys:
+                    if key not in self._entries:
+                        continue
+                    field_name = KEY_FIELDS.get(key[0])
+                    if field_name is not None and str(getattr(snapshot, field_name, None)) != str(key[-1]):
+                        # The device no longer answers to this key.
+                        self._remove_key(key)
+                    else:
+                        self._entries[key] = (snapshot, expires_at)
+        self._publish_invalidation(device.pk)
+
+    def invalidate(self, pk):
+        self._drop_device(pk)
+        self._publish_invalidation(pk)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_pk.clear()
+
+    def _publish_invalidation(self, pk):
+        try:
+            from django_redis import get_redis_connection
+            get_redis_connection('default').publish(
+                DEVICE_CACHE_INVALIDATION_CHANNEL,
+                f"{self._instance_id}:{pk}",
+            )
+        except (ImportError, NotImplementedError):
+            pass
+        except Exception as ex:
+            logger.warning("Failed to publish device cache invalidation for %s: %s", pk, ex)
+
+    def _ensure_listener(self):
+        if self._listener is not None:
+            return
+        with self._lock:
+            if self._listener is not None:
+                return
+            self._listener = threading.Thread(
+                target=self._listen_for_invalidations,
+                name="device-cache-invalidations",
+                daemon=True,
+            )
+        self._listener.start()
+
+    def _listen_for_invalidations(self):
+        try:
+            from django_redis import get_redis_connection
+        except ImportError:
+            return
+
+        while True:
+            pubsub = None
+            try:
+                pubsub = get_redis_connection('default').pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(DEVICE_CACHE_INVALIDATION_CHANNEL)
+                for message in pubsub.listen():
+                    data = message.get('data')
+                    if isinstance(data, bytes):
+                        data = data.decode('utf-8')
+                    instance_id, _, pk = str(data).partition(':')
+                    if instance_id == self._instance_id:
+                        continue
+                    self._drop_device(self._parse_pk(pk))
+            except NotImplementedError:
+                return
+            except Exception as ex:
+                logger.warning("Device cache invalidation listener failed, retrying: %s", ex)
+                # Updates may have been missed while disconnected.
+                self.clear()
+                time.sleep(5)
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+
+    def _parse_pk(self, pk):
+        try:
+            return uuid.UUID(pk)
+        except ValueError:
+            return pk
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        lookups = self.hits + self.misses
+        return {
+            "size": size,
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "invalidations": self.invalidations,
+        }
+
+
+device_cache = DeviceLookupCache(
+    max_size=getattr(settings, 'DEVICE_LOCAL_CACHE_MAX_SIZE', 2048),
+    ttl_seconds=getattr(settings, 'DEVICE_LOCAL_CACHE_TTL_SECONDS', 60),
+)
@@ -0,0 +1,87 @@
+import random
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from utils.load_detection import get_load_data_ai, get_load_data_ai_batch, load_model
+
+
+class Command(BaseCommand):
+
+    """
+        Benchmark the batch load detection against the per point loop.
+
+        Synthetic meter data points are run through get_load_data_ai one by
+        one and through get_load_data_ai_batch at once, with an equipment of
+        every load model sorted by power like Device.get_all_equipments. The
+        command reports the points per second of both and the points whose
+        loads differ, which should be none.
+    """
+
+    help = 'Benchmarks get_load_data_ai_batch against get_load_data_ai.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--points', type=int, default=10000, help='Data points to detect the loads of')
+        parser.add_argument('--batch-size', type=int, default=0, help='Points per batch call, 0 for all')
+
+    def handle(self, *args, **options):
+        equipments = self.generate_equipments()
+        points = self.generate_points(max(1, options['points']))
+        batch_size = options['batch_size'] or len(points)
+
+        started = time.perf_counter()
+        loop_loads = [
+            get_load_data_ai(None, data_point, equipments, temperature, humidity, wind_speed)
+            for data_point, temperature, humidity, wind_speed in points
+        ]
+        loop_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        batch_loads = []
+        for start in range(0, len(points), batch_size):
+            batch_loads.extend(get_load_data_ai_batch(points[start:start + batch_size], equipments))
+        batch_seconds = time.perf_counter() - started
+
+        mismatches = sum(1 for loop, batch in zip(loop_loads, batch_loads) if loop != batch)
+        detected = sum(len(loads) for loads in loop_loads)
+        self.stdout.write(
+            f"{len(points):,} points, {len(equipments)} equipments, {detected:,} loads detected"
+        )
+        self.stdout.write(f"{'loop':>6}: {loop_seconds:.3f}s, {len(points) / loop_seconds:,.0f} points/s")
+        self.stdout.write(
+            f"{'batch':>6}: {batch_seconds:.3f}s, {len(points) / batch_seconds:,.0f} points/s "
+            f"({batch_size:,} per call), {loop_seconds / batch_seconds:.1f}x"
+        )
+        self.stdout.write(f"mismatches: {mismatches:,}")
+
+    def generate_equipments(self):
+        randomizer = random.Random(42)
+        equipments = []
+        for name in sorted(load_model.targets):
+            min_power = randomizer.randint(5, 100)
+            equipments.append(SimpleNamespace(equipment=SimpleNamespace(
+                name=name,
+                min_power=min_power,
+                max_power=min_power + randomizer.randint(0, 2000),
+            )))
+        equipments.sort(key=lambda load: load.equipment.max_power, reverse=True)
+        return equipments
+
+    def generate_points(self, count):
+        randomizer = random.Random(42)
+        end_time = timezone.now()
+        points = []
+        for index in range(count):
+            data_point = {
+                "data_arrival_time": end_time - timedelta(minutes=randomizer.randint(0, 365 * 24 * 60)),
+                "power": round(randomizer.uniform(0, 8000), 1),
+            }
+            points.append((
+                data_point,
+                randomizer.uniform(-50, 450),
+                randomizer.uniform(0, 100),
+                randomizer.uniform(0, 40),
+            ))
+        return points
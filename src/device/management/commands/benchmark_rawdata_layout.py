@@ -0,0 +1,245 @@
+import random
+import time
+import uuid
+from datetime import timedelta
+
+import bson
+import simplejson as json
+from device.raw_data_store import (RAW_DATA_BUCKET_PAGE_SIZE, build_raw_data_bucket, get_bucket_start,
+                                   project_data)
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+DOCUMENT_READ_COLUMNS = ('data_arrival_time', 'channel', 'data_type', 'data')
+BUCKET_READ_COLUMNS = ('id', 'bucket_start', 'offsets', 'channels')
+BUCKET_JSON_COLUMNS = ('offsets', 'channels', 'payloads', 'values', 'field_names')
+DATA_TYPE = 'meters-data'
+
+
+def _document_size(document):
+    return len(bson.encode(document))
+
+
+def _raw_data_document(row, columns=None):
+    # JSONField values are stored as JSON strings.
+    document = {
+        'id': row['id'],
+        'device_id': row['device_id'],
+        'channel': row['channel'],
+        'data_type': row['data_type'],
+        'data_arrival_time': row['data_arrival_time'],
+        'data': json.dumps(row['data']),
+    }
+    if columns is not None:
+        document = {column: document[column] for column in columns}
+    return document
+
+
+def _bucket_document(bucket, columns=None):
+    document = {
+        'id': bucket.id.hex,
+        'device_id': bucket.device_id,
+        'data_type': bucket.data_type,
+        'bucket_start': bucket.bucket_start,
+        'compacted_at': bucket.compacted_at,
+        'first_arrival_time': bucket.first_arrival_time,
+        'last_arrival_time': bucket.last_arrival_time,
+        'sample_count': bucket.sample_count,
+    }
+    for column in BUCKET_JSON_COLUMNS:
+        document[column] = json.dumps(getattr(bucket, column))
+    if columns is not None:
+        document = {column: document[column] for column in columns}
+    return document
+
+
+class _Read:
+
+    def __init__(self):
+        self.queries = 0
+        self.documents = 0
+        self.bytes = 0
+        self.messages = 0
+        self.returned_bytes = 0
+
+    def add(self, documents):
+        self.queries += 1
+        for document in documents:
+            self.documents += 1
+            self.bytes += _document_size(document)
+
+
+class Command(BaseCommand):
+
+    """
+        Benchmark the read and write amplification of the RawData layouts.
+
+        A synthetic meters-data stream is stored as one document per message
+        and, for the "buckets" layout, compacted into one bucket per closed
+        window. The command counts the bytes written and the queries, documents
+        and bytes the readers load for a day scan and a projected numeric day
+        scan. Reads of the latest messages use the documents in both layouts.
+        Nothing is written to the database; document sizes are their BSON
+        encoding.
+    """
+
+    help = 'Benchmarks the read and write amplification of the RawData storage layouts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--devices', type=int, default=10, help='Devices sending data')
+        parser.add_argument('--hours', type=int, default=24, help='Hours of data per device')
+        parser.add_argument('--interval', type=float, default=10, help='Seconds between messages of a device')
+        parser.add_argument('--bucket-seconds', type=int, default=3600, help='Bucket window')
+        parser.add_argument(
+            '--field',
+            action='append',
+            help='Numeric payload path read by the projected scan, repeatable '
+                 '(default: meter_0.power and meter_1.energy)',
+        )
+
+    def handle(self, *args, **options):
+        fields = options['field'] or ['meter_0.power', 'meter_1.energy']
+        bucket_seconds = options['bucket_seconds']
+        rows_by_device = self.generate_rows(options)
+        now = timezone.now()
+        open_window = get_bucket_start(now, bucket_seconds)
+
+        payload_bytes = 0
+        document_bytes = 0
+        bucket_bytes = 0
+        compaction_read_bytes = 0
+        compaction_seconds = 0.0
+        buckets_by_device = {}
+        for device_id, rows in rows_by_device.items():
+            windows = {}
+            for row in rows:
+                payload_bytes += len(json.dumps(row['data']))
+                document_bytes += _document_size(_raw_data_document(row))
+                windows.setdefault(get_bucket_start(row['data_arrival_time'], bucket_seconds), []).append(row)
+
+            buckets = {}
+            for bucket_start, window_rows in windows.items():
+                if bucket_start >= open_window:
+                    continue
+                compaction_read_bytes += sum(
+                    _document_size(_raw_data_document(row, ('data_arrival_time', 'channel', 'data')))
+                    for row in window_rows
+                )
+                started = time.perf_counter()
+                bucket = build_raw_data_bucket(
+                    device_id,
+                    DATA_TYPE,
+                    bucket_start,
+                    [(row['data_arrival_time'], row['channel'], row['data']) for row in window_rows],
+                )
+                compaction_seconds += time.perf_counter() - started
+                bucket_bytes += _document_size(_bucket_document(bucket))
+                buckets[bucket_start] = bucket
+            buckets_by_device[device_id] = buckets
+
+        messages = sum(len(rows) for rows in rows_by_device.values())
+        bucket_count = sum(len(buckets) for buckets in buckets_by_device.values())
+        self.stdout.write(
+            f"{messages:,} messages of {len(rows_by_device)} device(s), {payload_bytes:,} payload bytes, "
+            f"{bucket_count:,} closed windows"
+        )
+        self.stdout.write("writes:")
+        self.write_amplification('documents', messages, document_bytes, 0, payload_bytes)
+        self.write_amplification(
+            'buckets', messages + bucket_count, document_bytes + bucket_bytes, compaction_read_bytes, payload_bytes,
+        )
+        if compaction_seconds > 0:
+            self.stdout.write(f"{'':>12}  compaction builds {messages / compaction_seconds:,.0f} msg/s")
+
+        scans = {}
+        for device_id, rows in rows_by_device.items():
+            buckets = buckets_by_device[device_id]
+            day_start = now - timedelta(days=1)
+            day_rows = [row for row in rows if row['data_arrival_time'] >= day_start]
+
+            self.read_documents(scans, 'day scan', day_rows, None)
+            self.read_buckets(scans, 'day scan', rows, buckets, day_start, now, None, bucket_seconds)
+            self.read_documents(scans, 'projected', day_rows, fields)
+            self.read_buckets(scans, 'projected', rows, buckets, day_start, now, fields, bucket_seconds)
+
+        self.stdout.write(f"reads (projected fields: {', '.join(fields)}):")
+        for (name, layout), read in scans.items():
+            self.stdout.write(
+                f"{name:>10} {layout:>9}: {read.queries:,} queries, {read.documents:,} documents, "
+                f"{read.bytes:,} bytes, amplification {read.bytes / max(1, read.returned_bytes):.2f}x"
+            )
+
+    def write_amplification(self, layout, documents_written, bytes_written, bytes_read, payload_bytes):
+        self.stdout.write(
+            f"{layout:>12}: {documents_written:,} document writes, {bytes_written:,} bytes, "
+            f"amplification {bytes_written / max(1, payload_bytes):.2f}x"
+            + (f", compaction reads {bytes_read:,} bytes" if bytes_read else "")
+        )
+
+    def _returned(self, read, rows, fields):
+        read.messages += len(rows)
+        read.returned_bytes += sum(len(json.dumps(project_data(row['data'], fields))) for row in rows)
+
+    def read_documents(self, scans, name, rows, fields):
+        read = scans.setdefault((name, 'documents'), _Read())
+        # The ORM cannot project inside the JSON payload, documents load it whole.
+        read.add(_raw_data_document(row, DOCUMENT_READ_COLUMNS) for row in rows)
+        self._returned(read, rows, fields)
+
+    def read_buckets(self, scans, name, rows, buckets, start_time, end_time, fields, bucket_seconds):
+        read = scans.setdefault((name, 'buckets'), _Read())
+        columns = BUCKET_READ_COLUMNS + (('payloads',) if fields is None else ('values', 'field_names'))
+        window_starts = [
+            bucket_start for bucket_start in sorted(buckets)
+            if get_bucket_start(start_time, bucket_seconds) <= bucket_start <= end_time
+        ]
+        page_size = 1
+        while window_starts:
+            page, window_starts = window_starts[:page_size], window_starts[page_size:]
+            read.add(_bucket_document(buckets[bucket_start], columns) for bucket_start in page)
+            page_size = min(page_size * 2, RAW_DATA_BUCKET_PAGE_SIZE)
+        # Windows without a bucket are read from their documents.
+        uncovered = [
+            row for row in rows
+            if start_time <= row['data_arrival_time'] < end_time
+            and get_bucket_start(row['data_arrival_time'], bucket_seconds) not in buckets
+        ]
+        read.add(_raw_data_document(row, DOCUMENT_READ_COLUMNS) for row in uncovered)
+        self._returned(read, [row for row in rows if start_time <= row['data_arrival_time'] < end_time], fields)
+
+    def generate_rows(self, options):
+        randomizer = random.Random(42)
+        interval = timedelta(seconds=options['interval'])
+        messages_per_device = int(options['hours'] * 3600 / options['interval'])
+        end_time = timezone.now()
+        rows_by_device = {}
+        for device_index in range(max(1, options['devices'])):
+            device_id = uuid.UUID(int=device_index + 1).hex
+            start_time = end_time - interval * messages_per_device + timedelta(
+                seconds=randomizer.uniform(0, options['interval'])
+            )
+            energy = randomizer.uniform(0, 1000)
+            rows = []
+            for index in range(messages_per_device):
+                energy += randomizer.uniform(0, 0.5)
+                data = {
+                    f"meter_{meter}": {
+                        "voltage": round(randomizer.uniform(220, 240), 2),
+                        "current": round(randomizer.uniform(0, 10), 3),
+                        "power": round(randomizer.uniform(0, 2400), 1),
+                        "frequency": round(randomizer.uniform(49.8, 50.2), 2),
+                        "energy": round(energy * (meter + 1), 3),
+                    }
+                    for meter in range(2)
+                }
+                data.update({"state": "ON", "firmware": "1.4.2"})
+                rows.append({
+                    'id': uuid.uuid4().hex,
+                    'device_id': device_id,
+                    'channel': 'mqtt',
+                    'data_type': DATA_TYPE,
+                    'data_arrival_time': start_time + interval * index,
+                    'data': data,
+                })
+            rows_by_device[device_id] = rows
+        return rows_by_device
@@ -0,0 +1,66 @@
+import json
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import django
+django.setup()
+import api.utils
+imported = time.perf_counter()
+sklearn_imported = 'sklearn' in sys.modules
+from utils.load_detection import load_model
+load_model.targets
+first_use = time.perf_counter()
+load_model.targets
+second_use = time.perf_counter()
+print(json.dumps({
+    'import': imported - started,
+    'first_use': first_use - imported,
+    'second_use': second_use - first_use,
+    'sklearn_imported': sklearn_imported,
+    'models': len(load_model.targets),
+}))
+"""
+
+
+class Command(BaseCommand):
+
+    """
+        Benchmark the startup of a process importing api.utils.
+
+        Every run is a new interpreter that sets Django up and imports
+        api.utils, like the web, MQTT and management processes, then reads
+        the load detection models. The command reports the median import
+        time, the time of the first and of a later use of the models, and
+        whether the import loaded scikit-learn.
+    """
+
+    help = 'Benchmarks the import time of api.utils and the first use of the load detection models.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5, help='Interpreters to start')
+
+    def handle(self, *args, **options):
+        runs = []
+        for _ in range(max(1, options['runs'])):
+            output = subprocess.run(
+                [sys.executable, '-W', 'ignore', '-c', STARTUP_SCRIPT],
+                cwd=settings.BASE_DIR,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+
+        for key, name in (('import', 'import api.utils'), ('first_use', 'first use'), ('second_use', 'later use')):
+            self.stdout.write(f"{name:>16}: {statistics.median(run[key] for run in runs) * 1000:,.2f} ms")
+        self.stdout.write(
+            f"{len(runs)} run(s), {runs[-1]['models']} models, "
+            f"scikit-learn imported by api.utils: {'yes' if runs[-1]['sklearn_imported'] else 'no'}"
+        )
@@ -0,0 +1,152 @@
+"""
+Management command to compact RawData documents into RawDataBucket buckets.
+
+Usage:
+    python manage.py migrate_rawdata_buckets
+    python manage.py migrate_rawdata_buckets --device 192.168.1.10 --start 2026-01-01T00:00:00Z
+    python manage.py migrate_rawdata_buckets --dry-run
+
+Every window with documents gets its bucket rebuilt, the documents are kept.
+The open window is left to the compaction of RAW_DATA_STORAGE_LAYOUT "buckets".
+"""
+from datetime import datetime, timezone as dt_timezone
+from uuid import UUID
+
+from device.models import Device, RawData
+from device.raw_data_store import build_raw_data_bucket, get_bucket_seconds, get_bucket_start, save_raw_data_bucket
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = 'Compact RawData documents into RawDataBucket buckets'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--device',
+            type=str,
+            action='append',
+            help='Device id, ip address or alias to migrate, repeatable (default: all devices)',
+        )
+        parser.add_argument(
+            '--start',
+            type=str,
+            help='ISO timestamp to migrate from, rounded down to a bucket window',
+        )
+        parser.add_argument(
+            '--end',
+            type=str,
+            help='ISO timestamp to migrate up to, rounded down to a bucket window (default: now)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=2000,
+            help='RawData documents read per round trip',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Build the buckets in memory and report, without writing',
+        )
+
+    def handle(self, *args, **options):
+        bucket_seconds = get_bucket_seconds()
+        start_time = self._parse_datetime(options.get('start'), '--start')
+        end_time = self._parse_datetime(options.get('end'), '--end') or timezone.now()
+        if start_time is not None:
+            start_time = get_bucket_start(start_time, bucket_seconds)
+        end_time = get_bucket_start(end_time, bucket_seconds)
+        if start_time is not None and start_time >= end_time:
+            raise CommandError('--end must be at least one bucket window after --start')
+
+        if options.get('device'):
+            devices = [self._get_device(device_id) for device_id in options['device']]
+        else:
+            devices = list(Device.objects.all().only('id', 'ip_address'))
+
+        totals = {'documents': 0, 'buckets': 0, 'failed': 0}
+        for device in devices:
+            documents, buckets, failed = self.migrate_device(
+                device, start_time, end_time, bucket_seconds, options['batch_size'], options['dry_run'],
+            )
+            totals['documents'] += documents
+            totals['buckets'] += buckets
+            totals['failed'] += failed
+            self.stdout.write(f"{device.ip_address or device.pk}: {documents:,} documents, {buckets:,} buckets")
+
+        if totals['failed']:
+            self.stdout.write(self.style.ERROR(f"✗ {totals['failed']:,} buckets could not be written"))
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"✓ {'Would compact' if options['dry_run'] else 'Compacted'} {totals['documents']:,} documents "
+                f"of {len(devices)} device(s) into {totals['buckets']:,} buckets"
+            )
+        )
+
+    def migrate_device(self, device, start_time, end_time, bucket_seconds, batch_size, dry_run):
+        documents = RawData.objects.filter(device=device, data_arrival_time__lt=end_time)
+        if start_time is not None:
+            documents = documents.filter(data_arrival_time__gte=start_time)
+        rows = documents.order_by('data_arrival_time').values_list(
+            'data_type', 'data_arrival_time', 'channel', 'data',
+        )
+
+        # Documents come in time order, a data type's window is complete once
+        # one of its documents falls in a later window.
+        open_windows = {}
+        counts = {'documents': 0, 'buckets': 0, 'failed': 0}
+
+        def write_window(data_type, bucket_start, points):
+            bucket = build_raw_data_bucket(device.pk, data_type, bucket_start, points)
+            if dry_run:
+                counts['buckets'] += 1
+                return
+            try:
+                save_raw_data_bucket(bucket)
+            except Exception as ex:
+                counts['failed'] += 1
+                self.stderr.write(f"Bucket of {device.pk}/{data_type} at {bucket_start.isoformat()} failed: {ex}")
+                return
+            counts['buckets'] += 1
+
+        for data_type, data_arrival_time, channel, data in rows.iterator(chunk_size=max(1, batch_size)):
+            bucket_start = get_bucket_start(data_arrival_time, bucket_seconds)
+            window = open_windows.get(data_type)
+            if window is not None and window[0] != bucket_start:
+                write_window(data_type, *window)
+                window = None
+            if window is None:
+                window = open_windows[data_type] = (bucket_start, [])
+            window[1].append((data_arrival_time, channel, data))
+            counts['documents'] += 1
+
+        for data_type, window in open_windows.items():
+            write_window(data_type, *window)
+        return counts['documents'], counts['buckets'], counts['failed']
+
+    def _get_device(self, device_id):
+        device_query = Q(ip_address=device_id) | Q(alias=device_id)
+        try:
+            UUID(str(device_id))
+        except (TypeError, ValueError):
+            pass
+        else:
+            device_query = Q(pk=device_id) | device_query
+
+        device = Device.objects.filter(device_query).first()
+        if device is None:
+            raise CommandError(f'Device not found: {device_id}')
+        return device
+
+    def _parse_datetime(self, value, label):
+        if not value:
+            return None
+        try:
+            parsed_value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError as exc:
+            raise CommandError(f'Invalid {label} value. Use an ISO 8601 timestamp.') from exc
+        if timezone.is_naive(parsed_value):
+            parsed_value = timezone.make_aware(parsed_value, dt_timezone.utc)
+        return parsed_value
@@ -0,0 +1,32 @@
+from django.db import migrations, models
+
+
+def populate_ip_address_numeric(apps, schema_editor):
+    """
+    Store the numeric form of every device address for subnet range lookups.
+    """
+    Device = apps.get_model('device', 'Device')
+    for device in Device.objects.exclude(ip_address=None).only('id', 'ip_address'):
+        try:
+            numeric_address = 0
+            for part in device.ip_address.split('.'):
+                numeric_address = numeric_address * 256 + (int(part) if part != '' else 0)
+        except ValueError:
+            continue
+        Device.objects.filter(pk=device.pk).update(ip_address_numeric=numeric_address)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device', '0003_create_devicestatus_timeseries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='ip_address_numeric',
+            field=models.BigIntegerField(blank=True, db_index=True, editable=False, help_text='Numeric form of ip_address, used for subnet range lookups', null=True),
+        ),
+        migrations.RunPython(populate_ip_address_numeric, migrations.RunPython.noop),
+    ]
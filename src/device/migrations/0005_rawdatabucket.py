@@ -0,0 +1,40 @@
+import uuid
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device', '0004_device_ip_address_numeric'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RawDataBucket',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('data_type', models.CharField(blank=True, db_index=True, max_length=255, null=True)),
+                ('bucket_start', models.DateTimeField(db_index=True)),
+                ('compacted_at', models.DateTimeField()),
+                ('first_arrival_time', models.DateTimeField()),
+                ('last_arrival_time', models.DateTimeField()),
+                ('sample_count', models.IntegerField(default=0)),
+                ('offsets', models.JSONField(default=list)),
+                ('channels', models.JSONField(default=list)),
+                ('payloads', models.JSONField(default=list)),
+                ('values', models.JSONField(default=dict)),
+                ('field_names', models.JSONField(default=list)),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, to='device.device')),
+            ],
+            options={
+                'verbose_name': 'RawData bucket',
+                'verbose_name_plural': 'RawData buckets',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='rawdatabucket',
+            index=models.Index(fields=['device', 'data_type', 'bucket_start'], name='device_rawd_device__e1e69d_idx'),
+        ),
+    ]
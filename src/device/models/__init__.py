@@ -10,6 +10,7 @@ from .device import (
     AssetStatus,
     Meter,
     RawData,
+    RawDataBucket,
     Subnet,
     get_image_path
 )
@@ -32,6 +33,7 @@ __all__ = (
     'AssetStatus',
     'AssetDocument',
     'RawData',
+    'RawDataBucket',
     'Meter',
     'DeviceConfig',
     'DeviceFirmware',
@@ -1,8 +1,11 @@
 import binascii
+import copy
 import logging
 import os
 # import ssl
+import threading
 import uuid
+from functools import lru_cache
 from typing import Iterable
 
 # import certifi
@@ -10,12 +13,16 @@ import pytz
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.core.cache import cache
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 # from geoposition.fields import GeopositionField
 # from geopy import geocoders
 from timezonefinder import TimezoneFinder
 
+from device.device_cache import device_cache
+
 if os.getenv("CLICKHOUSE_DATABASE_HOST") and os.getenv("CLICKHOUSE_DATABASE_PORT") and os.getenv("CLICKHOUSE_DATABASE_NAME") and os.getenv("CLICKHOUSE_DATABASE_USERNAME") and os.getenv("CLICKHOUSE_DATABASE_PASSWORD"):
     from device.clickhouse_models import MeterData
 else:
@@ -28,6 +35,65 @@ else:
 logger = logging.getLogger('django')
 
 
+_timezone_finder = None
+_timezone_finder_lock = threading.Lock()
+_timezone_lookup_lock = threading.Lock()
+
+
+def get_timezone_finder():
+    """
+        Return the process-wide TimezoneFinder, it loads its shape data on
+        construction so it is built only once.
+    """
+    global _timezone_finder
+    if _timezone_finder is None:
+        with _timezone_finder_lock:
+            if _timezone_finder is None:
+                _timezone_finder = TimezoneFinder()
+    return _timezone_finder
+
+
+@lru_cache(maxsize=4096)
+def get_timezone_name_at(latitude, longitude):
+    """
+        Return the timezone name for the position, or '' when it is unknown.
+        Keyed by position, so moving a device resolves its new timezone.
+    """
+    # TimezoneFinder reads its data files through shared handles, serialize lookups.
+    timezone_finder = get_timezone_finder()
+    with _timezone_lookup_lock:
+        return timezone_finder.timezone_at(lat=latitude, lng=longitude) or ''
+
+
+def get_position_timezone_name(position):
+    """Return the timezone name of a device position, or '' when it is missing or unknown."""
+    if not isinstance(position, dict):
+        return ''
+    try:
+        return get_timezone_name_at(float(position.get("latitude")), float(position.get("longitude")))
+    except (TypeError, ValueError):
+        return ''
+
+
+USER_DEVICE_CACHE_VERSION_KEY = 'user_devices:version'
+
+
+def get_user_device_cache_version():
+    version = cache.get(USER_DEVICE_CACHE_VERSION_KEY)
+    if version is None:
+        cache.add(USER_DEVICE_CACHE_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(USER_DEVICE_CACHE_VERSION_KEY)
+    return version
+
+
+def invalidate_user_device_cache():
+    """
+        Drop the cached device lists of every user. Called when a device is
+        created, deleted or changes its address or active flag.
+    """
+    cache.set(USER_DEVICE_CACHE_VERSION_KEY, uuid.uuid4().hex, None)
+
+
 def get_image_path(instance, filename):
     return os.path.join('photos', str(instance.pk), filename)
 
@@ -102,6 +168,13 @@ class Device(models.Model):
         blank=True,
         null=True
     )
+    ip_address_numeric = models.BigIntegerField(
+        blank=True,
+        null=True,
+        db_index=True,
+        editable=False,
+        help_text='Numeric form of ip_address, used for subnet range lookups'
+    )
     mac = models.CharField(
         max_length=255,
         help_text='Device MAC',
@@ -173,10 +246,36 @@ class Device(models.Model):
     def generate_key(self):
         return binascii.hexlify(os.urandom(20)).decode()
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_ownership_state = instance._get_ownership_state()
+        return instance
+
+    def _get_ownership_state(self):
+        # The position is part of it, the cached device lists keep each device's timezone.
+        # It is copied, so a position edited in place still differs from the snapshot.
+        return (
+            self.__dict__.get('ip_address'),
+            self.__dict__.get('active'),
+            copy.deepcopy(self.__dict__.get('position')),
+        )
+
     # Overriding save method to generate access token
     def save(self, *args, **kwargs):
         if not self.access_token:
             self.access_token = self.generate_key()
+        if self.ip_address:
+            try:
+                self.ip_address_numeric = User.address_string_to_numeric(self.ip_address)
+            except ValueError:
+                self.ip_address_numeric = None
+        else:
+            self.ip_address_numeric = None
+        ownership_changed = (
+            self._state.adding
+            or getattr(self, '_loaded_ownership_state', None) != self._get_ownership_state()
+        )
         # if not self.numeric_id:
         #     if self.ip_address:
         #         self.numeric_id = User.address_string_to_numeric(self.ip_address)
@@ -188,6 +287,10 @@ class Device(models.Model):
         #     else:
         #         self.address = location.address
         super(self.__class__, self).save(*args, **kwargs)
+        if ownership_changed:
+            self._loaded_ownership_state = self._get_ownership_state()
+            invalidate_user_device_cache()
+        device_cache.refresh(self)
 
     def latitude(self):
         if self.position:
@@ -229,6 +332,29 @@ class Device(models.Model):
         else:
             return None
 
+    def get_cached_command(self):
+        """
+            Same as `get_command`, but remembers that the device has no pending
+            command until a new one is created for it.
+
+            The marker holds the command generation of the device read before
+            the query; creating a command bumps the generation, so a marker
+            written after a concurrent create is not trusted.
+        """
+        cache_key = get_no_pending_command_cache_key(self.pk)
+        generation_key = get_command_generation_cache_key(self.pk)
+        cached = cache.get_many([cache_key, generation_key])
+        generation = cached.get(generation_key)
+        if generation is None:
+            cache.add(generation_key, uuid.uuid4().hex, None)
+            generation = cache.get(generation_key)
+        elif cached.get(cache_key) == generation:
+            return None
+        command = self.get_command()
+        if command is None and generation is not None:
+            cache.set(cache_key, generation, NO_PENDING_COMMAND_CACHE_SECONDS)
+        return command
+
     def get_latest_data(self, meter_type=None, split_by_meters=False):
         return self.get_last_data_point(meter_type=meter_type, split_by_meters=split_by_meters)
 
@@ -321,18 +447,16 @@ class Device(models.Model):
         """
             Return device timezone.
         """
-        timezone_str = cache.get("{}_timezone_str".format(self.ip_address))
-        if timezone_str is None:
-            if self.position is None:
+        if self.position is None:
+            if not getattr(self, '_missing_position_logged', False):
                 logger.warning("Position for the device {} is not defined.".format(self.ip_address))
-                timezone_str = ''
-            else:
-                tf = TimezoneFinder()
-                timezone_str = tf.timezone_at(
-                    lat=float(self.position.get("latitude")),
-                    lng=float(self.position.get("longitude"))
-                )
-            cache.set("{}_timezone_str".format(self.ip_address), timezone_str, 1 * 60 * 60)
+                self._missing_position_logged = True
+            return None
+
+        timezone_str = get_timezone_name_at(
+            float(self.position.get("latitude")),
+            float(self.position.get("longitude")),
+        )
         if timezone_str:
             timezone_obj = pytz.timezone(timezone_str)
         else:
@@ -526,6 +650,47 @@ class User(AbstractUser):
             + str(address[1]) + "."\
             + str(address[0])
 
+    def get_subnet_range(self):
+        subnet = self.subnet_mask
+        subnet = subnet.split('/')
+        if len(subnet) > 1:
+            subnet_start = User.address_string_to_numeric(subnet[0].strip())
+            subnet_end = subnet_start + int(subnet[1].strip())
+        else:
+            subnet_start = subnet_end = 0
+        return subnet_start, subnet_end
+
+    def _get_subnet_devices(self, subnet_start, subnet_end):
+        """
+            Return [(device pk, ip address, numeric address, timezone name)] of
+            the active devices in the user's subnet, cached until a device is
+            added, removed, re-addressed, moved or (de)activated.
+        """
+        cache_key = 'user_devices:v2:{}:{}:{}'.format(
+            self.pk,
+            self.subnet_mask,
+            get_user_device_cache_version(),
+        )
+        subnet_devices = cache.get(cache_key)
+        if subnet_devices is None:
+            subnet_devices = []
+            if subnet_start < subnet_end:
+                devices = Device.objects.filter(
+                    ip_address_numeric__gte=subnet_start,
+                    ip_address_numeric__lt=subnet_end,
+                ).only('id', 'ip_address', 'ip_address_numeric', 'active', 'position')
+                for device in devices:
+                    if device.ip_address is None or device.active is False:
+                        continue
+                    subnet_devices.append((
+                        device.pk,
+                        device.ip_address,
+                        device.ip_address_numeric,
+                        get_position_timezone_name(device.position),
+                    ))
+            cache.set(cache_key, subnet_devices, settings.DEVICE_CACHE_TTL_MINUTES * 60)
+        return subnet_devices
+
     def device_list(self, return_objects=False, device_id=None, return_next_address=False):
         device_list = []
         dev_user = self
@@ -538,33 +703,32 @@ class User(AbstractUser):
             if not return_objects:
                 device_list = [dev.ip_address for dev in device_list if dev.active is not False]
         else:
-            subnet = dev_user.subnet_mask
-            subnet = subnet.split('/')
-            if len(subnet) > 1:
-                subnet_start = User.address_string_to_numeric(subnet[0].strip())
-                subnet_end = subnet_start + int(subnet[1].strip())
-            else:
-                subnet_start = subnet_end = 0
+            subnet_start, subnet_end = dev_user.get_subnet_range()
 
             if device_id:
                 device_id = User.address_string_to_numeric(device_id)
+                if subnet_start <= device_id < subnet_end:
+                    # Single device lookups go straight to the indexed address.
+                    device = Device.objects.filter(ip_address_numeric=device_id).first()
+                    if device is not None and device.ip_address is not None and device.active is not False:
+                        return device
+
             # Now figure out the devices which belongs to this user
+            subnet_devices = dev_user._get_subnet_devices(subnet_start, subnet_end)
             max_address = subnet_start
-            for device in Device.objects.all():
-                dev_address = device.ip_address
-                if dev_address is None or device.active is False:
-                    continue
-                dev_address = User.address_string_to_numeric(dev_address)
-                if subnet_start <= dev_address and dev_address < subnet_end:
-                    # The device belongs to this user
-                    if device_id is not None and dev_address == device_id:
-                        return device
-                    if return_objects:
-                        device_list.append(device)
-                    else:
-                        device_list.append(device.ip_address)
-                    if max_address is None or dev_address > max_address:
-                        max_address = dev_address
+            for _, _, dev_address, _ in subnet_devices:
+                if dev_address > max_address:
+                    max_address = dev_address
+
+            if return_objects:
+                devices_by_pk = Device.objects.in_bulk([device_pk for device_pk, _, _, _ in subnet_devices])
+                device_list = [
+                    devices_by_pk[device_pk]
+                    for device_pk, _, _, _ in subnet_devices
+                    if device_pk in devices_by_pk
+                ]
+            else:
+                device_list = [ip_address for _, ip_address, _, _ in subnet_devices]
 
         if return_next_address:
             return (
@@ -574,6 +738,37 @@ class User(AbstractUser):
             )
         return device_list
 
+    def device_pks(self):
+        """
+            Return the primary keys of the user's devices, the ones device_list
+            returns with `return_objects`, without loading the devices.
+        """
+        if self.is_superuser:
+            return list(Device.objects.values_list('id', flat=True))
+        subnet_start, subnet_end = self.get_subnet_range()
+        return [device_pk for device_pk, _, _, _ in self._get_subnet_devices(subnet_start, subnet_end)]
+
+    def device_timezones(self):
+        """
+            Return {device pk: timezone or None} of the user's devices, the
+            ones device_pks returns, without loading the devices.
+        """
+        if self.is_superuser:
+            timezone_names = {
+                device_pk: get_position_timezone_name(position)
+                for device_pk, position in Device.objects.values_list('id', 'position')
+            }
+        else:
+            subnet_start, subnet_end = self.get_subnet_range()
+            timezone_names = {
+                device_pk: timezone_name
+                for device_pk, _, _, timezone_name in self._get_subnet_devices(subnet_start, subnet_end)
+            }
+        return {
+            device_pk: pytz.timezone(timezone_name) if timezone_name else None
+            for device_pk, timezone_name in timezone_names.items()
+        }
+
     def has_permission(self, permission):
         if isinstance(permission, Permission):
             return self.permissions.filter(name=permission.name).exists()
@@ -803,3 +998,92 @@ class RawData(models.Model):
 
     def __str__(self) -> str:
         return f"{self.device.ip_address}-{self.data_arrival_time.strftime(settings.TIME_FORMAT_STRING)}"
+
+
+class RawDataBucket(models.Model):
+    """
+    Bucketed copy of RawData: the messages of one device and data type within
+    one closed time window (an hour by default), stored as parallel lists.
+
+    `offsets` are the arrival times in microseconds after `bucket_start`,
+    `payloads` the message data, and `values` maps the dotted path of every
+    numeric payload value to a column of values (None where a message does
+    not have it). `field_names` lists every payload path seen, so readers know
+    whether the numeric columns answer a query without loading the payloads.
+
+    Buckets are compacted from the RawData documents of a window once it has
+    closed, see RAW_DATA_STORAGE_LAYOUT. A recompacted window briefly has two
+    buckets, readers use the latest `compacted_at`. Existing RawData is
+    converted with:
+        python manage.py migrate_rawdata_buckets
+    """
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    device = models.ForeignKey('Device', on_delete=models.DO_NOTHING, db_index=True)
+    data_type = models.CharField(max_length=255, null=True, blank=True, db_index=True)
+    bucket_start = models.DateTimeField(db_index=True)
+    compacted_at = models.DateTimeField()
+    first_arrival_time = models.DateTimeField()
+    last_arrival_time = models.DateTimeField()
+    sample_count = models.IntegerField(default=0)
+    offsets = models.JSONField(default=list)
+    channels = models.JSONField(default=list)
+    payloads = models.JSONField(default=list)
+    values = models.JSONField(default=dict)
+    field_names = models.JSONField(default=list)
+
+    class Meta:
+        app_label = "device"
+        verbose_name = "RawData bucket"
+        verbose_name_plural = "RawData buckets"
+        indexes = [
+            models.Index(fields=['device', 'data_type', 'bucket_start']),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.device_id}-{self.data_type}-{self.bucket_start.strftime(settings.TIME_FORMAT_STRING)}"
+
+
+@receiver(post_delete, sender=Device)
+def invalidate_user_device_cache_on_delete(sender, instance, **kwargs):
+    invalidate_user_device_cache()
+    device_cache.invalidate(instance.pk)
+
+
+COMMAND_NOTIFY_CHANNEL = 'device_commands:pending'
+NO_PENDING_COMMAND_CACHE_KEY_PREFIX = 'device_commands:none:v2:'
+COMMAND_GENERATION_CACHE_KEY_PREFIX = 'device_commands:generation:'
+NO_PENDING_COMMAND_CACHE_SECONDS = 5 * 60
+# Set when a pending command is created in this process.
+pending_command_event = threading.Event()
+
+
+def notify_pending_command():
+    """
+        Wake up the command dispatcher, in this process and, through Redis
+        pub/sub, in the MQTT listener.
+    """
+    pending_command_event.set()
+    try:
+        from django_redis import get_redis_connection
+        get_redis_connection('default').publish(COMMAND_NOTIFY_CHANNEL, '1')
+    except NotImplementedError:
+        # Not a Redis cache, the dispatcher falls back to polling.
+        pass
+    except Exception as ex:
+        logger.warning("Failed to publish pending command notification: %s", ex)
+
+
+def get_no_pending_command_cache_key(device_pk):
+    return f"{NO_PENDING_COMMAND_CACHE_KEY_PREFIX}{device_pk}"
+
+
+def get_command_generation_cache_key(device_pk):
+    return f"{COMMAND_GENERATION_CACHE_KEY_PREFIX}{device_pk}"
+
+
+@receiver(post_save, sender=Command)
+def notify_pending_command_on_create(sender, instance, created, **kwargs):
+    if created and str(instance.status).upper() == 'P':
+        cache.set(get_command_generation_cache_key(instance.device_id), uuid.uuid4().hex, None)
+        transaction.on_commit(notify_pending_command)
@@ -0,0 +1,357 @@
+import copy
+import logging
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone as dt_timezone
+from itertools import islice
+
+import simplejson as json
+from django.conf import settings
+from django.utils import timezone
+
+from device.models import RawData, RawDataBucket
+
+logger = logging.getLogger('device')
+
+RAW_DATA_LAYOUT_DOCUMENTS = 'documents'
+RAW_DATA_LAYOUT_BUCKETS = 'buckets'
+
+RAW_DATA_READ_CHUNK_SIZE = 2000
+RAW_DATA_BUCKET_PAGE_SIZE = 64
+# Numeric values nested deeper than this are only kept in the payloads.
+MAX_FIELD_DEPTH = 3
+
+RawDataPoint = namedtuple('RawDataPoint', ['data_arrival_time', 'channel', 'data_type', 'data'])
+
+_MISSING = object()
+
+
+def get_raw_data_layout():
+    if getattr(settings, 'RAW_DATA_STORAGE_LAYOUT', RAW_DATA_LAYOUT_DOCUMENTS) == RAW_DATA_LAYOUT_BUCKETS:
+        return RAW_DATA_LAYOUT_BUCKETS
+    return RAW_DATA_LAYOUT_DOCUMENTS
+
+
+def get_bucket_seconds():
+    return max(1, int(getattr(settings, 'RAW_DATA_BUCKET_SECONDS', 60 * 60)))
+
+
+def _as_utc(value):
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.get_current_timezone())
+    return value.astimezone(dt_timezone.utc)
+
+
+def get_bucket_start(data_arrival_time, bucket_seconds=None):
+    if bucket_seconds is None:
+        bucket_seconds = get_bucket_seconds()
+    epoch_seconds = int(_as_utc(data_arrival_time).timestamp())
+    return datetime.fromtimestamp(epoch_seconds - epoch_seconds % int(bucket_seconds), tz=dt_timezone.utc)
+
+
+def parse_raw_data_payload(data):
+    """Return a stored payload as loaded JSON, payloads may be stored as strings."""
+    if isinstance(data, (str, bytes)):
+        try:
+            return json.loads(data)
+        except ValueError:
+            return data
+    return data
+
+
+def extract_fields(data):
+    """
+        Return ({dotted path: number}, [every dotted path]) of a payload, for
+        values up to MAX_FIELD_DEPTH levels deep. Booleans are not numbers.
+    """
+    numeric = {}
+    paths = []
+
+    def walk(value, prefix, depth):
+        for key, item in value.items():
+            path = f"{prefix}{key}"
+            paths.append(path)
+            if isinstance(item, bool):
+                continue
+            if isinstance(item, (int, float)):
+                numeric[path] = item
+            elif isinstance(item, dict) and depth < MAX_FIELD_DEPTH:
+                walk(item, f"{path}.", depth + 1)
+
+    if isinstance(data, dict):
+        walk(data, '', 1)
+    return numeric, paths
+
+
+def _get_path(data, path):
+    value = data
+    for part in path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+def _set_path(target, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        target = target.setdefault(part, {})
+        if not isinstance(target, dict):
+            return
+    target[parts[-1]] = copy.deepcopy(value) if isinstance(value, (dict, list)) else value
+
+
+def project_data(data, fields):
+    """Keep only `fields` (dotted paths) of a payload, in the same nesting."""
+    if fields is None or not isinstance(data, dict):
+        return data
+    projected = {}
+    for field in fields:
+        value = _get_path(data, field)
+        if value is not _MISSING:
+            _set_path(projected, field, value)
+    return projected
+
+
+def _needs_payloads(fields, bucket_values, field_names):
+    """Whether the numeric columns of a bucket cannot answer the projection."""
+    for field in fields:
+        if field in bucket_values:
+            continue
+        if field in field_names or field.count('.') >= MAX_FIELD_DEPTH:
+            return True
+    return False
+
+
+def build_raw_data_bucket(device_id, data_type, bucket_start, points, compacted_at=None):
+    """
+        Return an unsaved RawDataBucket of the (data_arrival_time, channel,
+        data) points of a window, None without points.
+    """
+    bucket_start = _as_utc(bucket_start)
+    offsets = []
+    channels = []
+    payloads = []
+    values = {}
+    field_names = []
+    known_fields = set()
+    for data_arrival_time, channel, data in sorted(points, key=lambda point: point[0]):
+        data = parse_raw_data_payload(data)
+        numeric, paths = extract_fields(data)
+        index = len(offsets)
+        offsets.append((_as_utc(data_arrival_time) - bucket_start) // timedelta(microseconds=1))
+        channels.append(channel)
+        payloads.append(data)
+        for path, value in numeric.items():
+            column = values.setdefault(path, [])
+            column.extend([None] * (index - len(column)))
+            column.append(value)
+        for path in paths:
+            if path not in known_fields:
+                known_fields.add(path)
+                field_names.append(path)
+    if not offsets:
+        return None
+    for column in values.values():
+        column.extend([None] * (len(offsets) - len(column)))
+
+    return RawDataBucket(
+        device_id=device_id,
+        data_type=data_type,
+        bucket_start=bucket_start,
+        compacted_at=compacted_at or timezone.now(),
+        first_arrival_time=bucket_start + timedelta(microseconds=offsets[0]),
+        last_arrival_time=bucket_start + timedelta(microseconds=offsets[-1]),
+        sample_count=len(offsets),
+        offsets=offsets,
+        channels=channels,
+        payloads=payloads,
+        values=values,
+        field_names=field_names,
+    )
+
+
+def save_raw_data_bucket(bucket):
+    """Store a bucket in place of the earlier buckets of its window."""
+    bucket.save(force_insert=True)
+    # Readers use the latest compaction, so the replaced buckets go afterwards.
+    RawDataBucket.objects.filter(
+        device_id=bucket.device_id,
+        data_type=bucket.data_type,
+        bucket_start=bucket.bucket_start,
+    ).exclude(pk=bucket.pk).delete()
+    return bucket
+
+
+def compact_raw_data_window(device_id, data_type, bucket_start, bucket_seconds=None):
+    """
+        Rebuild the bucket of a device's data type and window from its RawData
+        documents. Returns the bucket, None when the window has no documents.
+    """
+    if bucket_seconds is None:
+        bucket_seconds = get_bucket_seconds()
+    rows = RawData.objects.filter(
+        device_id=device_id,
+        data_type=data_type,
+        data_arrival_time__gte=bucket_start,
+        data_arrival_time__lt=bucket_start + timedelta(seconds=bucket_seconds),
+    ).values_list('data_arrival_time', 'channel', 'data')
+    bucket = build_raw_data_bucket(device_id, data_type, bucket_start, rows)
+    if bucket is None:
+        return None
+    return save_raw_data_bucket(bucket)
+
+
+def iter_raw_data(device, data_type=None, start_time=None, end_time=None, include_end=False,
+                  fields=None, descending=False, limit=None):
+    """
+        Yield the device's stored messages as RawDataPoint(data_arrival_time,
+        channel, data_type, data) tuples in time order, newest first with
+        `descending`, arriving in [start_time, end_time), or up to and
+        including `end_time` with `include_end`.
+
+        `fields` is a list of dotted payload paths, `data` then only holds
+        those paths. Documents are read without their id and device columns.
+        With the "buckets" layout, reads of one data type use the buckets of
+        compacted windows, without their payloads when the requested fields
+        are numeric, and the documents of the other windows. Reads with a
+        `limit` stay on the documents, a bucket holds a whole window.
+    """
+    if get_raw_data_layout() == RAW_DATA_LAYOUT_BUCKETS and data_type is not None and limit is None:
+        points = _iter_buckets(device, data_type, start_time, end_time, include_end, fields, descending)
+    else:
+        points = _iter_documents(device, data_type, start_time, end_time, include_end, fields, descending, limit)
+    if limit is not None:
+        points = islice(points, limit)
+    return points
+
+
+def get_latest_raw_data_point(device, data_type=None, end_time=None, fields=None):
+    """Return the latest RawDataPoint of the device at or before `end_time`, or None."""
+    return next(
+        iter_raw_data(
+            device,
+            data_type=data_type,
+            end_time=end_time,
+            include_end=True,
+            fields=fields,
+            descending=True,
+            limit=1,
+        ),
+        None,
+    )
+
+
+def _iter_documents(device, data_type, start_time, end_time, include_end, fields, descending, limit=None):
+    queryset = RawData.objects.filter(device=device)
+    if data_type is not None:
+        queryset = queryset.filter(data_type=data_type)
+    if start_time is not None:
+        queryset = queryset.filter(data_arrival_time__gte=start_time)
+    if end_time is not None:
+        if include_end:
+            queryset = queryset.filter(data_arrival_time__lte=end_time)
+        else:
+            queryset = queryset.filter(data_arrival_time__lt=end_time)
+    queryset = queryset.order_by('-data_arrival_time' if descending else 'data_arrival_time')
+    if limit is not None:
+        queryset = queryset[:limit]
+
+    rows = queryset.values_list('data_arrival_time', 'channel', 'data_type', 'data')
+    for data_arrival_time, channel, row_data_type, data in rows.iterator(chunk_size=RAW_DATA_READ_CHUNK_SIZE):
+        yield RawDataPoint(data_arrival_time, channel, row_data_type, project_data(parse_raw_data_payload(data), fields))
+
+
+def _iter_bucket_points(bucket, data_type, fields, descending, start_time, end_time, include_end):
+    if fields is not None and _needs_payloads(fields, bucket['values'] or {}, set(bucket['field_names'] or ())):
+        bucket['payloads'] = RawDataBucket.objects.filter(pk=bucket['id']).values_list('payloads', flat=True).first()
+    bucket_start = _as_utc(bucket['bucket_start'])
+    offsets = bucket['offsets'] or []
+    channels = bucket['channels'] or []
+    payloads = bucket.get('payloads')
+    bucket_values = bucket.get('values') or {}
+
+    indexes = range(len(offsets) - 1, -1, -1) if descending else range(len(offsets))
+    for index in indexes:
+        data_arrival_time = bucket_start + timedelta(microseconds=offsets[index])
+        if start_time is not None and data_arrival_time < start_time:
+            continue
+        if end_time is not None and (data_arrival_time > end_time or (data_arrival_time == end_time and not include_end)):
+            continue
+        if payloads is not None:
+            data = project_data(parse_raw_data_payload(payloads[index]), fields)
+        else:
+            data = {}
+            for field in fields:
+                column = bucket_values.get(field)
+                if column is not None and column[index] is not None:
+                    _set_path(data, field, column[index])
+        yield RawDataPoint(data_arrival_time, channels[index], data_type, data)
+
+
+def _iter_bucket_pages(queryset, descending):
+    """
+        Yield the latest bucket of every window, reading pages of one window
+        first and doubling up to RAW_DATA_BUCKET_PAGE_SIZE, so reads stopping
+        early (latest before a time) load few buckets.
+    """
+    page_size = 1
+    last_window = None
+    while True:
+        page = queryset
+        if last_window is not None:
+            # Keyset pages: skips the replaced buckets of the last window too.
+            if descending:
+                page = page.filter(bucket_start__lt=last_window)
+            else:
+                page = page.filter(bucket_start__gt=last_window)
+        page = list(page[:page_size])
+        for bucket in page:
+            if bucket['bucket_start'] == last_window:
+                # Replaced by a later compaction of the window.
+                continue
+            last_window = bucket['bucket_start']
+            yield bucket
+        if len(page) < page_size:
+            return
+        page_size = min(page_size * 2, RAW_DATA_BUCKET_PAGE_SIZE)
+
+
+def _iter_buckets(device, data_type, start_time, end_time, include_end, fields, descending):
+    window = timedelta(seconds=get_bucket_seconds())
+    start_time = _as_utc(start_time) if start_time is not None else None
+    end_time = _as_utc(end_time) if end_time is not None else None
+
+    queryset = RawDataBucket.objects.filter(device=device, data_type=data_type)
+    if start_time is not None:
+        queryset = queryset.filter(bucket_start__gte=get_bucket_start(start_time))
+    if end_time is not None:
+        queryset = queryset.filter(bucket_start__lte=end_time)
+    queryset = queryset.order_by('-bucket_start' if descending else 'bucket_start', '-compacted_at')
+    columns = ['id', 'bucket_start', 'offsets', 'channels']
+    columns += ['payloads'] if fields is None else ['values', 'field_names']
+
+    # Windows without a bucket (the open one, or ones not compacted or
+    # migrated yet) are read from the documents between the buckets.
+    cursor = end_time if descending else start_time
+    cursor_inclusive = include_end if descending else True
+    for bucket in _iter_bucket_pages(queryset.values(*columns), descending):
+        window_start = _as_utc(bucket['bucket_start'])
+        if descending:
+            window_end = window_start + window
+            if cursor is None or cursor > window_end or (cursor == window_end and cursor_inclusive):
+                yield from _iter_documents(
+                    device, data_type, window_end, cursor, cursor_inclusive, fields, True,
+                )
+            cursor = window_start
+            cursor_inclusive = False
+        else:
+            if cursor is None or cursor < window_start:
+                yield from _iter_documents(device, data_type, cursor, window_start, False, fields, False)
+            cursor = window_start + window
+        yield from _iter_bucket_points(bucket, data_type, fields, descending, start_time, end_time, include_end)
+
+    if descending:
+        if cursor is None or start_time is None or cursor > start_time:
+            yield from _iter_documents(device, data_type, start_time, cursor, cursor_inclusive, fields, True)
+    elif cursor is None or end_time is None or cursor < end_time or (cursor == end_time and include_end):
+        yield from _iter_documents(device, data_type, cursor, end_time, include_end, fields, False)
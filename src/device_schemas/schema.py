@@ -1,6 +1,9 @@
+import ast
 import json
 import logging
+import math
 import os
+from functools import lru_cache
 from typing import Dict
 
 import jsonschema
@@ -449,12 +452,18 @@ def translate_field_value(
     return value
 
 
-def extract_data(field_name: str, data: Dict, multiplier, offset):
-    fields_list = field_name.split(".")
+@lru_cache(maxsize=4096)
+def _split_field_path(field_name: str):
     if field_name == "":
+        return None
+    return tuple(field_name.split("."))
+
+
+def _extract_path(field_path, data: Dict, multiplier, offset):
+    if field_path is None:
         return 0
     current_dict = data
-    for this_field_name in fields_list:
+    for this_field_name in field_path:
         if isinstance(current_dict, dict) and len(this_field_name) > 0:
             current_dict = current_dict.get(this_field_name)
 
@@ -465,6 +474,138 @@ def extract_data(field_name: str, data: Dict, multiplier, offset):
     return current_dict
 
 
+def extract_data(field_name: str, data: Dict, multiplier, offset):
+    return _extract_path(_split_field_path(field_name), data, multiplier, offset)
+
+
+# Calculated fields are evaluated on a whitelisted expression tree: arithmetic,
+# comparisons, boolean logic, conditionals, literals and the functions below.
+# There are no builtins, so any other name fails with NameError when it is
+# evaluated, exactly like an undefined name did with a plain eval().
+SAFE_EXPRESSION_FUNCTIONS = {
+    "abs": abs,
+    "min": min,
+    "max": max,
+    "round": round,
+    "pow": pow,
+    "sum": sum,
+    "len": len,
+    "int": int,
+    "float": float,
+    "bool": bool,
+    "str": str,
+}
+_SAFE_EXPRESSION_GLOBALS = dict(SAFE_EXPRESSION_FUNCTIONS, __builtins__={})
+_SAFE_EXPRESSION_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp,
+    ast.Constant, ast.Name, ast.Load, ast.Call, ast.keyword, ast.Tuple, ast.List,
+    ast.Dict, ast.Set, ast.Subscript, ast.Slice,
+    ast.operator, ast.unaryop, ast.boolop, ast.cmpop,
+)
+_VALUE_PLACEHOLDER = "__v{}"
+
+
+def _compile_safe_expression(expression: str):
+    """
+        Parse an expression and compile it, rejecting anything outside the
+        whitelisted nodes (attribute access, lambdas, comprehensions, ...).
+    """
+    # eval() ignores leading blanks, ast.parse() does not.
+    tree = ast.parse(expression.lstrip(" \t"), mode="eval")
+    for node in ast.walk(tree):
+        if not isinstance(node, _SAFE_EXPRESSION_NODES):
+            raise ValueError(f"Expression element {type(node).__name__} is not allowed")
+    return compile(tree, "<calculated-field>", "eval")
+
+
+@lru_cache(maxsize=1024)
+def _compile_resolved_equation(equation: str):
+    return _compile_safe_expression(equation)
+
+
+class CompiledExpression:
+    """
+        A calculated field source, tokenised and compiled once.
+
+        `tokens` holds (token, kind, field_name, field_path) tuples with the
+        history prefixes already stripped and dotted paths pre-split. When every
+        value token sits in an operand position, `code` is the expression with
+        each value replaced by a placeholder, so evaluation only binds values.
+    """
+
+    __slots__ = ("source", "tokens", "value_count", "code", "power_operands")
+
+    def __init__(self, source: str):
+        self.source = source
+        self.tokens = []
+        skeleton = ""
+        previous_was_value = False
+        adjacent_values = False
+        value_index = 0
+        self.power_operands = set()
+        for token in source.split():
+            if token.startswith("lastValue__"):
+                kind, field_name = "lastValue", token.replace("lastValue__", "")
+            elif token.startswith("changeToday__"):
+                kind, field_name = "changeToday", token.replace("changeToday__", "")
+            elif token.startswith("changeThisMonth__"):
+                kind, field_name = "changeThisMonth", token.replace("changeThisMonth__", "")
+            elif "." in token:
+                kind, field_name = "rawField", token
+            else:
+                kind, field_name = "operator", None
+
+            if kind == "operator":
+                if previous_was_value and token.startswith("**"):
+                    # A negative value would be rendered as "-x ** y" == -(x ** y)
+                    self.power_operands.add(value_index - 1)
+                skeleton += " " + token + " "
+                previous_was_value = False
+                self.tokens.append((token, kind, None, None))
+                continue
+
+            adjacent_values = adjacent_values or previous_was_value
+            skeleton += _VALUE_PLACEHOLDER.format(value_index)
+            value_index += 1
+            previous_was_value = True
+            field_path = _split_field_path(field_name)
+            if kind == "rawField" and field_name.startswith("."):
+                field_path = (_split_field_path(field_name[1:]), field_path)
+            self.tokens.append((token, kind, field_name, field_path))
+
+        self.value_count = value_index
+        self.code = None
+        if not adjacent_values:
+            try:
+                self.code = _compile_safe_expression(skeleton)
+            except (SyntaxError, ValueError):
+                self.code = None
+
+    def evaluate(self, values, render_equation):
+        if self.code is not None and self._can_bind(values):
+            bindings = {
+                _VALUE_PLACEHOLDER.format(index): value
+                for index, value in enumerate(values)
+            }
+            return eval(self.code, _SAFE_EXPRESSION_GLOBALS, bindings)
+        # Values that are not plain numbers change how the expression reads
+        # (e.g. numeric strings), so evaluate the rendered equation instead.
+        return eval(_compile_resolved_equation(render_equation()), _SAFE_EXPRESSION_GLOBALS, {})
+
+    def _can_bind(self, values):
+        for value in values:
+            if type(value) not in (int, float, bool):
+                return False
+            if type(value) is float and not math.isfinite(value):
+                return False
+        return not any(str(values[index]).startswith("-") for index in self.power_operands)
+
+
+@lru_cache(maxsize=4096)
+def compile_calculated_expression(source: str) -> CompiledExpression:
+    return CompiledExpression(source)
+
+
 def extract_calculated_data(
     schema_target: str,
     target_name: str,
@@ -538,8 +679,9 @@ def extract_calculated_data(
         return value if isinstance(value, (int, float)) else 0
 
     original_expression = field_name
-    fields_and_operators = field_name.split()
-    equation = ""
+    compiled_expression = compile_calculated_expression(field_name)
+    values = []
+    equation_parts = []
     resolved_tokens = []
     if existing_statuses is None:
         existing_statuses = {}
@@ -552,21 +694,21 @@ def extract_calculated_data(
     first_raw_data = _normalize_snapshot(first_today.get("raw", {}))
     last_raw_data = _normalize_snapshot(last_today.get("raw", {}))
     current_target_fields = _normalize_snapshot(current_target_fields)
-    for field_or_operator in fields_and_operators:
+    for field_or_operator, token_kind, token_field_name, token_field_path in compiled_expression.tokens:
         operator = None
         field_name = None
         value_already_fetched = False
         next_value = None
-        if field_or_operator.startswith("lastValue__"):
-            field_name = field_or_operator.replace("lastValue__", "")
+        if token_kind == "lastValue":
+            field_name = token_field_name
             value_source = "last_status_scope"
-            next_value = extract_data(field_name, last_status_data, 1, 0)
+            next_value = _extract_path(token_field_path, last_status_data, 1, 0)
             if next_value is None:
                 value_source = "last_status_root"
-                next_value = extract_data(field_name, last_status_root, 1, 0)
+                next_value = _extract_path(token_field_path, last_status_root, 1, 0)
             if next_value is None:
                 value_source = "last_raw"
-                next_value = extract_data(field_name, last_raw_data, 1, 0)
+                next_value = _extract_path(token_field_path, last_raw_data, 1, 0)
             value_already_fetched = True
             if next_value is None:
                 next_value = 0
@@ -580,12 +722,12 @@ def extract_calculated_data(
                     "value": next_value,
                     "source": value_source,
                 })
-        elif field_or_operator.startswith("changeToday__"):
-            field_name = field_or_operator.replace("changeToday__", "")
+        elif token_kind == "changeToday":
+            field_name = token_field_name
             value_now_source = "current_raw"
-            value_now = extract_data(field_name, data, multiplier, offset)
+            value_now = _extract_path(token_field_path, data, multiplier, offset)
             if value_now is None:
-                value_now = extract_data(field_name, current_target_fields, multiplier, offset)
+                value_now = _extract_path(token_field_path, current_target_fields, multiplier, offset)
                 value_now_source = "current_status_fields"
             if (
                 value_now is None
@@ -594,16 +736,16 @@ def extract_calculated_data(
                 and field_name in (target_field_configs or {})
             ):
                 field_resolver(field_name)
-                value_now = extract_data(field_name, current_target_fields, multiplier, offset)
+                value_now = _extract_path(token_field_path, current_target_fields, multiplier, offset)
                 value_now_source = "current_status_fields"
-            value_first = extract_data(field_name, first_raw_data, 1, 0)
+            value_first = _extract_path(token_field_path, first_raw_data, 1, 0)
             value_first_source = "first_raw"
             if value_first is None:
                 value_first_source = "first_status_scope"
-                value_first = extract_data(field_name, first_status_data, 1, 0)
+                value_first = _extract_path(token_field_path, first_status_data, 1, 0)
             if value_first is None:
                 value_first_source = "first_status_root"
-                value_first = extract_data(field_name, first_status_root, 1, 0)
+                value_first = _extract_path(token_field_path, first_status_root, 1, 0)
             if value_first is None:
                 remembered_value = _as_number(value_now)
                 value_first = remembered_value
@@ -629,16 +771,16 @@ def extract_calculated_data(
                     "value_now_source": value_now_source,
                     "value_first_source": value_first_source,
                 })
-        elif field_or_operator.startswith("changeThisMonth__"):
-            field_name = field_or_operator.replace("changeThisMonth__", "")
+        elif token_kind == "changeThisMonth":
+            field_name = token_field_name
             first_this_month = _normalize_snapshot(existing_statuses.get("firstThisMonth", {}))
             first_month_status_root = _normalize_snapshot(first_this_month.get(schema_target, {}))
             first_month_status_data = _resolve_status_scope(first_month_status_root, target_name)
             first_month_raw_data = _normalize_snapshot(first_this_month.get("raw", {}))
             value_now_source = "current_raw"
-            value_now = extract_data(field_name, data, multiplier, offset)
+            value_now = _extract_path(token_field_path, data, multiplier, offset)
             if value_now is None:
-                value_now = extract_data(field_name, current_target_fields, multiplier, offset)
+                value_now = _extract_path(token_field_path, current_target_fields, multiplier, offset)
                 value_now_source = "current_status_fields"
             if (
                 value_now is None
@@ -647,16 +789,16 @@ def extract_calculated_data(
                 and field_name in (target_field_configs or {})
             ):
                 field_resolver(field_name)
-                value_now = extract_data(field_name, current_target_fields, multiplier, offset)
+                value_now = _extract_path(token_field_path, current_target_fields, multiplier, offset)
                 value_now_source = "current_status_fields"
-            value_first = extract_data(field_name, first_month_raw_data, 1, 0)
+            value_first = _extract_path(token_field_path, first_month_raw_data, 1, 0)
             value_first_source = "first_month_raw"
             if value_first is None:
                 value_first_source = "first_month_status_scope"
-                value_first = extract_data(field_name, first_month_status_data, 1, 0)
+                value_first = _extract_path(token_field_path, first_month_status_data, 1, 0)
             if value_first is None:
                 value_first_source = "first_month_status_root"
-                value_first = extract_data(field_name, first_month_status_root, 1, 0)
+                value_first = _extract_path(token_field_path, first_month_status_root, 1, 0)
             if value_first is None:
                 remembered_value = _as_number(value_now)
                 value_first = remembered_value
@@ -682,8 +824,8 @@ def extract_calculated_data(
                     "value_now_source": value_now_source,
                     "value_first_source": value_first_source,
                 })
-        elif "." in field_or_operator:
-            field_name = field_or_operator
+        elif token_kind == "rawField":
+            field_name = token_field_name
         else:
             operator = field_or_operator
 
@@ -691,7 +833,8 @@ def extract_calculated_data(
             field_source = "current_raw"
             if field_name.startswith("."):
                 current_field_name = field_name[1:]
-                next_value = extract_data(current_field_name, current_target_fields, multiplier, offset)
+                current_field_path, field_path = token_field_path
+                next_value = _extract_path(current_field_path, current_target_fields, multiplier, offset)
                 field_source = "current_status_fields"
                 if (
                     next_value is None
@@ -700,13 +843,13 @@ def extract_calculated_data(
                     and current_field_name in (target_field_configs or {})
                 ):
                     field_resolver(current_field_name)
-                    next_value = extract_data(current_field_name, current_target_fields, multiplier, offset)
+                    next_value = _extract_path(current_field_path, current_target_fields, multiplier, offset)
                     field_source = "current_status_fields"
                 if next_value is None:
-                    next_value = extract_data(field_name, data, multiplier, offset)
+                    next_value = _extract_path(field_path, data, multiplier, offset)
                     field_source = "current_raw"
             else:
-                next_value = extract_data(field_name, data, multiplier, offset)
+                next_value = _extract_path(token_field_path, data, multiplier, offset)
             value_already_fetched = True
             if include_debug:
                 resolved_tokens.append({
@@ -720,20 +863,28 @@ def extract_calculated_data(
         if value_already_fetched:
             if next_value is None:
                 next_value = 0
-            equation += f"{next_value}"
+            equation_parts.append(len(values))
+            values.append(next_value)
 
         elif operator is not None:
-            equation += " " + operator + " "
+            equation_parts.append(" " + operator + " ")
             if include_debug:
                 resolved_tokens.append({
                     "token": field_or_operator,
                     "kind": "operator",
                 })
 
+    def _render_equation():
+        return "".join(
+            f"{values[part]}" if isinstance(part, int) else part
+            for part in equation_parts
+        )
+
     value = None
     try:
-        value = eval(equation)
+        value = compiled_expression.evaluate(values, _render_equation)
     except Exception as ex:
+        equation = _render_equation()
         logger.warning(
             f"Error evaluating equation {equation} for field {field_name}. Exception: {ex}"
         )
@@ -742,7 +893,7 @@ def extract_calculated_data(
             "value": value,
             "detail": {
                 "expression": original_expression,
-                "resolved_expression": equation,
+                "resolved_expression": _render_equation(),
                 "resolved_tokens": resolved_tokens,
                 "current_status_fields": current_target_fields,
                 "first_status_scope": first_status_data,
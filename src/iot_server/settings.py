@@ -139,6 +139,23 @@ if CLICKHOUSE_ENABLED:
         }
     }
 
+# ClickHouse inserts are buffered per table and written in batches, see
+# device.clickhouse_models.buffer. Batches that cannot be written are spilled
+# to CLICKHOUSE_SPILL_DIR and re-sent once ClickHouse is reachable again, in chunks
+# of CLICKHOUSE_INSERT_BATCH_SIZE rows. A chunk ClickHouse rejects
+# CLICKHOUSE_SPILL_ATTEMPTS times is moved to a `<table>.tsv.rejected` file.
+CLICKHOUSE_INSERT_BATCH_SIZE = int(os.getenv("CLICKHOUSE_INSERT_BATCH_SIZE", 500))
+CLICKHOUSE_INSERT_MAX_DELAY_SECONDS = float(os.getenv("CLICKHOUSE_INSERT_MAX_DELAY_SECONDS", 5))
+CLICKHOUSE_INSERT_MAX_PENDING_ROWS = int(os.getenv("CLICKHOUSE_INSERT_MAX_PENDING_ROWS", 50000))
+CLICKHOUSE_INSERT_RETRIES = int(os.getenv("CLICKHOUSE_INSERT_RETRIES", 3))
+CLICKHOUSE_SPILL_DIR = os.getenv("CLICKHOUSE_SPILL_DIR", "/tmp/iot-clickhouse-spill")
+CLICKHOUSE_SPILL_ATTEMPTS = int(os.getenv("CLICKHOUSE_SPILL_ATTEMPTS", 3))
+
+# Report queries stream their results over a pool of keep-alive HTTP
+# connections per process, see device.clickhouse_models.query.
+CLICKHOUSE_QUERY_POOL_SIZE = int(os.getenv("CLICKHOUSE_QUERY_POOL_SIZE", 10))
+CLICKHOUSE_QUERY_TIMEOUT_SECONDS = float(os.getenv("CLICKHOUSE_QUERY_TIMEOUT_SECONDS", 60))
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -287,6 +304,95 @@ MQTT_HEALTH_FILE = os.path.join(MQTT_HEALTH_DIR, "mqtt-listener.json")
 MQTT_HEALTH_STALE_SECONDS = int(os.getenv("MQTT_HEALTH_STALE_SECONDS", 120))
 CLICKHOUSE_SYNC_STALE_SECONDS = int(os.getenv("CLICKHOUSE_SYNC_STALE_SECONDS", 900))
 
+# MQTT ingestion pipeline: messages are partitioned by device over a pool of
+# workers, each with its own bounded queue.
+MQTT_INGEST_WORKERS = int(os.getenv("MQTT_INGEST_WORKERS", 4))
+MQTT_INGEST_QUEUE_SIZE = int(os.getenv("MQTT_INGEST_QUEUE_SIZE", 1000))
+MQTT_INGEST_SHUTDOWN_TIMEOUT_SECONDS = int(os.getenv("MQTT_INGEST_SHUTDOWN_TIMEOUT_SECONDS", 30))
+
+# Websocket frames are acked from a pool of SOCKET_ACK_WORKERS threads; data frames are
+# ingested in the background by a device-partitioned pool like the MQTT one. A frame whose
+# device queue stays full for SOCKET_INGEST_SUBMIT_TIMEOUT_SECONDS is ingested inline on the
+# ack thread, which slows down the acks instead of losing the frame.
+SOCKET_ACK_WORKERS = int(os.getenv("SOCKET_ACK_WORKERS", 8))
+SOCKET_INGEST_WORKERS = int(os.getenv("SOCKET_INGEST_WORKERS", 4))
+SOCKET_INGEST_QUEUE_SIZE = int(os.getenv("SOCKET_INGEST_QUEUE_SIZE", 1000))
+SOCKET_INGEST_SUBMIT_TIMEOUT_SECONDS = float(os.getenv("SOCKET_INGEST_SUBMIT_TIMEOUT_SECONDS", 0.05))
+
+# Pending commands are published as soon as they are created (Redis pub/sub), with a
+# fallback poll every COMMAND_DISPATCH_POLL_SECONDS and at most COMMAND_DISPATCH_BATCH_SIZE
+# commands per round.
+COMMAND_DISPATCH_POLL_SECONDS = float(os.getenv("COMMAND_DISPATCH_POLL_SECONDS", 10))
+COMMAND_DISPATCH_BATCH_SIZE = int(os.getenv("COMMAND_DISPATCH_BATCH_SIZE", 100))
+COMMAND_ACK_TIMEOUT_SECONDS = int(os.getenv("COMMAND_ACK_TIMEOUT_SECONDS", 30))
+
+# Devices resolved by the MQTT listener and websocket ingestion are kept in an
+# in-process LRU cache, dropped on save through Redis pub/sub.
+DEVICE_LOCAL_CACHE_MAX_SIZE = int(os.getenv("DEVICE_LOCAL_CACHE_MAX_SIZE", 2048))
+DEVICE_LOCAL_CACHE_TTL_SECONDS = int(os.getenv("DEVICE_LOCAL_CACHE_TTL_SECONDS", 60))
+
+# Volatile device other_data fields (sync/heartbeat times, device status values) are kept
+# in Redis hashes and merged into the Device rows every DEVICE_STATE_FLUSH_SECONDS.
+DEVICE_STATE_FLUSH_SECONDS = float(os.getenv("DEVICE_STATE_FLUSH_SECONDS", 30))
+DEVICE_STATE_TTL_SECONDS = int(os.getenv("DEVICE_STATE_TTL_SECONDS", 24 * 60 * 60))
+
+# RawData rows are written in batches of up to RAW_DATA_BUFFER_SIZE rows, at most
+# RAW_DATA_BUFFER_MAX_DELAY_SECONDS after arrival. A size of 1 writes every row directly.
+# A row failing RAW_DATA_BUFFER_MAX_ATTEMPTS writes is dropped, and at most
+# RAW_DATA_BUFFER_MAX_PENDING_ROWS rows are kept while writes fail.
+RAW_DATA_BUFFER_SIZE = int(os.getenv("RAW_DATA_BUFFER_SIZE", 200))
+RAW_DATA_BUFFER_MAX_DELAY_SECONDS = float(os.getenv("RAW_DATA_BUFFER_MAX_DELAY_SECONDS", 2))
+RAW_DATA_BUFFER_MAX_PENDING_ROWS = int(os.getenv("RAW_DATA_BUFFER_MAX_PENDING_ROWS", 20000))
+RAW_DATA_BUFFER_MAX_ATTEMPTS = int(os.getenv("RAW_DATA_BUFFER_MAX_ATTEMPTS", 5))
+
+# RawData storage layout. "documents" stores one document per message. "buckets"
+# also compacts the documents of every closed RAW_DATA_BUCKET_SECONDS window into
+# one RawDataBucket per device and data type, RAW_DATA_BUCKET_GRACE_SECONDS after
+# the window closed; status context and weather reads then use the buckets and
+# only read documents for windows without one. Compact existing data with
+# `python manage.py migrate_rawdata_buckets`.
+RAW_DATA_STORAGE_LAYOUT = os.getenv("RAW_DATA_STORAGE_LAYOUT", "documents")
+RAW_DATA_BUCKET_SECONDS = int(os.getenv("RAW_DATA_BUCKET_SECONDS", 60 * 60))
+RAW_DATA_BUCKET_GRACE_SECONDS = int(os.getenv("RAW_DATA_BUCKET_GRACE_SECONDS", 5 * 60))
+
+# Per-device status processing context (first/last snapshots of the day and month)
+# kept in the cache between messages; it is rebuilt when a local day/month starts.
+# It is updated under a per-device cache lock; a message waiting longer than
+# STATUS_CONTEXT_LOCK_WAIT_SECONDS for it is processed without saving the context.
+STATUS_CONTEXT_CACHE_TIMEOUT_SECONDS = int(os.getenv("STATUS_CONTEXT_CACHE_TIMEOUT_SECONDS", 36 * 60 * 60))
+STATUS_CONTEXT_LOCK_SECONDS = int(os.getenv("STATUS_CONTEXT_LOCK_SECONDS", 60))
+STATUS_CONTEXT_LOCK_WAIT_SECONDS = float(os.getenv("STATUS_CONTEXT_LOCK_WAIT_SECONDS", 5))
+
+# Status replays read raw data in STATUS_REPLAY_CHUNK_HOURS windows and bulk insert the
+# statuses of each window; multi-device replays run on STATUS_REPLAY_WORKERS processes.
+STATUS_REPLAY_CHUNK_HOURS = int(os.getenv("STATUS_REPLAY_CHUNK_HOURS", 24))
+STATUS_REPLAY_WORKERS = int(os.getenv("STATUS_REPLAY_WORKERS", 4))
+
+# Per-device daily activity/energy rollups backing the summary widget.
+DAILY_ROLLUP_TIMEOUT_SECONDS = int(os.getenv("DAILY_ROLLUP_TIMEOUT_SECONDS", 2 * 24 * 60 * 60))
+
+# Stored weather lookups of a device are answered from a series of its weather entries
+# of the last WEATHER_SERIES_HOURS, cached for WEATHER_SERIES_CACHE_SECONDS and dropped
+# when weather is stored; older lookups query RawData.
+WEATHER_SERIES_HOURS = int(os.getenv("WEATHER_SERIES_HOURS", 24))
+WEATHER_SERIES_CACHE_SECONDS = int(os.getenv("WEATHER_SERIES_CACHE_SECONDS", 30 * 60))
+
+# Weather is fetched per WEATHER_GRID_DEGREES lat/lon cell and shared by the devices in
+# it; one worker fetches a cell at a time (cache lock). Cells requested within
+# WEATHER_CELL_HOT_SECONDS are fetched again in the background once their weather is
+# WEATHER_CELL_REFRESH_SECONDS old. WEATHER_API_CLIENT can be set to
+# "utils.weather_fetcher.StubWeatherClient" to use fixed local weather.
+WEATHER_API_CLIENT = os.getenv("WEATHER_API_CLIENT", "utils.weather_fetcher.OpenWeatherMapClient")
+WEATHER_API_TIMEOUT_SECONDS = float(os.getenv("WEATHER_API_TIMEOUT_SECONDS", 5))
+WEATHER_API_POOL_SIZE = int(os.getenv("WEATHER_API_POOL_SIZE", 4))
+WEATHER_GRID_DEGREES = float(os.getenv("WEATHER_GRID_DEGREES", 0.05))
+WEATHER_CELL_REFRESH_SECONDS = int(os.getenv("WEATHER_CELL_REFRESH_SECONDS", 30 * 60))
+WEATHER_CELL_HOT_SECONDS = int(os.getenv("WEATHER_CELL_HOT_SECONDS", 2 * 60 * 60))
+
+# Load detection models (datascience/*.coef) are read on first use and read again
+# when a file changes, checked at most every LOAD_MODEL_RELOAD_CHECK_SECONDS.
+LOAD_MODEL_RELOAD_CHECK_SECONDS = int(os.getenv("LOAD_MODEL_RELOAD_CHECK_SECONDS", 60))
+
 # Rate Limiting Settings for Data Ingestion API
 # User-level rate limiting: max requests per time window per authenticated user
 RATE_LIMIT_USER_REQUESTS = int(os.getenv("RATE_LIMIT_USER_REQUESTS", 10))
@@ -22,20 +22,218 @@ CLICKHOUSE_ENABLED = getattr(settings, 'CLICKHOUSE_ENABLED', False)
 if CLICKHOUSE_ENABLED:
     from device.clickhouse_models import (DerivedData, MeterData, MeterLoad,
                                           WeatherData)
-    from django_clickhouse.configuration import config
-    from django_clickhouse.database import connections
+    from device.clickhouse_models.query import get_query_client
 else:
     DerivedData = None
     MeterData = None
     MeterLoad = None
     WeatherData = None
-    config = None
-    connections = None
+    get_query_client = None
+STATISTICS_FIELDS = ('voltage', 'current', 'power', 'energy', 'runtime', 'frequency', 'temperature')
+STATISTICS_RAW_SOURCE = 'meterdata'
+STATISTICS_HOURLY_SOURCE = 'meterdata_hourly'
+STATISTICS_DAILY_SOURCE = 'meterdata_daily'
+HOUR = datetime.timedelta(hours=1)
+DAY = datetime.timedelta(days=1)
+# Gaps between the loads of an equipment longer than LOAD_GAP_MAX_SECONDS are
+# counted as LOAD_GAP_SUBSTITUTE_SECONDS of runtime.
+LOAD_GAP_MAX_SECONDS = 1000
+LOAD_GAP_SUBSTITUTE_SECONDS = 5 * 60
+APPLIANCE_USAGE_QUERY = """
+    select
+        equipment_name,
+        sum(seconds) as seconds,
+        sum(toFloat64(power) * seconds) as energy
+    from (
+        select
+            equipment_name,
+            power,
+            if(
+                row_index = 1,
+                0,
+                if(gap > {max_gap_seconds:UInt32}, {substitute_gap_seconds:UInt32}, gap)
+            ) as seconds
+        from (
+            select
+                equipment_name,
+                power,
+                row_number() over equipment_loads as row_index,
+                dateDiff('second', lagInFrame(data_arrival_time) over equipment_loads, data_arrival_time) as gap
+            from meterload
+            where
+                device = {device_id:UUID}
+                and equipment_name in {equipment_names:Array(String)}
+                and data_arrival_time >= {from_time:DateTime}
+                and data_arrival_time <  {to_time:DateTime}
+            window equipment_loads as (
+                partition by equipment_name
+                order by data_arrival_time
+                rows between 1 preceding and current row
+            )
+        )
+    )
+    group by equipment_name
+"""
 LIGHT_EQUIPMENTS = ['CFL', 'Tubelight', 'Bulb']
 SUMMER_EQUIPMENTS = ['Fan', 'Cooler', 'AC']
 OTHER_EQUIPMENTS = ['TV', 'Water Pump']
 
 
+def _as_naive_utc(value):
+    if timezone.is_aware(value):
+        value = value.astimezone(pytz.utc).replace(tzinfo=None)
+    return value
+
+
+def _floor(value, period):
+    if period == DAY:
+        return value.replace(hour=0, minute=0, second=0, microsecond=0)
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def _ceil(value, period):
+    floored = _floor(value, period)
+    return floored if floored == value else floored + period
+
+
+def plan_statistics_sources(from_time, to_time, now, use_daily=True):
+    """
+        Split [from_time, to_time) into (source, start, end) segments in time
+        order: whole closed UTC days from the daily view when `use_daily`,
+        whole closed hours from the hourly view, and raw meterdata rows for the
+        partial hours at the edges and the open current hour.
+    """
+    from_time = _as_naive_utc(from_time)
+    to_time = _as_naive_utc(to_time)
+    open_hour = _floor(_as_naive_utc(now), HOUR)
+    if from_time >= to_time:
+        return []
+
+    closed_end = max(from_time, min(to_time, open_hour))
+    segments = []
+
+    def add(source, start, end):
+        if start < end:
+            segments.append((source, start, end))
+
+    def add_hours(start, end):
+        first_hour = _ceil(start, HOUR)
+        last_hour = _floor(end, HOUR)
+        if first_hour >= last_hour:
+            add(STATISTICS_RAW_SOURCE, start, end)
+            return
+        add(STATISTICS_RAW_SOURCE, start, first_hour)
+        add(STATISTICS_HOURLY_SOURCE, first_hour, last_hour)
+        add(STATISTICS_RAW_SOURCE, last_hour, end)
+
+    first_day = _ceil(from_time, DAY)
+    last_day = _floor(closed_end, DAY)
+    if use_daily and first_day < last_day:
+        add_hours(from_time, first_day)
+        add(STATISTICS_DAILY_SOURCE, first_day, last_day)
+        add_hours(last_day, closed_end)
+    else:
+        add_hours(from_time, closed_end)
+    add(STATISTICS_RAW_SOURCE, closed_end, to_time)
+    return segments
+
+
+def _statistics_state_columns():
+    columns = ['data_points', 'initial_time', 'final_time']
+    for field in STATISTICS_FIELDS:
+        columns += [f'avg_{field}', f'min_{field}', f'max_{field}']
+    return columns
+
+
+def build_statistics_query(meter_ids, segments, time_aggregation):
+    """
+        Build the statistics query and its parameters of `segments`, see
+        plan_statistics_sources. Every segment yields aggregate states per
+        (meter, hour or day bucket), which are merged per `time_aggregation`
+        of the bucket. Buckets and bounds are UTC, like the segments.
+    """
+    selects = []
+    params = {'meter_ids': meter_ids}
+    for index, (source, start, end) in enumerate(segments):
+        params[f'start_{index}'] = start
+        params[f'end_{index}'] = end
+        if source == STATISTICS_RAW_SOURCE:
+            states = [
+                'countState() as state_data_points',
+                'minState(data.data_arrival_time) as state_initial_time',
+                'maxState(data.data_arrival_time) as state_final_time',
+            ]
+            for field in STATISTICS_FIELDS:
+                states += [
+                    f'{function}State(data.{field}) as state_{function}_{field}'
+                    for function in ('avg', 'min', 'max')
+                ]
+            selects.append("""
+                select
+                    meter,
+                    toStartOfHour(data.data_arrival_time, 'UTC') as bucket,
+                    {states}
+                from meterdata as data
+                where
+                    data.meter in {{meter_ids:Array(UUID)}}
+                    and data.data_arrival_time >= {{start_{index}:DateTime('UTC')}}
+                    and data.data_arrival_time <  {{end_{index}:DateTime('UTC')}}
+                group by
+                    meter,
+                    bucket
+            """.format(
+                states=',\n                    '.join(states),
+                index=index,
+            ))
+        else:
+            states = [f'{column} as state_{column}' for column in _statistics_state_columns()]
+            selects.append("""
+                select
+                    meter,
+                    bucket,
+                    {states}
+                from {source}
+                where
+                    meter in {{meter_ids:Array(UUID)}}
+                    and bucket >= {{start_{index}:DateTime('UTC')}}
+                    and bucket <  {{end_{index}:DateTime('UTC')}}
+            """.format(
+                states=',\n                    '.join(states),
+                source=source,
+                index=index,
+            ))
+
+    merges = []
+    for column in _statistics_state_columns():
+        function = {'data_points': 'count', 'initial_time': 'min', 'final_time': 'max'}.get(column, column[:3])
+        merges.append(f'{function}Merge(state_{column}) as {column}')
+    query = """
+        select
+            meter,
+            {time_aggregation} as aggregation_time,
+            {merges}
+        from ({selects})
+        group by
+            meter,
+            aggregation_time
+        order by aggregation_time
+    """.format(
+        time_aggregation=time_aggregation,
+        merges=',\n            '.join(merges),
+        selects='\n                union all\n'.join(selects),
+    )
+    return query, params
+
+
+def _clickhouse_text(value):
+    # Dates and times are used as keys and labels, keep them as ClickHouse prints them.
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+
 class DataReports(object):
     """
         class to provide methods to access the device data.
@@ -129,107 +327,38 @@ class DataReports(object):
         device_ip_address = self.device.ip_address
 
         if aggregation_period is None or aggregation_period == datetime.timedelta(hours=1):
-            time_aggregation = "toHour(data.data_arrival_time)"
+            time_aggregation = "toHour(bucket)"
         elif aggregation_period == datetime.timedelta(days=1):
-            time_aggregation = "toDate(data.data_arrival_time)"
+            time_aggregation = "toDate(bucket)"
         elif aggregation_period == datetime.timedelta(days=7):
-            time_aggregation = "toWeek(data.data_arrival_time)"
+            time_aggregation = "toWeek(bucket)"
         elif aggregation_period >= datetime.timedelta(days=30):
-            time_aggregation = "toMonth(data.data_arrival_time)"
+            time_aggregation = "toMonth(bucket)"
         else:
-            time_aggregation = "toHour(data.data_arrival_time)"
-
-        from_time_string = from_time.strftime("%Y-%m-%dT%H:%M:%S")
-        to_time_string = to_time.strftime("%Y-%m-%dT%H:%M:%S")
+            time_aggregation = "toHour(bucket)"
 
         meter_names = {}
         for meter in self.meters:
             meter_names[str(meter.id)] = meter.name
         meter_ids = list(meter_names.keys())
 
-        logger.debug("Getting statistics: {}, {}, {}, {}".format(device_ip_address, aggregation_period, from_time_string, to_time_string))
-        columns = [
-            "meter",
-            "aggregation_time",
-            "data_points",
-            "initial_time",
-            "final_time",
-            "avg_voltage",
-            "min_voltage",
-            "max_voltage",
-            "avg_current",
-            "min_current",
-            "max_current",
-            "avg_power",
-            "min_power",
-            "max_power",
-            "avg_energy",
-            "min_energy",
-            "max_energy",
-            "avg_runtime",
-            "min_runtime",
-            "max_runtime",
-            "avg_frequency",
-            "min_frequency",
-            "max_frequency",
-            "avg_temperature",
-            "min_temperature",
-            "max_temperature",
-        ]
-        connection = connections.get_connection(config.DEFAULT_DB_ALIAS)
-
-        rows = connection.raw("""
-            select
-                meter,
-                {time_aggregation} as aggregation_time,
-                count(id) as data_points,
-                min(data.data_arrival_time) as initial_time,
-                max(data.data_arrival_time) as final_time,
-                avg(data.voltage) as avg_voltage,
-                min(data.voltage) as min_voltage,
-                max(data.voltage) as max_voltage,
-                avg(data.current) as avg_current,
-                min(data.current) as min_current,
-                max(data.current) as max_current,
-                avg(data.power) as avg_power,
-                min(data.power) as min_power,
-                max(data.power) as max_power,
-                avg(data.energy) as avg_energy,
-                min(data.energy) as min_energy,
-                max(data.energy) as max_energy,
-                avg(data.runtime) as avg_runtime,
-                min(data.runtime) as min_runtime,
-                max(data.runtime) as max_runtime,
-                avg(data.frequency) as avg_frequency,
-                min(data.frequency) as min_frequency,
-                max(data.frequency) as max_frequency,
-                avg(data.temperature) as avg_temperature,
-                min(data.temperature) as min_temperature,
-                max(data.temperature) as max_temperature
-            from meterdata as data
-            where
-                data.meter in {meter_ids}
-                and data.data_arrival_time >= toDateTime('{from_time_string}')
-                and data.data_arrival_time <  toDateTime('{to_time_string}')
-            group by
-                meter,
-                aggregation_time
-            order by aggregation_time
-        """.format(
-            time_aggregation=time_aggregation,
-            meter_ids=meter_ids,
-            from_time_string=from_time_string,
-            to_time_string=to_time_string
-        )).split('\n')
-
-        data_list = (
-            dict(zip(columns, row.split('\t'))) for row in rows
+        # Closed hours and days are read from the pre-aggregated views, see
+        # device/clickhouse_migrations/0003_meterdata_statistics_views.py.
+        segments = plan_statistics_sources(
+            from_time, to_time, timezone.now(), use_daily=time_aggregation != "toHour(bucket)",
         )
+        if not segments:
+            return []
+
+        logger.debug("Getting statistics: {}, {}, {}, {}".format(device_ip_address, aggregation_period, from_time, to_time))
+        query, query_params = build_statistics_query(meter_ids, segments, time_aggregation)
+        rows = get_query_client().iter_rows(query, query_params)
         return (
             {
-                **x,
-                'meter_name': meter_names.get(x['meter'], ''),
-            } for x in data_list
+                **{column: _clickhouse_text(value) for column, value in row._asdict().items()},
+                'meter': str(row.meter),
+                'meter_name': meter_names.get(str(row.meter), ''),
+            } for row in rows
         )
 
     def get_latest_data(self):
@@ -318,19 +447,7 @@ class DataReports(object):
 
         meter_ids = list(meter_names.keys())
 
-        from_time_string = start_time.strftime("%Y-%m-%dT%H:%M:%S")
-        to_time_string = end_time.strftime("%Y-%m-%dT%H:%M:%S")
-
-        connection = connections.get_connection(config.DEFAULT_DB_ALIAS)
-
-        columns = [
-            "meter",
-            "data_arrival_time",
-            "power",
-            "energy"
-        ]
-
-        rows = connection.raw(
+        rows = get_query_client().iter_rows(
             """
                 select
                     meter,
@@ -340,40 +457,29 @@ class DataReports(object):
                 from
                     meterdata as data
                 where
-                    data.meter in {meter_ids}
-                    and data.data_arrival_time >= toDateTime('{from_time_string}')
-                    and data.data_arrival_time <  toDateTime('{to_time_string}')
+                    data.meter in {meter_ids:Array(UUID)}
+                    and data.data_arrival_time >= {from_time:DateTime}
+                    and data.data_arrival_time <  {to_time:DateTime}
                 group by
                     meter, data_arrival_time
                 order by
                     data_arrival_time
-            """.format(
-                meter_ids=meter_ids,
-                from_time_string=from_time_string,
-                to_time_string=to_time_string
-            )
-        ).split('\n')
-
-        data_list = (
-            dict(zip(columns, row.split('\t'))) for row in rows
+            """,
+            {'meter_ids': meter_ids, 'from_time': start_time, 'to_time': end_time},
         )
         return (
             {
-                'meter_name': meter_names.get(x['meter'], ''),
-                'data_arrival_time': x.get('data_arrival_time'),
-                'power': x.get('power'),
-                'energy': x.get('energy')
-            } for x in data_list
+                'meter_name': meter_names.get(str(row.meter), ''),
+                'data_arrival_time': _clickhouse_text(row.data_arrival_time),
+                'power': row.power,
+                'energy': row.energy
+            } for row in rows
         )
 
     def get_historic_weather_data(self, start_time, end_time):
         if not CLICKHOUSE_ENABLED:
             return []
-        from_time_string = start_time.strftime("%Y-%m-%dT%H:%M:%S")
-        to_time_string = end_time.strftime("%Y-%m-%dT%H:%M:%S")
-
-        connection = connections.get_connection(config.DEFAULT_DB_ALIAS)
-        rows = connection.raw(
+        rows = get_query_client().iter_rows(
             """
                 select
                     temperature,
@@ -383,35 +489,25 @@ class DataReports(object):
                 from
                     weatherdata as data
                 where
-                    data.device in {device_ids}
-                    and data.data_arrival_time >= toDateTime('{from_time_string}')
-                    and data.data_arrival_time <  toDateTime('{to_time_string}')
+                    data.device = {device_id:UUID}
+                    and data.data_arrival_time >= {from_time:DateTime}
+                    and data.data_arrival_time <  {to_time:DateTime}
                 order by
                     data_arrival_time
-            """.format(
-                device_ids=[str(self.device.id)],
-                from_time_string=from_time_string,
-                to_time_string=to_time_string
-            )
-        ).split('\n')
+            """,
+            {'device_id': self.device.id, 'from_time': start_time, 'to_time': end_time},
+        )
 
         data_list = []
         for row in rows:
-            cols = row.split('\t')
-            if len(cols) == 4:
-                temperature = round(int(cols[0]) / 100, 0)  if cols[0].isdigit() else None
-                humidity = round(int(cols[1]) / 100) if cols[1].isdigit() else None
-                data = json.loads(cols[2])['weather'][0] if len(cols[2]) > 0 else {}
-                description = data.get('description', '')
-                icon = data.get('icon', '')
-
-                data_list.append({
-                    "temperature": temperature,
-                    "humidity": humidity,
-                    "description": description,
-                    "icon": icon,
-                    "data_arrival_time": cols[3]
-                })
+            data = json.loads(row.data)['weather'][0] if len(row.data) > 0 else {}
+            data_list.append({
+                "temperature": round(row.temperature / 100, 0) if row.temperature is not None else None,
+                "humidity": round(row.humidity / 100) if row.humidity is not None else None,
+                "description": data.get('description', ''),
+                "icon": data.get('icon', ''),
+                "data_arrival_time": _clickhouse_text(row.data_arrival_time)
+            })
 
         return data_list
 
@@ -514,43 +610,25 @@ class DataReports(object):
 
         device_equipments = [eqp.equipment.name for eqp in self.device.get_all_equipments()]
 
-        if len(device_equipments) > 0:
-            load_list = MeterLoad.objects.filter(
-                equipment_name__in=device_equipments
-            ).filter(
-                data_arrival_time__gte=date_today,
-                data_arrival_time__lt=date_tomorrow
-            ).order_by(
-                'data_arrival_time'
-            )
-        else:
-            load_list = []
-
-        last_data_point = None
         load_data = {}
-
-        time_diff = 0
-        for load in load_list:
-
-            if last_data_point is not None:
-                time_diff = (load.data_arrival_time - last_data_point.data_arrival_time).total_seconds()
-
-            if time_diff > 1000:
-                time_diff = 5 * 60
-            elif time_diff < 0:
-                logger.error("Time diff is negative. {}".format(time_diff))
-
-            load_name = load.equipment_name
-            if load_name in load_data:
-                load_data[load_name]['seconds'] = load_data[load_name]['seconds'] + time_diff
-                load_data[load_name]['energy'] = float(load_data[load_name]['energy']) + float(load.power) * time_diff
-            else:
-                load_data[load_name] = {
-                    'seconds': 0,
-                    'energy': 0,
+        if CLICKHOUSE_ENABLED and len(device_equipments) > 0:
+            rows = get_query_client().iter_rows(
+                APPLIANCE_USAGE_QUERY,
+                {
+                    'device_id': self.device.id,
+                    'equipment_names': device_equipments,
+                    'from_time': date_today,
+                    'to_time': date_tomorrow,
+                    'max_gap_seconds': LOAD_GAP_MAX_SECONDS,
+                    'substitute_gap_seconds': LOAD_GAP_SUBSTITUTE_SECONDS,
+                },
+            )
+            for row in rows:
+                load_data[row.equipment_name] = {
+                    'seconds': row.seconds,
+                    'energy': row.energy,
                     'money': 0
                 }
-            last_data_point = load
 
         rate = self.rate.get_value() if self.rate is not None else 0.0
         for load in load_data:
@@ -1,7 +1,9 @@
 import json
 import logging
+import numbers
 
-from datascience.train_machine import Train
+import numpy as np
+from datascience.train_machine import ModelRegistry
 from device.models import Device, Meter
 from django.conf import settings
 from django.utils import timezone
@@ -9,12 +11,19 @@ from django.utils import timezone
 from .weather import get_weather_data_cached
 
 logger = logging.getLogger('django')
-load_model = Train()
+load_model = ModelRegistry(check_interval=getattr(settings, 'LOAD_MODEL_RELOAD_CHECK_SECONDS', 60))
+
+LOAD_FEATURES = 8
+# Bound on the rounding error of a dot product of the features plus the
+# intercept, relative to the sum of the absolute terms, with a margin for the
+# error of model.predict and of the bound itself.
+LOAD_PREDICTION_ERROR = 4 * (LOAD_FEATURES + 1) * np.finfo(float).eps
 
 CLICKHOUSE_ENABLED = getattr(settings, 'CLICKHOUSE_ENABLED', False)
 
 if CLICKHOUSE_ENABLED:
     from device.clickhouse_models import (MeterLoad, WeatherData,
+                                          clickhouse_buffer,
                                           create_model_instance)
 else:
     MeterLoad = None
@@ -24,12 +33,10 @@ else:
         return None
 
 
-def get_load_data_ai(device, data_point, sorted_equipments, temperature, humidity, wind_speed):
+def _load_features(data_point, temperature, humidity, wind_speed):
     """
-        Method to find out appliances list based on the data.
+        Returns the model input of a data point, power at index 4.
     """
-    equipments = []
-
     if isinstance(data_point, dict):
         power = data_point.get("power", 0)
         data_arrival_time = data_point["data_arrival_time"]
@@ -42,7 +49,7 @@ def get_load_data_ai(device, data_point, sorted_equipments, temperature, humidit
         power = data_point.power
         data_arrival_time = data_point.data_arrival_time
 
-    input_data_list = [
+    return [
         # float(data_point.device.latitude()),
         # float(data_point.device.longitude()),
         data_arrival_time.month,
@@ -55,24 +62,37 @@ def get_load_data_ai(device, data_point, sorted_equipments, temperature, humidit
         wind_speed,
     ]
 
+
+def _predict(model, rows):
+    # Handle sklearn version compatibility issues
+    try:
+        return model.predict(rows)
+    except AttributeError as attr_ex:
+        if "'LinearRegression' object has no attribute 'positive'" in str(attr_ex):
+            # Add the missing positive attribute for compatibility
+            if not hasattr(model, 'positive'):
+                model.positive = False
+            return model.predict(rows)
+        raise attr_ex
+
+
+def get_load_data_ai(device, data_point, sorted_equipments, temperature, humidity, wind_speed):
+    """
+        Method to find out appliances list based on the data.
+    """
+    equipments = []
+
+    input_data_list = _load_features(data_point, temperature, humidity, wind_speed)
+    power = input_data_list[4]
+    targets = load_model.targets
+
     for load in sorted_equipments:
         input_data_list[4] = power
-        if load.equipment.name in load_model.targets:
+        if load.equipment.name in targets:
             try:
-                model = load_model.targets[load.equipment.name]
-                
-                # Handle sklearn version compatibility issues
-                try:
-                    number = int(model.predict([input_data_list]))
-                except AttributeError as attr_ex:
-                    if "'LinearRegression' object has no attribute 'positive'" in str(attr_ex):
-                        # Add the missing positive attribute for compatibility
-                        if not hasattr(model, 'positive'):
-                            model.positive = False
-                        number = int(model.predict([input_data_list]))
-                    else:
-                        raise attr_ex
-                
+                model = targets[load.equipment.name]
+                number = int(_predict(model, [input_data_list])[0])
+
                 equipment_avg_power = (load.equipment.max_power + load.equipment.min_power) / 2
                 if number > 0 and equipment_avg_power <= power:
                     # Find the suitable number.
@@ -90,6 +110,163 @@ def get_load_data_ai(device, data_point, sorted_equipments, temperature, humidit
     return equipments
 
 
+class LinearLoadModels:
+    """
+        Coefficients of the LinearRegression load models stacked into one matrix,
+        column j predicting the count of names[j].
+    """
+
+    def __init__(self, targets):
+        from sklearn.linear_model import LinearRegression
+
+        self.targets = targets
+        self.names = [
+            name for name, model in targets.items()
+            if isinstance(model, LinearRegression)
+            and np.ndim(model.coef_) == 1 and len(model.coef_) == LOAD_FEATURES
+            and np.ndim(model.intercept_) == 0
+        ]
+        self.columns = {name: column for column, name in enumerate(self.names)}
+        self.coefficients = np.zeros((LOAD_FEATURES, len(self.names)))
+        self.intercepts = np.zeros(len(self.names))
+        for column, name in enumerate(self.names):
+            self.coefficients[:, column] = targets[name].coef_
+            self.intercepts[column] = targets[name].intercept_
+        self.magnitudes = np.abs(self.coefficients)
+        self.intercept_magnitudes = np.abs(self.intercepts)
+
+    def predict(self, features, columns=slice(None)):
+        """
+            Returns the predictions and bounds on their rounding errors.
+        """
+        predictions = features @ self.coefficients[:, columns] + self.intercepts[columns]
+        errors = np.abs(features) @ self.magnitudes[:, columns] + self.intercept_magnitudes[columns]
+        return predictions, errors * LOAD_PREDICTION_ERROR
+
+
+_linear_load_models = None
+
+
+def get_linear_load_models(targets):
+    global _linear_load_models
+    linear_load_models = _linear_load_models
+    if linear_load_models is None or linear_load_models.targets is not targets:
+        linear_load_models = _linear_load_models = LinearLoadModels(targets)
+    return linear_load_models
+
+
+def _feature_matrix(inputs):
+    matrix = np.full((len(inputs), LOAD_FEATURES), np.nan)
+    for row, input_data_list in enumerate(inputs):
+        for column, value in enumerate(input_data_list):
+            if type(value) in (int, float) or isinstance(value, numbers.Real):
+                matrix[row, column] = value
+    return matrix
+
+
+def _allocate(number, average_power, power):
+    """
+        Largest count up to number whose power fits in power, as found by
+        decrementing number in get_load_data_ai.
+    """
+    if average_power <= 0:
+        return number
+    count = np.minimum(number, np.floor(power / average_power))
+    # The floor of the quotient can be one off the product comparison.
+    while True:
+        over = count * average_power > power
+        if not over.any():
+            break
+        count[over] -= 1
+    while True:
+        under = (count < number) & ((count + 1) * average_power <= power)
+        if not under.any():
+            break
+        count[under] += 1
+    return count
+
+
+def get_load_data_ai_batch(points, sorted_equipments):
+    """
+        get_load_data_ai for many data points of one meter.
+
+        points are (data_point, temperature, humidity, wind_speed) tuples; the
+        loads of every point are returned in their order. The LinearRegression
+        models are evaluated for all points in one matrix multiply, and again
+        for the points whose remaining power changed, and the greedy
+        allocation runs on all points at once. A prediction within its
+        rounding error of an integer, which could truncate differently than
+        model.predict, is recomputed with it, so the loads are the same as
+        those of get_load_data_ai.
+    """
+    points = list(points)
+    loads = [[] for _ in points]
+    if not points:
+        return loads
+
+    inputs = [_load_features(*point) for point in points]
+    features = _feature_matrix(inputs)
+    # Models raise on missing values, get_load_data_ai finds no loads there.
+    valid = np.isfinite(features).all(axis=1)
+    rows = np.flatnonzero(valid)
+    if len(rows) == 0:
+        return loads
+    features = features[rows]
+    inputs = [inputs[row] for row in rows]
+    power = features[:, 4].copy()
+    initial_power = power.copy()
+
+    targets = load_model.targets
+    linear_models = get_linear_load_models(targets)
+    predictions, errors = linear_models.predict(features)
+
+    for load in sorted_equipments:
+        name = load.equipment.name
+        if name not in targets:
+            continue
+        model = targets[name]
+        try:
+            features[:, 4] = power
+            predicted = np.full(len(rows), np.nan)
+            if name in linear_models.columns:
+                column = linear_models.columns[name]
+                predicted[:] = predictions[:, column]
+                error = errors[:, column].copy()
+                changed = power != initial_power
+                if changed.any():
+                    predicted[changed], error[changed] = linear_models.predict(features[changed], column)
+                # model.predict may truncate to another integer within the error.
+                recheck = (error > 0) & (np.abs(predicted - np.round(predicted)) <= error)
+            else:
+                recheck = np.ones(len(rows), dtype=bool)
+            for index in np.flatnonzero(recheck):
+                if power[index] != initial_power[index]:
+                    inputs[index][4] = power[index].item()
+                try:
+                    predicted[index] = int(_predict(model, [inputs[index]])[0])
+                except Exception as ex:
+                    predicted[index] = np.nan
+                    logger.exception(f"Exception occurred while checking for load {name}: %s", str(ex))
+            number = np.trunc(predicted)
+
+            equipment_avg_power = (load.equipment.max_power + load.equipment.min_power) / 2
+            selected = np.flatnonzero((number > 0) & (equipment_avg_power <= power))
+            if len(selected) == 0:
+                continue
+            count = _allocate(number[selected], equipment_avg_power, power[selected])
+            for index, qty in zip(selected, count):
+                qty = int(qty)
+                loads[rows[index]].append({
+                    'name': name,
+                    'qty': qty,
+                    'power': equipment_avg_power * qty,
+                })
+                power[index] -= equipment_avg_power * qty
+        except Exception as ex:
+            logger.exception(f"Exception occurred while checking for load {name}: %s", str(ex))
+    return loads
+
+
 def detect_and_save_meter_loads(device: Device, meters_and_data, data_arrival_time):
     """
     Method to find the loads connected to a meter and store in the MeterLoad table.
@@ -99,9 +276,11 @@ def detect_and_save_meter_loads(device: Device, meters_and_data, data_arrival_ti
 
     all_equipments = device.get_all_equipments()
 
+    # Ingestion never waits for the weather API, a missed cell is fetched in the background.
     weather_data_now = get_weather_data_cached(
         device,
         reference_time=data_arrival_time,
+        wait_for_fetch=False,
     )
     temperature = weather_data_now.get('main', {}).get('temp', 0) if weather_data_now is not None else 0
     humidity = weather_data_now.get('main', {}).get('humidity', 0) if weather_data_now is not None else 0
@@ -134,13 +313,14 @@ def detect_and_save_meter_loads(device: Device, meters_and_data, data_arrival_ti
             if len(meter_equipments) == 0:
                 meter_equipments = all_equipments
 
-            loads = get_load_data_ai(
-                device,
-                data_point,
+            loads, = get_load_data_ai_batch(
+                [(
+                    data_point,
+                    (temperature - 273) * 10, # Convert from kelvin to degrees * 10
+                    humidity,
+                    wind_speed * 3.6 # convert from m/s to kh/h
+                )],
                 meter_equipments,
-                (temperature - 273) * 10, # Convert from kelvin to degrees * 10
-                humidity,
-                wind_speed * 3.6 # convert from m/s to kh/h
             )
 
             meter_loads = [
@@ -154,7 +334,7 @@ def detect_and_save_meter_loads(device: Device, meters_and_data, data_arrival_ti
                 ) for load in loads
             ]
 
-            MeterLoad.objects.bulk_create(meter_loads)
+            clickhouse_buffer.extend(meter_loads)
 
             data["loads"] = loads
     return data
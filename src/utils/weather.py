@@ -2,52 +2,159 @@
     Script to fetch weather info from Openweathermap.
 """
 import logging
+import uuid
+from bisect import bisect_right
+from datetime import timedelta
 
-import requests
+from api.buffers import raw_data_bucket_compactor
 from device.models import RawData
+from device.raw_data_store import RawDataPoint, get_latest_raw_data_point, iter_raw_data
 from django.conf import settings
 from django.core.cache import cache
 from django.utils import timezone
 
+from .weather_fetcher import weather_fetcher
+
 logger = logging.getLogger("django")
-openwathermap_api_key = settings.OPENWEATHERMAP_API_KEY
 WEATHER_RAW_DATA_TYPE = "weather"
 WEATHER_RAW_DATA_CHANNEL = "weather"
-
-url = "http://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&APPID={apikey}"
+WEATHER_SERIES_HOURS = getattr(settings, 'WEATHER_SERIES_HOURS', 24)
+WEATHER_SERIES_CACHE_SECONDS = getattr(settings, 'WEATHER_SERIES_CACHE_SECONDS', 30 * 60)
 
 
-def get_weather_data(latitude, longitude):
+def get_weather_data(latitude, longitude, wait=True):
     """
         Method to fetch weather data for the location (latitude, longitude).
+        Locations in the same grid cell share one fetch, see WeatherFetcher;
+        without `wait` None is returned until the cell has been fetched.
     """
-    weather_data_url = url.format(lat=latitude, lon=longitude, apikey=openwathermap_api_key)
+    return weather_fetcher.get(latitude, longitude, wait=wait)
 
-    resp = requests.get(weather_data_url)
-    if resp.status_code == 200:
-        return resp.json()
-    else:
-        raise Exception(f"Error fetching weather data. {resp.status_code}")
+
+class WeatherSeries:
+    """
+        Stored weather entries of a device answering `get_stored_weather_data`
+        for any time in [start_time, end_time), end_time None for no end.
+
+        The entries are kept in ascending order of arrival time, the first one
+        being the latest stored before start_time, and the entry at or before a
+        time is found by bisection.
+    """
+
+    def __init__(self, start_time, end_time=None, entries=()):
+        self.start_time = start_time
+        self.end_time = end_time
+        self.times = []
+        self.data = []
+        for data_arrival_time, data in entries:
+            self.times.append(data_arrival_time)
+            self.data.append(data)
+
+    def __len__(self):
+        return len(self.times)
+
+    def covers(self, reference_time):
+        if self.end_time is not None and reference_time >= self.end_time:
+            return False
+        # Nothing was stored between the first entry and start_time.
+        return reference_time >= self.start_time or (bool(self.times) and reference_time >= self.times[0])
+
+    def at(self, reference_time):
+        """
+            Returns the data of the latest entry at or before reference_time, or None.
+        """
+        index = bisect_right(self.times, reference_time) - 1
+        return self.data[index] if index >= 0 else None
+
+    def latest(self):
+        """
+            Returns the latest (data_arrival_time, data) entry, or None.
+        """
+        if not self.times:
+            return None
+        return self.times[-1], self.data[-1]
+
+
+def _aware(reference_time):
+    if reference_time is not None and timezone.is_naive(reference_time):
+        reference_time = timezone.make_aware(
+            reference_time,
+            timezone.get_current_timezone(),
+        )
+    return reference_time
+
+
+def _weather_series_version_cache_key(device):
+    return "{}_weather_series_version".format(device.ip_address)
+
+
+def _weather_series_cache_key(device):
+    version_key = _weather_series_version_cache_key(device)
+    version = cache.get(version_key)
+    if version is None:
+        cache.add(version_key, uuid.uuid4().hex, None)
+        version = cache.get(version_key)
+    return "{}_weather_series:{}".format(device.ip_address, version)
+
+
+def get_device_weather_series(device):
+    """
+        Returns the WeatherSeries of the device over the last WEATHER_SERIES_HOURS
+        without end, cached for WEATHER_SERIES_CACHE_SECONDS under the device's
+        series version. store_weather_data bumps the version after storing, so
+        a series read before the new weather is never cached as the current one.
+    """
+    cache_key = _weather_series_cache_key(device)
+    series = cache.get(cache_key)
+    if series is None:
+        series = get_stored_weather_series(device, timezone.now() - timedelta(hours=WEATHER_SERIES_HOURS), None)
+        cache.set(cache_key, series, WEATHER_SERIES_CACHE_SECONDS)
+    return series
 
 
 def get_stored_weather_data(device, reference_time=None):
-    weather_queryset = RawData.objects.filter(
-        device=device,
+    reference_time = _aware(reference_time)
+    series = get_device_weather_series(device)
+    if reference_time is None:
+        latest_entry = series.latest()
+        return latest_entry[1] if latest_entry is not None else None
+    if series.covers(reference_time):
+        return series.at(reference_time)
+
+    weather_entry = get_latest_raw_data_point(
+        device,
         data_type=WEATHER_RAW_DATA_TYPE,
+        end_time=reference_time,
     )
-    if reference_time is not None:
-        if timezone.is_naive(reference_time):
-            reference_time = timezone.make_aware(
-                reference_time,
-                timezone.get_current_timezone(),
-            )
-        weather_queryset = weather_queryset.filter(
-            data_arrival_time__lte=reference_time,
-        )
-    weather_entry = weather_queryset.order_by('-data_arrival_time').first()
     return weather_entry.data if weather_entry is not None else None
 
 
+def get_stored_weather_series(device, start_time, end_time):
+    """
+        Return the WeatherSeries answering `get_stored_weather_data(device, t)`
+        for any t in [start_time, end_time), end_time None for no end, read
+        with two queries.
+    """
+    entries = []
+    for preceding_entry in iter_raw_data(
+        device,
+        data_type=WEATHER_RAW_DATA_TYPE,
+        end_time=start_time,
+        descending=True,
+        limit=1,
+    ):
+        entries.append((preceding_entry.data_arrival_time, preceding_entry.data))
+
+    for weather_entry in iter_raw_data(
+        device,
+        data_type=WEATHER_RAW_DATA_TYPE,
+        start_time=start_time,
+        end_time=end_time,
+    ):
+        entries.append((weather_entry.data_arrival_time, weather_entry.data))
+    return WeatherSeries(start_time, end_time, entries)
+
+
 def store_weather_data(device, weather_data, data_arrival_time=None):
     if not weather_data:
         return None
@@ -60,23 +167,24 @@ def store_weather_data(device, weather_data, data_arrival_time=None):
             timezone.get_current_timezone(),
         )
 
-    latest_weather_entry = RawData.objects.filter(
-        device=device,
-        data_type=WEATHER_RAW_DATA_TYPE,
-    ).order_by('-data_arrival_time').first()
+    latest_weather_entry = get_device_weather_series(device).latest()
     if latest_weather_entry is not None:
-        same_timestamp = latest_weather_entry.data_arrival_time == data_arrival_time
-        same_payload = latest_weather_entry.data == weather_data
+        latest_arrival_time, latest_weather_data = latest_weather_entry
+        same_timestamp = latest_arrival_time == data_arrival_time
+        same_payload = latest_weather_data == weather_data
         if same_timestamp and same_payload:
-            return latest_weather_entry
+            return RawDataPoint(latest_arrival_time, WEATHER_RAW_DATA_CHANNEL, WEATHER_RAW_DATA_TYPE, latest_weather_data)
 
-    return RawData.objects.create(
+    raw_data = RawData.objects.create(
         device=device,
         channel=WEATHER_RAW_DATA_CHANNEL,
         data_type=WEATHER_RAW_DATA_TYPE,
         data_arrival_time=data_arrival_time,
         data=weather_data,
     )
+    raw_data_bucket_compactor.note([raw_data])
+    cache.set(_weather_series_version_cache_key(device), uuid.uuid4().hex, None)
+    return raw_data
 
 
 def get_weather_data_cached(
@@ -85,6 +193,7 @@ def get_weather_data_cached(
     reference_time=None,
     allow_fetch=True,
     store_in_raw_data=True,
+    wait_for_fetch=True,
 ):
     # logger.debug("Getting weather data for device {}".format(device.ip_address))
     if reference_time is not None:
@@ -106,9 +215,15 @@ def get_weather_data_cached(
     if device.position is not None:
         logger.info("Weather data not in cache for device {}".format(device.ip_address))
         try:
-            weather_data = get_weather_data(device.position.get("latitude"), device.position.get("longitude"))
+            weather_data = get_weather_data(
+                device.position.get("latitude"),
+                device.position.get("longitude"),
+                wait=wait_for_fetch,
+            )
         except Exception as e:
             logger.exception(e)
+            weather_data = None
+        if weather_data is None:
             weather_data = {}
         else:
             cache.set("{}_weather_data".format(device.ip_address), weather_data, settings.WEATHER_DATA_CACHE_MINUTES)
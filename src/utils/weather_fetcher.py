@@ -0,0 +1,266 @@
+"""
+    Weather of grid cells, fetched once for all the devices in a cell.
+"""
+import atexit
+import logging
+import threading
+import time
+import uuid
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("django")
+
+OPENWEATHERMAP_URL = "http://api.openweathermap.org/data/2.5/weather"
+
+
+class OpenWeatherMapClient:
+    """
+        Current weather from Openweathermap through a pooled session.
+    """
+
+    def __init__(self, api_key=None, timeout_seconds=5, pool_size=4, url=OPENWEATHERMAP_URL):
+        self.api_key = api_key
+        self.timeout_seconds = float(timeout_seconds)
+        self.url = url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, int(pool_size)))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch(self, latitude, longitude):
+        resp = self.session.get(
+            self.url,
+            params={"lat": latitude, "lon": longitude, "APPID": self.api_key},
+            timeout=self.timeout_seconds,
+        )
+        if resp.status_code == 200:
+            return resp.json()
+        else:
+            raise Exception(f"Error fetching weather data. {resp.status_code}")
+
+
+class StubWeatherClient:
+    """
+        Local stand-in for OpenWeatherMapClient returning fixed weather in its
+        response format, for tests and environments without an API key.
+    """
+
+    def __init__(self, **kwargs):
+        self.fetches = 0
+
+    def fetch(self, latitude, longitude):
+        self.fetches += 1
+        return {
+            "coord": {"lat": latitude, "lon": longitude},
+            "weather": [{"id": 800, "main": "Clear", "description": "clear sky", "icon": "01d"}],
+            "main": {"temp": 298.15, "feels_like": 298.15, "pressure": 1013, "humidity": 50},
+            "wind": {"speed": 2.0, "deg": 180},
+            "clouds": {"all": 0},
+            "dt": int(time.time()),
+            "name": "stub",
+            "cod": 200,
+        }
+
+
+class WeatherFetcher:
+    """
+        Weather of the grid cell of a position, shared by the devices in it.
+
+        Positions are rounded to `grid_degrees`, and the weather of a cell is
+        kept in the cache with its fetch time. One worker fetches a cell at a
+        time, the others wait for it (`wait=True`) or get the weather cached
+        before. A background thread fetches the cells missed without waiting,
+        and fetches again the cells requested in the last `hot_seconds` when
+        their weather is `refresh_seconds` old, so requests rarely find a cell
+        missing or stale.
+    """
+
+    KEY_PREFIX = 'weather:cell:v1:'
+    LOCK_KEY_PREFIX = 'weather:cell:v1:lock:'
+
+    def __init__(self, client, grid_degrees=0.05, refresh_seconds=30 * 60, hot_seconds=2 * 60 * 60,
+                 check_interval_seconds=60.0):
+        self.client = client
+        self.grid_degrees = float(grid_degrees)
+        self.refresh_seconds = float(refresh_seconds)
+        self.hot_seconds = float(hot_seconds)
+        self.check_interval_seconds = float(check_interval_seconds)
+        self.lock_seconds = max(1, int(getattr(client, 'timeout_seconds', 10) * 2) + 1)
+        self._hot_cells = {}
+        self._lock = threading.Lock()
+        self._instance_id = uuid.uuid4().hex
+        self._worker = None
+        self._stopped = threading.Event()
+        self._wake = threading.Event()
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+        self.failed_fetches = 0
+        self.coalesced_fetches = 0
+
+    def cell(self, latitude, longitude):
+        """Return the (latitude, longitude) center of the grid cell of a position."""
+        return (
+            round(round(float(latitude) / self.grid_degrees) * self.grid_degrees, 6),
+            round(round(float(longitude) / self.grid_degrees) * self.grid_degrees, 6),
+        )
+
+    def _key(self, cell):
+        return f"{self.KEY_PREFIX}{cell[0]}:{cell[1]}"
+
+    def _cached(self, cell):
+        try:
+            return cache.get(self._key(cell))
+        except Exception as ex:
+            logger.warning("Weather cache read failed for cell %s: %s", cell, ex)
+            return None
+
+    def get(self, latitude, longitude, wait=True):
+        """
+            Return the weather of the cell of (latitude, longitude).
+
+            A missing cell is fetched, or waited for when another worker
+            fetches it, if `wait`; otherwise it is left to the background
+            thread and None is returned. Stale weather is returned as is and
+            fetched again in the background.
+        """
+        cell = self.cell(latitude, longitude)
+        with self._lock:
+            self._hot_cells[cell] = time.monotonic()
+        self._ensure_worker()
+
+        entry = self._cached(cell)
+        if entry is not None:
+            self.hits += 1
+            if time.time() - entry['fetched_at'] >= self.refresh_seconds:
+                self._wake.set()
+            return entry['data']
+
+        self.misses += 1
+        if not wait:
+            self._wake.set()
+            return None
+        acquired, entry = self._fetch(cell)
+        if not acquired:
+            entry = self._wait_for(cell)
+        return entry['data'] if entry is not None else None
+
+    def _fetch(self, cell):
+        """
+            Fetch the weather of a cell unless another worker does, return
+            whether this worker fetched it and the cached entry, None on errors.
+        """
+        lock_key = f"{self.LOCK_KEY_PREFIX}{cell[0]}:{cell[1]}"
+        try:
+            acquired = cache.add(lock_key, self._instance_id, self.lock_seconds)
+        except Exception as ex:
+            logger.warning("Weather fetch lock failed for cell %s: %s", cell, ex)
+            acquired = True
+        if not acquired:
+            self.coalesced_fetches += 1
+            return False, None
+        try:
+            self.fetches += 1
+            try:
+                data = self.client.fetch(*cell)
+            except Exception as ex:
+                self.failed_fetches += 1
+                logger.warning("Fetching weather of cell %s failed: %s", cell, ex)
+                return True, None
+            entry = {'data': data, 'fetched_at': time.time()}
+            cache.set(self._key(cell), entry, int(self.refresh_seconds + self.hot_seconds))
+            return True, entry
+        finally:
+            try:
+                if cache.get(lock_key) == self._instance_id:
+                    cache.delete(lock_key)
+            except Exception as ex:
+                logger.warning("Weather fetch lock release failed for cell %s: %s", cell, ex)
+
+    def _wait_for(self, cell):
+        deadline = time.monotonic() + self.lock_seconds
+        while time.monotonic() < deadline:
+            entry = self._cached(cell)
+            if entry is not None:
+                return entry
+            time.sleep(0.1)
+        return None
+
+    def refresh_due(self):
+        """Fetch the hot cells missing or `refresh_seconds` old, return the count fetched."""
+        now = time.monotonic()
+        with self._lock:
+            for cell, requested_at in list(self._hot_cells.items()):
+                if now - requested_at > self.hot_seconds:
+                    del self._hot_cells[cell]
+            cells = list(self._hot_cells)
+
+        fetched = 0
+        for cell in cells:
+            if self._stopped.is_set():
+                break
+            entry = self._cached(cell)
+            if entry is not None and time.time() - entry['fetched_at'] < self.refresh_seconds:
+                continue
+            if self._fetch(cell)[1] is not None:
+                fetched += 1
+        return fetched
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._stopped.clear()
+            self._worker = threading.Thread(
+                target=self._run_worker,
+                name="weather-refresher",
+                daemon=True,
+            )
+            self._worker.start()
+
+    def _run_worker(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.check_interval_seconds)
+            self._wake.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                self.refresh_due()
+            except Exception as ex:
+                logger.exception("Weather refresh failed: %s", ex)
+
+    def close(self):
+        self._stopped.set()
+        self._wake.set()
+
+    def stats(self):
+        with self._lock:
+            hot_cells = len(self._hot_cells)
+        return {
+            "hot_cells": hot_cells,
+            "hits": self.hits,
+            "misses": self.misses,
+            "fetches": self.fetches,
+            "failed_fetches": self.failed_fetches,
+            "coalesced_fetches": self.coalesced_fetches,
+        }
+
+
+weather_fetcher = WeatherFetcher(
+    import_string(getattr(settings, 'WEATHER_API_CLIENT', 'utils.weather_fetcher.OpenWeatherMapClient'))(
+        api_key=getattr(settings, 'OPENWEATHERMAP_API_KEY', None),
+        timeout_seconds=getattr(settings, 'WEATHER_API_TIMEOUT_SECONDS', 5),
+        pool_size=getattr(settings, 'WEATHER_API_POOL_SIZE', 4),
+    ),
+    grid_degrees=getattr(settings, 'WEATHER_GRID_DEGREES', 0.05),
+    refresh_seconds=getattr(settings, 'WEATHER_CELL_REFRESH_SECONDS', 30 * 60),
+    hot_seconds=getattr(settings, 'WEATHER_CELL_HOT_SECONDS', 2 * 60 * 60),
+)
+atexit.register(weather_fetcher.close)